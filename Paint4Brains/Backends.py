@@ -0,0 +1,131 @@
+"""Paint4Brains Inference Backends
+
+This file contains the inference backends the Segmenter can run the QuickNAT models with.
+Every backend is built for one orientation of a Segmenter and offers the same predict method, taking a batch of slices and returning the scores of each class as a numpy array.
+Backends also offer a prepare method, building any files they need once, before several worker processes create their own backends.
+The backend used is chosen by name when creating the Segmenter.
+
+Attributes:
+    backends (dict): Backend classes by name.
+
+Usage:
+    To use this module, pick a backend by name when creating the Segmenter:
+
+        from Paint4Brains.Segmenter import Segmenter
+
+        segmentation_operation = Segmenter(backend="onnx", threads=4)
+
+    The ONNX backend needs the onnx extra to be installed:
+
+        $ pip install -e .[onnx]
+
+"""
+
+import os
+import numpy as np
+import torch
+
+try:
+    import onnxruntime
+except ImportError:  # Optional, only needed for the ONNX backend
+    onnxruntime = None
+
+
+class TorchBackend:
+    """TorchBackend class for Paint4Brains.
+
+    Runs the models with PyTorch, on the device of the Segmenter.
+    The models are loaded by the Segmenter, so the quantised and TorchScript versions are used when available.
+
+    Args:
+        segmenter (Segmenter): Segmenter the backend runs for
+        orientation (str): String indicating the orientation of the slices (COR or AXI)
+    """
+
+    def __init__(self, segmenter, orientation):
+        self.device = segmenter.device
+        self.cuda = segmenter.cuda_available and segmenter.device == "cuda"
+        self.model = segmenter.load_model(orientation)
+
+    @staticmethod
+    def prepare(segmenter, orientation):
+        """Builds the cached quantised model, if the segmenter uses one and it does not exist yet.
+
+        Args:
+            segmenter (Segmenter): Segmenter the backend runs for
+            orientation (str): String indicating the orientation of the slices (COR or AXI)
+        """
+        if segmenter.quantised and segmenter.device == "cpu":
+            segmenter.load_model(orientation)
+
+    def predict(self, batch):
+        """Forward pass
+
+        Args:
+            batch (torch.tensor): Slices of shape (N, 1, 256, 256)
+
+        Returns:
+            np.array: Scores of shape (N, 33, 256, 256)
+        """
+        if self.cuda:
+            batch = batch.cuda(self.device)
+        with torch.no_grad():
+            return self.model(batch).cpu().numpy()
+
+
+class OnnxBackend:
+    """OnnxBackend class for Paint4Brains.
+
+    Runs the models on the CPU with ONNX Runtime, with all its graph optimisations enabled.
+    The models are exported to ONNX next to the checkpoints the first time they are needed.
+
+    Args:
+        segmenter (Segmenter): Segmenter the backend runs for
+        orientation (str): String indicating the orientation of the slices (COR or AXI)
+    """
+
+    def __init__(self, segmenter, orientation):
+        path = self.prepare(segmenter, orientation)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if segmenter.threads is not None:
+            options.intra_op_num_threads = segmenter.threads
+            options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    @staticmethod
+    def prepare(segmenter, orientation):
+        """Exports the model to ONNX, if it has not been exported yet.
+
+        Args:
+            segmenter (Segmenter): Segmenter the backend runs for
+            orientation (str): String indicating the orientation of the slices (COR or AXI)
+
+        Returns:
+            str: Path to the ONNX model
+        """
+        if onnxruntime is None:
+            raise ImportError("The ONNX backend needs onnxruntime to be installed")
+        # Imported here as ModelExport builds on top of the Segmenter, which uses this module
+        from Paint4Brains.ModelExport import onnx_path, export_onnx, load_checkpoint
+        model_path = segmenter.coronal_model_path if orientation == "COR" else segmenter.axial_model_path
+        path = onnx_path(model_path)
+        if not os.path.exists(path):
+            export_onnx(load_checkpoint(model_path), path)
+        return path
+
+    def predict(self, batch):
+        """Forward pass
+
+        Args:
+            batch (torch.tensor): Slices of shape (N, 1, 256, 256)
+
+        Returns:
+            np.array: Scores of shape (N, 33, 256, 256)
+        """
+        batch = np.ascontiguousarray(batch.numpy(), dtype=np.float32)
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+backends = {"torch": TorchBackend, "onnx": OnnxBackend}
@@ -13,8 +13,8 @@ Usage:
 
 import numpy as np
 import nibabel as nib
-from Paint4Brains.Extractor import Extractor
-from Paint4Brains.Segmenter import Segmenter
+from Paint4Brains.Segmenter import unsegmented
+from Paint4Brains.DaemonClient import DaemonClient
 
 
 class BrainData:
@@ -49,6 +49,7 @@ class BrainData:
         self.__current_label = 1
         self.other_labels_data = np.zeros(self.data.shape)
         self.multiple_labels = False
+        self.confidence = None
 
         if self.label_filename is None:
             self.label_data = np.zeros(self.data.shape)
@@ -69,19 +70,49 @@ class BrainData:
         self.probability_mask = np.zeros(self.shape)
         self.full_head = self.data.copy()
         self.only_brain = []
-        self.segmenter = Segmenter()
+        # The models run in the segmentation daemon if there is one, or in a worker process otherwise.
+        self.segmenter = DaemonClient()
+        # The confidence of the labels is only computed once the user asks to review uncertain regions
+        self.keep_confidence = False
 
         self.edit_history = [
-            [self.label_data.copy(), self.other_labels_data.copy()]]
+            [self.label_data.copy(), self.other_labels_data.copy(), self.__current_label]]
         self.edits_recorded = 10
         self.current_edit = 1
 
+        # Voxels painted since the last stored edit and the box containing them
+        self.__stroke = []
+        self.dirty_box = None
+
+        # Voxels whose labels have been received from a running segmentation
+        self.__segmented = None
+
+    def get_volume_slice(self, volume, i):
+        """Function returning the 2D slice of any volume for a given point
+
+        Depending on the desired view (self.section) it returns a different 2-D slice of the 3-D volume.
+        A number of transposes and flips are done to return the 2_D image with a sensible orientation.
+        The volume can be the data, any of the labels or a downsampled version of them. Only views are returned, no data is copied.
+
+        Args:
+            volume (np.array): 3-D array with the same orientation as the data
+            i (int): Index point, indicating the desired location where the 2D slice is to be sampled.
+
+        Returns:
+            np.array: 2D slice at point i of the volume
+        """
+        if self.section == 0:
+            return volume[i]
+        elif self.section == 1:
+            return np.flip(volume[:, i].transpose())
+        elif self.section == 2:
+            return np.flip(volume[:, :, i].transpose(), axis=1)
+
     def get_data_slice(self, i):
         """Function returning the 2D MRI slice for a given point
 
         This function Returns the 2-D slice at point i of the full MRI data (not labels).
         Depending on the desired view (self.section) it returns a different 2-D slice of the 3-D data.
-        A number of transposes and flips are done to return the 2_D image with a sensible orientation.
 
         Args:
             i (int): Index point, indicating the desired location where the 2D slice is to be sampled.
@@ -89,12 +120,7 @@ class BrainData:
         Returns:
             list: 2D slice at point i of the full MRI data
         """
-        if self.section == 0:
-            return self.data[i]
-        elif self.section == 1:
-            return np.flip(self.data[:, i].transpose())
-        elif self.section == 2:
-            return np.flip(self.data[:, :, i].transpose(), axis=1)
+        return self.get_volume_slice(self.data, i)
 
     @property
     def current_data_slice(self):
@@ -120,12 +146,7 @@ class BrainData:
             list: 2-D slice at point i of the labelled data
         """
         self.label_data = np.clip(self.label_data, 0, 1)
-        if self.section == 0:
-            return self.label_data[i]
-        elif self.section == 1:
-            return np.flip(self.label_data[:, i].transpose())
-        elif self.section == 2:
-            return np.flip(self.label_data[:, :, i].transpose(), axis=1)
+        return self.get_volume_slice(self.label_data, i)
 
     @property
     def current_label_data_slice(self):
@@ -150,12 +171,7 @@ class BrainData:
         Returns:
             list: 2-D slice at point i of all labelled data
         """
-        if self.section == 0:
-            return self.other_labels_data[i]
-        elif self.section == 1:
-            return np.flip(self.other_labels_data[:, i].transpose())
-        elif self.section == 2:
-            return np.flip(self.other_labels_data[:, :, i].transpose(), axis=1)
+        return self.get_volume_slice(self.other_labels_data, i)
 
     @property
     def current_other_labels_data_slice(self):
@@ -179,8 +195,19 @@ class BrainData:
         """
         self.label_filename = filename
         self.__nib_label_data = nib.load(self.label_filename)
-        x = np.flip(self.__nib_label_data.as_reoriented(
-            self.__orientation).get_fdata().transpose()).astype(np.int8)
+        self.set_label_data(self.__nib_label_data.get_fdata())
+
+    def set_label_data(self, labels):
+        """Segmentation labels setter
+
+        Same as load_label_data, but the labels are given as an array with the voxels of the original file (e.g. as returned by Segmenter.segment_array).
+
+        Args:
+            labels (np.array): 3-D array of labels with the orientation of the original file
+        """
+        self.__stroke = []
+        self.dirty_box = None
+        x = self.from_native(labels).astype(np.int8)
         self.different_labels = np.unique(x)
         number_of_labels = len(self.different_labels)
         if number_of_labels == 2:
@@ -193,6 +220,61 @@ class BrainData:
             self.label_data = np.where(x == self.__current_label, 1, 0)
             self.other_labels_data = np.where(self.label_data == 1, 0, x)
 
+    def set_partial_labels(self, labels):
+        """Partial segmentation labels setter
+
+        Merges the labels of the slices segmented so far (as sent to the subscribers of Segmenter.subscribe_labels) into the current labels.
+        Voxels which have not been segmented yet keep their current labels (e.g. those of a preview).
+        Only the voxels segmented since the previous call are written, straight into both label volumes, so this stays cheap enough to run on the GUI thread.
+        The stroke being painted is kept.
+
+        Args:
+            labels (np.array): 3-D array of labels with the orientation of the original file, unsegmented where not known yet
+
+        Returns:
+            np.array: Boolean 3-D array with the same orientation as the data, True for the voxels segmented since the previous call
+        """
+        # Only a view of the labels is taken, nothing is copied
+        x = self.from_native(labels)
+        segmented = x != unsegmented
+        new = segmented if self.__segmented is None else segmented & ~self.__segmented
+        self.__segmented = segmented
+        index = np.nonzero(new)
+        values = x[index]
+        if len(values) == 0:
+            return new
+        self.different_labels = np.union1d(self.different_labels, values)
+        self.multiple_labels = self.multiple_labels or len(self.different_labels) > 2
+        current = values == self.__current_label
+        self.label_data[index] = current
+        self.other_labels_data[index] = np.where(current, 0, values)
+        return new
+
+    def load_confidence(self, filename):
+        """Confidence map loader
+
+        Loads a confidence map saved by the Segmenter (<scan>_confidence.npy).
+        The file is mapped rather than read, so only the slices displayed are ever loaded.
+        The following segmentations compute a confidence map as well.
+
+        Args:
+            filename (str): Path of the confidence map
+        """
+        self.keep_confidence = True
+        self.set_confidence(np.load(filename, mmap_mode="r"))
+
+    def set_confidence(self, confidence):
+        """Confidence map setter
+
+        Args:
+            confidence (np.array): Confidence map with the orientation of the original file (as kept by the Segmenter), or None to remove it
+        """
+        if confidence is None:
+            self.confidence = None
+        else:
+            # Only views are taken, so a mapped file stays on disk
+            self.confidence = self.from_native(confidence)
+
     def save_label_data(self, saving_filename):
         """Label Data Saver
 
@@ -268,13 +350,14 @@ class BrainData:
         """Brain Extraction
 
         Function which performs brain extraction/skull stripping on nifti images. To run extraction, this function uses the deepbrain neural network.
+        The network is run by the segmenter, in the segmentation daemon or a worker process by default.
         """
         # If it has already been extracted (mostly empty) don't do it again
         if self.extracted:
             return 0
         elif len(self.only_brain) == 0:
-            ext = Extractor()
-            self.probability_mask = ext.run(self.data)
+            self.segmenter.run = True
+            self.probability_mask = self.segmenter.extract(self.data)
             mask2 = np.where(self.probability_mask >
                              self.extraction_cutoff, 1, 0)
             self.only_brain = self.data * mask2
@@ -316,24 +399,99 @@ class BrainData:
         data_array = reoriented_img.get_fdata()
         self.data = data_array / np.max(data_array)
 
-    def segment(self, device):
+    def to_native(self, volume):
+        """Native orientation
+
+        Undoes the reorientation, transposition and flips applied to the data when loading it.
+        The result lines up with the voxels of the original file.
+
+        Args:
+            volume (np.array): 3-D array with the same orientation as the data
+
+        Returns:
+            np.array: 3-D array with the orientation of the original file
+        """
+        reoriented = np.flip(volume).transpose()
+        transformation = nib.orientations.ornt_transform(
+            nib.orientations.axcodes2ornt(("R", "A", "S")), self.__orientation)
+        return nib.orientations.apply_orientation(reoriented, transformation)
+
+    def from_native(self, volume):
+        """Loaded orientation
+
+        Applies the reorientation, transposition and flips applied to the data when loading it. This is the inverse of to_native.
+
+        Args:
+            volume (np.array): 3-D array with the orientation of the original file
+
+        Returns:
+            np.array: 3-D array with the same orientation as the data
+        """
+        return np.flip(nib.orientations.apply_orientation(volume, self.__orientation).transpose())
+
+    def segment(self, device, save=False):
         """Brain Segmenter
 
         This function calls the Segmenter file to perform brain segmentation.
+        The scan is segmented in memory and the labels are used directly, without going through a file.
+        If the brain has already been extracted, the extraction mask is used to skip the slices without any brain.
+        On the CPU, the segmentation is checkpointed and segmenting the same brain again resumes a cancelled run.
+        If self.keep_confidence is True, the confidence of the labels is kept in self.confidence, and saved as <scan>_confidence.npy when the labels are saved.
 
         Args:
             device (str/int): Device to run the neural network on, can be "cpu" or cuda-enabled GPU ("gpu").
+            save (bool): Whether the labels should also be saved next to the scan, as <scan>_segmented.nii.gz
         """
         try:
             self.segmenter.device = device
             self.segmenter.run = True
-            self.label_filename = self.segmenter.segment(self.filename)
+            # Segmentations on the CPU take hours, so they can be resumed if cancelled
+            self.segmenter.checkpoint = device == "cpu"
+            self.segmenter.confidence = self.keep_confidence
+            self.__segmented = None
+            mask = self._segmentation_mask()
+            # The data already in memory is segmented, rather than the file it came from
+            labels = self.segmenter.segment_array(self.to_native(self.full_head), self.__nib_data.affine, mask=mask)
+            if save:
+                self.label_filename = self.segmenter.save_labels(labels, self.filename, self.__nib_data)
+                if self.segmenter.confidence:
+                    self.segmenter.save_confidence(self.segmenter.confidence_map, self.filename)
         except Exception as e:
             raise e
         else:
-            self.load_label_data(self.label_filename)
+            self.set_label_data(labels)
+            self.set_confidence(self.segmenter.confidence_map)
             self.store_edit()
 
+    def segment_preview(self, device, step=4):
+        """Brain Segmentation Preview
+
+        Quickly segments approximate labels (see Segmenter.segment_preview), to be reviewed while the full segmentation runs.
+        The labels replace the current ones, and are replaced in turn by those of the full segmentation.
+
+        Args:
+            device (str/int): Device to run the neural network on, can be "cpu" or cuda-enabled GPU ("gpu").
+            step (int): Number of coronal slices each segmented slice stands for
+        """
+        self.segmenter.device = device
+        self.segmenter.run = True
+        self.segmenter.confidence = self.keep_confidence
+        labels = self.segmenter.segment_preview(self.to_native(self.full_head), self.__nib_data.affine,
+                                                mask=self._segmentation_mask(), step=step)
+        self.set_label_data(labels)
+        self.set_confidence(self.segmenter.confidence_map)
+        self.store_edit()
+
+    def _segmentation_mask(self):
+        """Brain mask restricting the segmentation
+
+        Returns:
+            np.array: Extraction mask with the orientation of the original file, or None if the brain has not been extracted
+        """
+        if len(self.only_brain) > 0:
+            return self.to_native(self.probability_mask > self.extraction_cutoff)
+        return None
+
     @property
     def current_label(self):
         """Current Label Values
@@ -359,26 +517,210 @@ class BrainData:
         if new_label not in self.different_labels:
             self.multiple_labels = True
             self.different_labels = np.append(self.different_labels, new_label)
-        self.label_data = np.clip(self.label_data, 0, 1)
-        other_minus_current = np.where(
-            self.other_labels_data == self.__current_label, 0, self.other_labels_data)
-        self.other_labels_data = np.where(
-            self.label_data == 0, other_minus_current, self.__current_label)
-        self.label_data = np.where(self.other_labels_data == new_label, 1, 0)
+        self.label_data, self.other_labels_data = select_label(
+            self.label_data, self.other_labels_data, self.__current_label, new_label)
         self.__current_label = new_label
 
+    def paint(self, mouse_x, mouse_y, values):
+        """Label painter
+
+        Writes a brush stroke straight into the 3-D labels of the label being edited.
+        The positions are given in the 2-D coordinates of the current view, so it works the same way for all three axes.
+        The values are added to the labels, which are kept between 0 and 1 (so -1 rubs labels out).
+        Every changed voxel is recorded, and the bounding box of all of them is kept in self.dirty_box until the edit is stored.
+
+        Args:
+            mouse_x (np.array): Positions along the x axis of the view
+            mouse_y (np.array): Positions along the y axis of the view
+            values (np.array): Values to be added at each position
+        """
+        voxels = np.broadcast_arrays(*self.position_as_voxel(np.asarray(mouse_x), np.asarray(mouse_y)))
+        inside = np.ones(voxels[0].shape, dtype=bool)
+        for axis in range(3):
+            inside &= (voxels[axis] >= 0) & (voxels[axis] < self.shape[axis])
+        index = tuple(v[inside] for v in voxels)
+        values = np.broadcast_to(values, inside.shape)[inside]
+
+        old = self.label_data[index]
+        new = np.clip(old + values, 0, 1).astype(self.label_data.dtype)
+        changed = old != new
+        if not np.any(changed):
+            return
+        index = tuple(v[changed] for v in index)
+        self.label_data[index] = new[changed]
+        self.__stroke.append((np.ravel_multi_index(index, self.shape), old[changed]))
+
+        box = np.array([[np.min(v), np.max(v) + 1] for v in index])
+        if self.dirty_box is None:
+            self.dirty_box = box
+        else:
+            self.dirty_box[:, 0] = np.minimum(self.dirty_box[:, 0], box[:, 0])
+            self.dirty_box[:, 1] = np.maximum(self.dirty_box[:, 1], box[:, 1])
+
+    @property
+    def dirty_region(self):
+        """Region changed since the last stored edit
+
+        Returns:
+            tuple: Three slices selecting the bounding box of the painted voxels, or None if nothing has been painted
+        """
+        if self.dirty_box is None:
+            return None
+        return tuple(slice(start, stop) for start, stop in self.dirty_box)
+
     def store_edit(self):
         """Function that stores previous edits.
 
         This list of edits are then used by the undo and redo functions.
+        If the changes were painted, only the changed voxels are stored (as a LabelEdit).
+        Otherwise, for example after loading new labels, a copy of both label volumes is stored, with the label they were split for.
         """
 
         if self.edits_recorded < len(self.edit_history):
-            self.edit_history = self.edit_history[1:]
+            self._drop_oldest_edit()
         if self.current_edit < len(self.edit_history):
             self.edit_history = self.edit_history[
                                 :(self.current_edit - len(self.edit_history))]
 
-        self.edit_history.append(
-            [self.label_data.copy(), self.other_labels_data.copy()])
+        if self.__stroke:
+            flat = np.concatenate([stroke[0] for stroke in self.__stroke])
+            old = np.concatenate([stroke[1] for stroke in self.__stroke])
+            # A voxel may have been painted several times, its original value is the first one recorded
+            flat, first = np.unique(flat, return_index=True)
+            self.edit_history.append(LabelEdit(self.current_label, flat, old[first],
+                                               self.label_data.flat[flat], self.dirty_box))
+        else:
+            self.edit_history.append(
+                [self.label_data.copy(), self.other_labels_data.copy(), self.current_label])
         self.current_edit = len(self.edit_history)
+        self.__stroke = []
+        self.dirty_box = None
+
+    def _drop_oldest_edit(self):
+        """Removes the oldest stored edit.
+
+        The first stored edit always has to be a full copy of the labels.
+        If the next one only holds the changed voxels, they are applied to the copy being dropped, which then replaces it.
+        The copy is split for the label that was painted first, as the changed voxels only make sense for that label.
+        """
+        first = self.edit_history[0]
+        self.edit_history = self.edit_history[1:]
+        edit = self.edit_history[0]
+        if isinstance(edit, LabelEdit):
+            label_data, other_labels_data = select_label(first[0], first[1], first[2], edit.label)
+            label_data.flat[edit.index] = edit.new
+            self.edit_history[0] = [label_data, other_labels_data, edit.label]
+        self.current_edit = max(self.current_edit - 1, 1)
+
+    def _restore_edit(self, position):
+        """Restores the labels to the state they had after a given stored edit.
+
+        Args:
+            position (int): Index of the stored edit in self.edit_history
+        """
+        start = position
+        while isinstance(self.edit_history[start], LabelEdit):
+            start -= 1
+        self._restore_copy(self.edit_history[start])
+        for edit in self.edit_history[start + 1:position + 1]:
+            self._apply_edit(edit, edit.new)
+
+    def _restore_copy(self, copy):
+        """Restores the labels from a stored copy of both label volumes, selecting the label they were split for."""
+        self.label_data = copy[0].copy()
+        self.other_labels_data = copy[1].copy()
+        if copy[2] not in self.different_labels:
+            self.different_labels = np.append(self.different_labels, copy[2])
+        self.__current_label = copy[2]
+
+    def _apply_edit(self, edit, values):
+        """Writes the values of a LabelEdit into the labels.
+
+        The edit is only meaningful for the label it was painted on, so that label is selected first if needed.
+
+        Args:
+            edit (LabelEdit): Stored edit
+            values (np.array): Either edit.old or edit.new
+        """
+        if edit.label != self.current_label:
+            self.current_label = edit.label
+        self.label_data.flat[edit.index] = values
+
+    def undo_edit(self):
+        """Undo function
+
+        Reverts the labels to the previous stored edit.
+
+        Returns:
+            bool: True if there was something to undo
+        """
+        current = self.current_edit
+        if current <= 1:
+            return False
+        edit = self.edit_history[current - 1]
+        if isinstance(edit, LabelEdit):
+            self._apply_edit(edit, edit.old)
+        else:
+            self._restore_edit(current - 2)
+        self.current_edit = current - 1
+        return True
+
+    def redo_edit(self):
+        """Redo function
+
+        Re-applies a previously reverted edit.
+
+        Returns:
+            bool: True if there was something to redo
+        """
+        current = self.current_edit
+        if current >= len(self.edit_history):
+            return False
+        edit = self.edit_history[current]
+        if isinstance(edit, LabelEdit):
+            self._apply_edit(edit, edit.new)
+        else:
+            self._restore_copy(edit)
+        self.current_edit = current + 1
+        return True
+
+
+def select_label(label_data, other_labels_data, current_label, new_label):
+    """Splits labels for another label
+
+    Moves the label being edited back into the other labels, and takes the new one out of them.
+
+    Args:
+        label_data (np.array): Labels of the label being edited (1 where it is)
+        other_labels_data (np.array): Values of all the other labels
+        current_label (int): Label being edited
+        new_label (int): Label to be edited next
+
+    Returns:
+        tuple: New label_data and other_labels_data
+    """
+    label_data = np.clip(label_data, 0, 1)
+    other_minus_current = np.where(other_labels_data == current_label, 0, other_labels_data)
+    other_labels_data = np.where(label_data == 0, other_minus_current, current_label)
+    return np.where(other_labels_data == new_label, 1, 0), other_labels_data
+
+
+class LabelEdit:
+    """Painted edit of the labels.
+
+    Only the voxels changed by painting are stored, instead of copies of the whole volumes.
+
+    Args:
+        label (int): Label that was being edited
+        index (np.array): Flat indices of the changed voxels in label_data
+        old (np.array): Values before the edit
+        new (np.array): Values after the edit
+        box (np.array): Bounding box of the changed voxels, as [start, stop] for each axis
+    """
+
+    def __init__(self, label, index, old, new, box):
+        self.label = label
+        self.index = index
+        self.old = old
+        self.new = new
+        self.box = box
@@ -0,0 +1,198 @@
+"""Paint4Brains Segmentation Checkpoints
+
+This file contains the checkpoints that make long segmentations resumable.
+The predictions of every segmented slice are written to disk as soon as they are made, one file per axis, and the ranges of slices already segmented are saved regularly.
+When a segmentation of the same scan with the same models is started again (after being cancelled, or after a crash), the saved predictions are loaded and only the remaining slices are segmented.
+
+Attributes:
+    default_checkpoint_folder (str): Folder the checkpoints are stored in by default.
+
+Usage:
+    The checkpoints are used by the Segmenter when asked to:
+
+        from Paint4Brains.Segmenter import Segmenter
+
+        segmentation_operation = Segmenter(checkpoint=True)
+
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
+from Paint4Brains.DiskCache import default_cache_folder
+
+default_checkpoint_folder = os.path.join(default_cache_folder, "checkpoints")
+
+
+class Checkpoint:
+    """Checkpoint class for Paint4Brains.
+
+    Keeps the predictions of each slice of a segmentation in an .npy file per axis, cropped to the box containing the head, as float16 like the accumulator of the Segmenter.
+    Writing the prediction of a slice overwrites any previous one, so a slice segmented again after a crash is never counted twice.
+    The slices already segmented are listed in progress.json, which is only replaced once the predictions it refers to are on disk.
+    Pickling a Checkpoint (e.g. to send it to a worker process) only sends its folder and box.
+    An unpickled Checkpoint never creates the prediction files: they have to be created with prepare before the checkpoint is sent, so several workers never create the same file at once.
+
+    Args:
+        folder (str): Folder of this checkpoint, e.g. named after the key of the segmentation
+        box (tuple): Slices of the conformed volume containing the head, as returned by nonempty_box
+        slice_axes (dict): Transposition of the conformed volume which puts the slices of each orientation along the first axis
+        classes (int): Number of classes predicted by the models
+        interval (float): Seconds between saves of the progress. If None, progress is only saved when asked to.
+    """
+
+    def __init__(self, folder, box, slice_axes, classes=33, interval=60.):
+        self.folder = folder
+        self.box = tuple((int(part.start), int(part.stop)) for part in box)
+        self.slice_axes = slice_axes
+        self.classes = classes
+        self.interval = interval
+        self.done = {orientation: set() for orientation in slice_axes}
+        self._arrays = {}
+        self._saved = time.time()
+        self._create = True
+        progress = self._load_progress()
+        if progress is not None and [tuple(part) for part in progress["box"]] == list(self.box):
+            for orientation, ranges in progress["done"].items():
+                for start, stop in ranges:
+                    self.done[orientation].update(range(start, stop))
+
+    def __getstate__(self):
+        return {"folder": self.folder, "box": self.box, "slice_axes": self.slice_axes, "classes": self.classes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.interval = None
+        self.done = {orientation: set() for orientation in self.slice_axes}
+        self._arrays = {}
+        self._saved = time.time()
+        self._create = False
+
+    def _load_progress(self):
+        """Saved progress, or None if there is none (or it is unreadable)."""
+        try:
+            with open(os.path.join(self.folder, "progress.json")) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _crop(self, orientation):
+        """Slices selecting the box in a prediction of the given orientation (classes first)."""
+        axes = self.slice_axes[orientation]
+        return (slice(None), slice(*self.box[axes[1]]), slice(*self.box[axes[2]]))
+
+    def _array(self, orientation):
+        """Predictions of the given orientation, mapped from their file (created the first time, unless unpickled)."""
+        if orientation not in self._arrays:
+            axes = self.slice_axes[orientation]
+            shape = tuple([self.box[axes[0]][1] - self.box[axes[0]][0], self.classes] +
+                          [self.box[axis][1] - self.box[axis][0] for axis in axes[1:]])
+            path = os.path.join(self.folder, orientation + ".npy")
+            if os.path.exists(path):
+                array = np.load(path, mmap_mode="r+")
+                if array.shape == shape and array.dtype == np.half:
+                    self._arrays[orientation] = array
+                    return array
+                del array
+            if not self._create:
+                raise (Exception("The checkpoint predictions " + path + " have not been prepared"))
+            os.makedirs(self.folder, exist_ok=True)
+            self._arrays[orientation] = np.lib.format.open_memmap(path, mode="w+", dtype=np.half, shape=shape)
+        return self._arrays[orientation]
+
+    def prepare(self, orientations):
+        """Creates the prediction files of some orientations, before the checkpoint is sent to worker processes.
+
+        Args:
+            orientations (iterable): Strings indicating the orientations (COR and/or AXI)
+        """
+        for orientation in orientations:
+            self._array(orientation).flush()
+
+    def remaining(self, orientation):
+        """Slices of the box still to be segmented
+
+        Args:
+            orientation (str): String indicating the orientation of the slices (COR or AXI)
+
+        Returns:
+            list: Indices of the slices along the first axis of the orientation
+        """
+        start, stop = self.box[self.slice_axes[orientation][0]]
+        return [i for i in range(start, stop) if i not in self.done[orientation]]
+
+    def restore(self, orientation, predictions):
+        """Adds the saved predictions of the slices already segmented to an accumulator.
+
+        Args:
+            orientation (str): String indicating the orientation of the slices (COR or AXI)
+            predictions (np.array): View of the accumulator with the slices of the orientation along the first axis
+
+        Returns:
+            int: Number of slices restored
+        """
+        if not self.done[orientation]:
+            return 0
+        start = self.box[self.slice_axes[orientation][0]][0]
+        crop = self._crop(orientation)
+        array = self._array(orientation)
+        for i in sorted(self.done[orientation]):
+            predictions[i][crop] += array[i - start]
+        return len(self.done[orientation])
+
+    def record(self, orientation, index, prediction):
+        """Writes the prediction of a slice.
+
+        Args:
+            orientation (str): String indicating the orientation of the slices (COR or AXI)
+            index (int): Index of the slice
+            prediction (np.array): float16 scores of the slice, of shape (classes, width, height)
+        """
+        start = self.box[self.slice_axes[orientation][0]][0]
+        self._array(orientation)[index - start] = prediction[self._crop(orientation)]
+
+    def mark(self, orientation, indices):
+        """Marks slices as segmented, saving the progress if it was last saved longer than the interval ago.
+
+        Args:
+            orientation (str): String indicating the orientation of the slices (COR or AXI)
+            indices (iterable): Indices of the slices whose predictions have been recorded
+        """
+        self.done[orientation].update(int(i) for i in indices)
+        if self.interval is not None and time.time() - self._saved > self.interval:
+            self.save()
+
+    def save(self):
+        """Saves the progress, after making sure the predictions it refers to are on disk."""
+        for array in self._arrays.values():
+            array.flush()
+        done = {orientation: _ranges(indices) for orientation, indices in self.done.items()}
+        os.makedirs(self.folder, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(suffix=".json", dir=self.folder)
+        with os.fdopen(handle, "w") as file:
+            json.dump({"box": self.box, "done": done}, file)
+        os.replace(temporary, os.path.join(self.folder, "progress.json"))
+        self._saved = time.time()
+
+    def close(self):
+        """Releases the files of the checkpoint."""
+        self._arrays = {}
+
+    def remove(self):
+        """Deletes the checkpoint, once the segmentation it belongs to has finished."""
+        self.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def _ranges(indices):
+    """Sorted indices grouped into [start, stop) ranges of consecutive values."""
+    ranges = []
+    for i in sorted(indices):
+        if ranges and ranges[-1][1] == i:
+            ranges[-1][1] = i + 1
+        else:
+            ranges.append([i, i + 1])
+    return ranges
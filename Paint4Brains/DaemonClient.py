@@ -0,0 +1,220 @@
+"""Paint4Brains Segmentation Daemon Client
+
+This file contains a Segmenter which submits its segmentations (and brain extractions) to the local segmentation daemon.
+When no daemon is running, or the daemon runs on another device or with other models than asked for, it runs them in a worker process of its own instead, like a SegmentProcess.
+
+Usage:
+    It is used exactly like the Segmenter:
+
+        from Paint4Brains.DaemonClient import DaemonClient
+
+        segmentation_operation = DaemonClient()
+
+        labels = segmentation_operation.segment_array(volume, affine)
+
+"""
+
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import nibabel as nib
+import numpy as np
+from Paint4Brains.Segmenter import ProgressEvent
+from Paint4Brains.SegmentProcess import SegmentProcess
+from Paint4Brains.SegmentDaemon import default_address, pack_arrays, unpack_arrays
+
+
+class DaemonClient(SegmentProcess):
+    """DaemonClient class for Paint4Brains.
+
+    SegmentProcess whose jobs are run by the segmentation daemon when one is listening.
+    The progress and partial labels of a job are polled and passed on to the subscribers, and setting run to False cancels the job.
+    Every job is sent with the priority of this client and its device, backend, quantisation, checkpoint and confidence settings.
+    If the daemon can not be reached, or refuses the job because its models do not run on that device, backend or quantisation, the job runs in a worker process instead.
+
+    Args:
+        address (tuple): Host and port of the daemon
+        priority (int): Priority of the jobs submitted. Jobs with a lower priority run first.
+        poll_interval (float): Seconds between two requests for the progress of a job
+        timeout (float): Seconds to wait for an answer of the daemon
+        **settings: Arguments of the Segmenter, sent with the jobs and used when they run in a worker process
+    """
+
+    def __init__(self, address=default_address, priority=0, poll_interval=0.2, timeout=10., **settings):
+        super(DaemonClient, self).__init__(**settings)
+        self.url = "http://{}:{}".format(*address)
+        self.priority = priority
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def segment_array(self, volume, affine, mask=None):
+        """In Memory Segmentation by the daemon
+
+        Same as Segmenter.segment_array.
+
+        Args:
+            volume (np.array): 3-D scan to be segmented
+            affine (np.array): 4x4 affine of the scan
+            mask (np.array): Optional brain mask (e.g. from the Extractor) with the shape of the volume, non zero inside the brain
+
+        Returns:
+            labels (np.array): Labels with the shape and voxels of the volume
+        """
+        job = self._submit("segment", volume, affine, mask)
+        if job is None:
+            return super(DaemonClient, self).segment_array(volume, affine, mask)
+        return self._segmentation_result(job, volume, affine)
+
+    def segment_preview(self, volume, affine, mask=None, step=4):
+        """Preview Segmentation by the daemon
+
+        Same as Segmenter.segment_preview.
+
+        Args:
+            volume (np.array): 3-D scan to be segmented
+            affine (np.array): 4x4 affine of the scan
+            mask (np.array): Optional brain mask (e.g. from the Extractor) with the shape of the volume, non zero inside the brain
+            step (int): Number of coronal slices each segmented slice stands for
+
+        Returns:
+            labels (np.array): Approximate labels with the shape and voxels of the volume
+        """
+        job = self._submit("preview", volume, affine, mask, step)
+        if job is None:
+            return super(DaemonClient, self).segment_preview(volume, affine, mask, step)
+        return self._segmentation_result(job, volume, affine)
+
+    def extract(self, volume):
+        """Brain Extraction by the daemon
+
+        Same as Segmenter.extract.
+
+        Args:
+            volume (np.array): 3-D brain volume
+
+        Returns:
+            np.array: Probability of each voxel being brain tissue
+        """
+        job = self._submit("extract", volume)
+        if job is None:
+            return super(DaemonClient, self).extract(volume)
+        return self._follow(job)["mask"]
+
+    def _submit(self, kind, volume, affine=None, mask=None, step=4):
+        """Submits a job to the daemon.
+
+        Args:
+            kind (str): "segment", "preview" or "extract"
+            volume (np.array): 3-D scan
+            affine (np.array): 4x4 affine of the scan, not needed to extract
+            mask (np.array): Brain mask, or None
+            step (int): Step of a preview
+
+        Returns:
+            str: Id of the job, or None if the daemon can not be reached or can not run the job
+        """
+        arrays = {"volume": np.asanyarray(volume)}
+        if affine is not None:
+            arrays["affine"] = np.asarray(affine)
+        if mask is not None:
+            arrays["mask"] = np.asarray(mask) > 0
+        query = urllib.parse.urlencode({"kind": kind, "priority": self.priority, "step": step, "device": self.device,
+                                        "backend": self.backend, "quantised": int(bool(self.quantised)),
+                                        "checkpoint": int(bool(self.checkpoint)),
+                                        "confidence": int(bool(self.confidence))})
+        try:
+            return json.loads(self._request("POST", "/jobs?" + query, pack_arrays(arrays)))["id"]
+        except urllib.error.HTTPError as error:
+            if error.code == 409:
+                # The models of the daemon do not run on the device (or backend) asked for
+                return None
+            raise
+        except OSError:
+            # Nothing is listening, the job runs here instead
+            return None
+
+    def _segmentation_result(self, job, volume, affine):
+        """Follows a segmentation job and keeps its results like the Segmenter does.
+
+        Args:
+            job (str): Id of the job
+            volume (np.array): Scan segmented
+            affine (np.array): 4x4 affine of the scan
+
+        Returns:
+            labels (np.array): Labels with the shape and voxels of the volume
+        """
+        self.original = nib.Nifti1Image(np.asanyarray(volume), affine)
+        self.cache_metadata = None
+        self.confidence_map = None
+        result = self._follow(job)
+        if self.confidence:
+            self.confidence_map = result.get("confidence")
+        return result["labels"].astype(np.intp)
+
+    def _follow(self, job):
+        """Waits for a job, passing on its progress and partial labels, and removes it from the daemon once finished.
+
+        Args:
+            job (str): Id of the job
+
+        Returns:
+            dict: Arrays computed by the job
+        """
+        self._start(2 * 256)
+        self._report("Waiting for the segmentation daemon")
+        progress, version = None, 0
+        try:
+            while True:
+                if not self.run:
+                    self._request("DELETE", "/jobs/" + job)
+                    self._done = 0
+                    self._report("Not running")
+                    raise (Exception("Segmentation has been killed"))
+                status = json.loads(self._request("GET", "/jobs/" + job))
+                if status["progress"] is not None and status["progress"] != progress:
+                    progress = status["progress"]
+                    event = ProgressEvent(**progress)
+                    self.state, self.completion = event.stage, event.completion
+                    self._done, self._total = event.done, event.total
+                    for callback in list(self.subscribers):
+                        callback(event)
+                elif status["status"] == "queued" and status["ahead"]:
+                    self._report("Waiting for " + str(status["ahead"]) + " other jobs of the segmentation daemon")
+                if status["partial_version"] > version and self.label_subscribers:
+                    version = status["partial_version"]
+                    try:
+                        labels = unpack_arrays(self._request("GET", "/jobs/" + job + "/partial"))["labels"]
+                    except urllib.error.HTTPError:
+                        # The job finished in the meantime
+                        labels = None
+                    if labels is not None:
+                        for callback in list(self.label_subscribers):
+                            callback(labels)
+                if status["status"] == "done":
+                    return unpack_arrays(self._request("GET", "/jobs/" + job + "/result"))
+                if status["status"] in ("failed", "cancelled"):
+                    raise (Exception(status["error"] or "The segmentation job was " + status["status"]))
+                time.sleep(self.poll_interval)
+        finally:
+            try:
+                self._request("DELETE", "/jobs/" + job)
+            except OSError:
+                pass
+
+    def _request(self, method, path, body=None):
+        """Sends a request to the daemon.
+
+        Args:
+            method (str): HTTP method
+            path (str): Path of the request
+            body (bytes): Content of the request, if any
+
+        Returns:
+            bytes: Content of the answer
+        """
+        request = urllib.request.Request(self.url + path, data=body, method=method)
+        with urllib.request.urlopen(request, timeout=self.timeout) as answer:
+            return answer.read()
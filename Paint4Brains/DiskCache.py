@@ -0,0 +1,200 @@
+"""Paint4Brains Disk Cache
+
+This file contains a small content-addressed cache used to avoid redoing expensive work on data already seen.
+Entries are stored as compressed .npz files holding a few named arrays and a JSON dictionary of metadata, under a key derived from the content they were computed from.
+The cache is bounded in size: when it grows too large, the least recently used entries are removed first.
+
+Attributes:
+    default_cache_folder (str): Folder the caches of Paint4Brains are stored in by default.
+
+Usage:
+    To use this module, import it and instantiate is as you wish:
+
+        from Paint4Brains.DiskCache import DiskCache, hash_array
+
+        cache = DiskCache("results", max_size=2 ** 30)
+        key = hash_array(volume, affine)
+
+        entry = cache.get(key)
+        if entry is None:
+            cache.put(key, {"labels": labels}, {"elapsed": elapsed})
+        else:
+            arrays, metadata = entry
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+default_cache_folder = os.path.join(os.path.expanduser("~"), ".cache", "paint4brains")
+
+_file_hashes = {}
+
+
+def hash_array(*arrays):
+    """Content hash of arrays
+
+    The type and shape of every array are part of the hash, so equal bytes with a different layout give a different key.
+    None is accepted in place of an array (e.g. a missing mask).
+
+    Args:
+        *arrays (np.array): Arrays to be hashed
+
+    Returns:
+        str: Hexadecimal SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    for array in arrays:
+        if array is None:
+            digest.update(b"None;")
+            continue
+        array = np.ascontiguousarray(array)
+        digest.update("{}{};".format(array.dtype.str, array.shape).encode())
+        digest.update(array.view(np.uint8).reshape(-1).data)
+    return digest.hexdigest()
+
+
+def hash_file(path, block=2 ** 20):
+    """Content hash of a file
+
+    The hash of each file is remembered for as long as its size and modification time stay the same, so model checkpoints are only read once.
+
+    Args:
+        path (str): Path of the file
+        block (int): Number of bytes read at a time
+
+    Returns:
+        str: Hexadecimal SHA-256 digest
+    """
+    status = os.stat(path)
+    identity = (os.path.realpath(path), status.st_size, status.st_mtime)
+    if identity not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(block), b""):
+                digest.update(chunk)
+        _file_hashes[identity] = digest.hexdigest()
+    return _file_hashes[identity]
+
+
+def hash_strings(*strings):
+    """Hash combining several strings (e.g. other hashes and settings) into one key
+
+    Args:
+        *strings (str): Strings to be combined
+
+    Returns:
+        str: Hexadecimal SHA-256 digest
+    """
+    return hashlib.sha256(";".join(str(string) for string in strings).encode()).hexdigest()
+
+
+class DiskCache:
+    """DiskCache class for Paint4Brains.
+
+    Stores named arrays and their metadata under string keys, in a folder on disk.
+    Reading an entry marks it as recently used. Entries are written to a temporary file first and then renamed, so a crash never leaves half an entry behind.
+
+    Args:
+        name (str): Name of the cache, used as the name of its folder
+        max_size (int): Largest total size in bytes of the entries kept
+        folder (str): Folder the cache folder is created in. Defaults to default_cache_folder.
+    """
+
+    def __init__(self, name, max_size=2 ** 30, folder=None):
+        self.folder = os.path.join(folder if folder is not None else default_cache_folder, name)
+        self.max_size = max_size
+
+    def _path(self, key):
+        """Path of the file of an entry."""
+        return os.path.join(self.folder, key + ".npz")
+
+    def get(self, key):
+        """Cached entry
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            tuple: Dictionary of arrays and dictionary of metadata, or None if the entry is not cached (or unreadable)
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as stored:
+                arrays = {name: stored[name] for name in stored.files if name != "metadata"}
+                metadata = json.loads(str(stored["metadata"]))
+        except (OSError, ValueError, KeyError):
+            return None
+        # The modification time keeps track of when each entry was last used
+        os.utime(path, None)
+        return arrays, metadata
+
+    def put(self, key, arrays, metadata=None):
+        """Stores an entry, replacing any entry with the same key, then evicts old entries if the cache is too large.
+
+        Args:
+            key (str): Key of the entry
+            arrays (dict): Arrays to be stored, by name
+            metadata (dict): JSON serialisable information about the entry
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(suffix=".npz", dir=self.folder)
+        try:
+            with os.fdopen(handle, "wb") as file:
+                np.savez_compressed(file, metadata=np.array(json.dumps(metadata or {})), **arrays)
+            os.replace(temporary, self._path(key))
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self.evict()
+
+    def entries(self):
+        """Entries in the cache
+
+        Returns:
+            list: Path, size and last use time of every entry, least recently used first
+        """
+        if not os.path.isdir(self.folder):
+            return []
+        entries = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if not name.endswith(".npz") or name.startswith("tmp"):
+                continue
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, status.st_size, status.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size(self):
+        """Total size in bytes of the entries in the cache
+
+        Returns:
+            int: Size in bytes
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in its maximum size."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        """Removes every entry."""
+        for path, _, _ in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -45,7 +45,7 @@ class BonusBrush(QWidget):
         self.g_item = pg.GraphicsView()
         self.vbox = pg.ViewBox()
         self.pen = np.zeros((5, 5)).astype(np.int32)
-        self.img = pg.ImageItem(self.pen, autoDownSmaple=False)
+        self.img = pg.ImageItem(self.pen, autoDownsample=False)
         self.img.setLevels([-1, 1])
         self.img.setDrawKernel(self.kernel, mask=self.kernel, center=(0, 0), mode='add')
 
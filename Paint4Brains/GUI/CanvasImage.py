@@ -0,0 +1,45 @@
+"""Canvas Image Module
+
+This file contains the image item the brain is displayed on.
+It behaves like a pyqtgraph ImageItem, but drawing is handed over to the viewer instead of modifying the displayed array.
+This is needed because the displayed array is a coloured composite of the data and the labels, not the labels themselves.
+
+Usage:
+    To use this module, import it and instantiate is as you wish:
+
+        from Paint4Brains.GUI.CanvasImage import CanvasImage
+
+        img = CanvasImage()
+        img.painter = function_receiving_the_position_in_view_coordinates
+
+"""
+
+from pyqtgraph import ImageItem
+
+
+class CanvasImage(ImageItem):
+    """CanvasImage class for Paint4Brains.
+
+    ImageItem whose drawing kernel is applied by an external painter.
+    The kernel, its centre and mode are still set with setDrawKernel, so the mouse handling of pyqtgraph is kept as is.
+
+    Attributes:
+        painter (function): Called with the mouse position in view (voxel) coordinates every time the kernel should be applied.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CanvasImage, self).__init__(*args, **kwargs)
+        self.painter = None
+
+    def drawAt(self, pos, ev=None):
+        """Drawing event
+
+        Forwards the position of the drawing event to the painter.
+        The position is mapped out of the item, as the displayed image might be scaled and shifted.
+
+        Args:
+            pos (QPointF): Position of the event in item coordinates
+            ev: Mouse event which triggered the drawing
+        """
+        if self.painter is not None:
+            self.painter(self.mapToParent(pos))
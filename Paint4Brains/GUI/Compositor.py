@@ -0,0 +1,173 @@
+"""Slice Compositor Module
+
+This file contains a class which combines the brain image and the labels into a single coloured image.
+Rather than stacking several pyqtgraph images on top of each other, every displayed pixel is looked up in a table holding the final colour for each combination of label and intensity.
+
+Attributes:
+    colours (list): The first label colours. Labels beyond these get automatically generated colours.
+    edit_row (int): Row of the lookup table used for the label currently being edited.
+    uncertain_row (int): Row of the lookup table used for voxels the segmentation is unsure about.
+
+Usage:
+    To use this module, import it and instantiate is as you wish:
+
+        from Paint4Brains.GUI.Compositor import Compositor
+
+        compositor = Compositor()
+
+        rgba = compositor.composite(intensity_slice, labels_slice, edited_slice)
+
+    Voxels segmented with a low confidence can be highlighted too:
+
+        rgba = compositor.composite(intensity_slice, labels_slice, edited_slice, confidence_slice < 128)
+
+"""
+
+import colorsys
+import numpy as np
+
+# Maybe the visualization lecture was not that useless...
+colours = [[166, 206, 27],
+           [31, 120, 180],
+           [178, 223, 138],
+           [51, 160, 44],
+           [251, 154, 153],
+           [227, 26, 28],
+           [253, 191, 111],
+           [255, 127, 0],
+           [202, 178, 214],
+           [106, 61, 154],
+           [255, 255, 153],
+           [177, 89, 40]
+           ]
+
+edit_row = 256
+
+uncertain_row = 257
+
+
+def label_colours(number=256):
+    """Label colour generator
+
+    Returns one colour per label value. Label 0 is the background and has no colour.
+    After the predefined colours, new ones are generated by stepping around the hue circle by the golden angle.
+    This keeps neighbouring label values far apart in colour, so every structure can be told apart.
+
+    Args:
+        number (int): Number of label values that need a colour
+
+    Returns:
+        np.array: Array of shape (number, 3) with RGB values for each label
+    """
+    table = np.zeros((number, 3))
+    for label in range(1, number):
+        if label <= len(colours):
+            table[label] = colours[label - 1]
+        else:
+            hue = (label * 0.618033988749895) % 1
+            saturation = 0.55 + 0.45 * ((label // 3) % 2)
+            value = 0.75 + 0.25 * (label % 2)
+            table[label] = np.array(colorsys.hsv_to_rgb(hue, saturation, value)) * 255
+    return table
+
+
+class Compositor:
+    """Compositor class for Paint4Brains.
+
+    Maps a uint8 intensity slice and an integer label slice to a single RGBA image in one pass.
+    The lookup table has one row per label value (plus one for the label being edited and one for uncertain voxels) and one column per intensity.
+    Labels are added on top of the grey value, like the Plus composition mode used to do.
+    The table is only rebuilt when the intensity correction or the opacities change, and the output arrays are reused between frames.
+
+    Args:
+        edit_colour (list): RGB colour of the label currently being edited
+        uncertain_colour (list): RGB colour of the voxels the segmentation is unsure about
+    """
+
+    def __init__(self, edit_colour=(250, 0, 0), uncertain_colour=(255, 0, 255)):
+        self.edit_colour = np.array(edit_colour, dtype=float)
+        self.uncertain_colour = np.array(uncertain_colour, dtype=float)
+        self.colours = label_colours()
+        self.opacity = 0.7
+        self.edit_opacity = 1.0
+        self._intensity = None
+        self._lut = None
+        self._index = None
+        self._output = None
+
+    def set_intensity(self, intensity, scale):
+        """Intensity correction setter
+
+        The intensity correction is folded into the lookup table, so it is only recomputed when it changes.
+
+        Args:
+            intensity (float): Multiplier applied after the logarithmic correction
+            scale (float): Maximum value allowed after the correction
+        """
+        if self._intensity != (intensity, scale):
+            self._intensity = (intensity, scale)
+            self._lut = None
+
+    def set_opacity(self, opacity):
+        """Label opacity setter
+
+        Args:
+            opacity (float): Opacity of all labels, between 0 and 1
+        """
+        self.opacity = opacity
+        self.edit_opacity = opacity
+        self._lut = None
+
+    def _build_lut(self):
+        """Builds the lookup table for the current settings.
+
+        Returns:
+            np.array: Flattened uint32 table holding packed RGBA colours
+        """
+        intensity, scale = self._intensity if self._intensity is not None else (1.0, 1.0)
+        values = np.arange(256) / 255.
+        grey = np.clip(np.clip(np.log2(1 + values) * intensity, 0, scale), 0, 1) * 255
+
+        added = np.zeros((uncertain_row + 1, 3))
+        added[:edit_row] = self.colours * self.opacity
+        added[edit_row] = self.edit_colour * self.edit_opacity
+        added[uncertain_row] = self.uncertain_colour * self.opacity
+
+        lut = np.full((uncertain_row + 1, 256, 4), 255, dtype=np.uint8)
+        lut[:, :, :3] = np.rint(np.clip(grey[np.newaxis, :, np.newaxis] + added[:, np.newaxis, :], 0, 255))
+        return lut.view(np.uint32).reshape(-1)
+
+    def composite(self, intensity, labels, edited=None, uncertain=None):
+        """Composites one slice
+
+        Uncertain voxels are drawn over the background labels, but under the label being edited.
+
+        Args:
+            intensity (np.array): 2D uint8 slice of the brain image
+            labels (np.array): 2D slice of the background labels, or None to hide them
+            edited (np.array): 2D slice of the label being edited (non zero where labelled), or None
+            uncertain (np.array): 2D boolean slice, True where the segmentation is unsure, or None
+
+        Returns:
+            np.array: 2D RGBA image of shape intensity.shape + (4,). This array is overwritten by the next call.
+        """
+        if self._lut is None:
+            self._lut = self._build_lut()
+        if self._output is None or self._output.shape != intensity.shape:
+            self._output = np.empty(intensity.shape, dtype=np.uint32)
+            self._index = np.empty(intensity.shape, dtype=np.intp)
+
+        index = self._index
+        if labels is None:
+            index.fill(0)
+        else:
+            np.copyto(index, labels, casting="unsafe")
+            np.clip(index, 0, edit_row - 1, out=index)
+        if uncertain is not None:
+            np.putmask(index, uncertain, uncertain_row)
+        if edited is not None:
+            np.putmask(index, edited > 0, edit_row)
+        index *= 256
+        index += intensity
+        np.take(self._lut, index, out=self._output)
+        return self._output.view(np.uint8).reshape(intensity.shape + (4,))
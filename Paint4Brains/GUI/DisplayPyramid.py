@@ -0,0 +1,197 @@
+"""Display Pyramid Module
+
+This file contains a class which provides downsampled versions of the brain volumes for displaying zoomed out views.
+High resolution scans have far more voxels than there are pixels on the screen when the whole slice is visible.
+Instead of handing the full resolution slices to pyqtgraph, the ImageViewer asks this class for the level that best matches the current zoom.
+
+Usage:
+    To use this module, import it and instantiate is as you wish:
+
+        from Paint4Brains.GUI.DisplayPyramid import DisplayPyramid
+
+        pyramid = DisplayPyramid(brain)
+
+"""
+
+import numpy as np
+from PyQt5.QtCore import QRectF
+
+# Which of the two display axes are flipped by BrainData.get_volume_slice for each section
+flipped_axes = {0: (False, False), 1: (True, True), 2: (False, True)}
+
+
+class DisplayPyramid:
+    """DisplayPyramid class for Paint4Brains.
+
+    Lazily built multi-resolution pyramid of the brain data and labels.
+    The intensity data is stored as uint8 (the full resolution level included) and downsampled by averaging blocks of voxels. The levels are only computed when first requested and are rebuilt if the data array is replaced.
+    Labels can not be averaged, so they are subsampled with strided views instead. These never need rebuilding and always reflect the latest edits.
+
+    Args:
+        brain (class): BrainData class for Paint4Brains
+        factors (tuple): Downsampling factors available. The first one should always be 1 (full resolution).
+    """
+
+    def __init__(self, brain, factors=(1, 2, 4)):
+        self.brain = brain
+        self.factors = factors
+        self._source = None
+        self._levels = {}
+
+    def factor_for(self, voxels_per_pixel):
+        """Pyramid level selection
+
+        Returns the largest downsampling factor that does not drop below one voxel per screen pixel.
+        Full resolution is therefore only used once the user has zoomed in.
+
+        Args:
+            voxels_per_pixel (float): Number of voxels covered by a single screen pixel.
+
+        Returns:
+            int: Downsampling factor to be used
+        """
+        chosen = self.factors[0]
+        for factor in self.factors:
+            if factor <= voxels_per_pixel:
+                chosen = factor
+        return chosen
+
+    def data_volume(self, factor):
+        """Downsampled intensity data
+
+        Returns the intensity data, scaled to uint8 and downsampled by the given factor.
+        Each level is built from the previous one the first time it is needed.
+
+        Args:
+            factor (int): Downsampling factor
+
+        Returns:
+            np.array: 3D uint8 array of downsampled intensity data
+        """
+        if self._source is not self.brain.data:
+            self._source = self.brain.data
+            self._levels = {1: _to_uint8(self.brain.data)}
+        if factor not in self._levels:
+            previous = self.data_volume(factor // 2)
+            self._levels[factor] = _halve(previous)
+        return self._levels[factor]
+
+    @staticmethod
+    def label_volume(volume, factor):
+        """Subsampled labels
+
+        Returns a strided view of a label volume. No data is copied.
+
+        Args:
+            volume (np.array): 3D label array
+            factor (int): Downsampling factor
+
+        Returns:
+            np.array: 3D view of the labels with every factor-th voxel along each axis
+        """
+        return volume[::factor, ::factor, ::factor]
+
+    def slice_rect(self, factor):
+        """Displayed rectangle of a downsampled slice
+
+        Returns where a slice of the given level has to be drawn so that it lines up with the full resolution voxel coordinates.
+        Both the flips done by BrainData and the padding of odd sized volumes are taken into account.
+
+        Args:
+            factor (int): Downsampling factor
+
+        Returns:
+            QRectF: Rectangle in voxel coordinates covered by the downsampled slice
+        """
+        full = self.brain.get_volume_slice(self.brain.data, self.brain.i).shape
+        small = [-(-n // factor) for n in full]
+        flips = flipped_axes[self.brain.section]
+        x0 = full[0] - small[0] * factor if flips[0] else 0
+        y0 = full[1] - small[1] * factor if flips[1] else 0
+        return QRectF(x0, y0, small[0] * factor, small[1] * factor)
+
+    def window(self, factor, region=None):
+        """Part of a slice covering a region
+
+        Finds which pixels of the downsampled slice are needed to cover a region of the view.
+        The returned rectangle is aligned to the pixels of the level, so it is where the cropped slice has to be drawn.
+
+        Args:
+            factor (int): Downsampling factor
+            region (QRectF): Region in voxel coordinates to be covered. If None, the whole slice is used.
+
+        Returns:
+            tuple: Index (tuple of two slices) selecting the pixels, and the QRectF they cover
+        """
+        rect = self.slice_rect(factor)
+        width, height = int(rect.width()) // factor, int(rect.height()) // factor
+        if region is None:
+            return (slice(0, width), slice(0, height)), rect
+        x0 = int(np.clip(np.floor((region.left() - rect.x()) / factor), 0, width - 1))
+        x1 = int(np.clip(np.ceil((region.right() - rect.x()) / factor), x0 + 1, width))
+        y0 = int(np.clip(np.floor((region.top() - rect.y()) / factor), 0, height - 1))
+        y1 = int(np.clip(np.ceil((region.bottom() - rect.y()) / factor), y0 + 1, height))
+        covered = QRectF(rect.x() + x0 * factor, rect.y() + y0 * factor, (x1 - x0) * factor, (y1 - y0) * factor)
+        return (slice(x0, x1), slice(y0, y1)), covered
+
+    def data_slice(self, factor):
+        """Current data slice at a given level
+
+        Args:
+            factor (int): Downsampling factor
+
+        Returns:
+            np.array: 2D uint8 downsampled slice of the data at the current position
+        """
+        return self.brain.get_volume_slice(self.data_volume(factor), self.brain.i // factor)
+
+    def label_slice(self, volume, factor):
+        """Current label slice at a given level
+
+        Args:
+            volume (np.array): 3D label array
+            factor (int): Downsampling factor
+
+        Returns:
+            np.array: 2D subsampled slice of the labels at the current position
+        """
+        return self.brain.get_volume_slice(self.label_volume(volume, factor), self.brain.i // factor)
+
+
+def _to_uint8(volume, slab=16):
+    """Scales a volume with values between 0 and 1 to uint8.
+
+    It is done a few slices at a time to avoid several full size temporary arrays.
+
+    Args:
+        volume (np.array): 3D array to be converted
+        slab (int): Number of slices converted at once
+
+    Returns:
+        np.array: 3D uint8 array
+    """
+    converted = np.empty(volume.shape, dtype=np.uint8)
+    for start in range(0, volume.shape[0], slab):
+        part = np.clip(volume[start:start + slab], 0, 1) * 255
+        np.rint(part, out=part)
+        converted[start:start + slab] = part
+    return converted
+
+
+def _halve(volume):
+    """Halves the resolution of a volume by averaging blocks of 2x2x2 voxels.
+
+    Volumes with odd dimensions are padded by repeating the last voxel.
+
+    Args:
+        volume (np.array): 3D array to be downsampled
+
+    Returns:
+        np.array: 3D uint8 array with half the size along each axis
+    """
+    padding = [(0, n % 2) for n in volume.shape]
+    if any(pad[1] for pad in padding):
+        volume = np.pad(volume, padding, mode="edge")
+    x, y, z = [n // 2 for n in volume.shape]
+    blocks = volume.reshape(x, 2, y, 2, z, 2).mean(axis=(1, 3, 5), dtype=np.float32)
+    return np.rint(blocks).astype(np.uint8)
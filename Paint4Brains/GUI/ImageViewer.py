@@ -19,9 +19,11 @@ Usage:
 from Paint4Brains.GUI.SelectLabel import SelectLabel
 from Paint4Brains.GUI.ModViewBox import ModViewBox
 from Paint4Brains.GUI.BonusBrush import BonusBrush
-from pyqtgraph import ImageItem, GraphicsView
+from Paint4Brains.GUI.DisplayPyramid import DisplayPyramid
+from Paint4Brains.GUI.Compositor import Compositor
+from Paint4Brains.GUI.CanvasImage import CanvasImage
+from pyqtgraph import GraphicsView
 from PyQt5.QtCore import Qt
-from PyQt5 import QtGui
 import numpy as np
 
 cross = np.array([
@@ -56,73 +58,78 @@ class ImageViewer(GraphicsView):
         self.view = ModViewBox()
         self.setCentralItem(self.view)
 
-        # Making Images out of data
-        self.over_img = ImageItem(self.brain.current_label_data_slice, autoDownSmaple=False, opacity=1,
-                                  compositionMode=QtGui.QPainter.CompositionMode_Plus)
-        self.mid_img = ImageItem(np.zeros(self.brain.current_other_labels_data_slice.shape), autoDownSmaple=False,
-                                 opacity=0.7,
-                                 compositionMode=QtGui.QPainter.CompositionMode_Plus)
-        self.img = ImageItem(self.brain.current_data_slice, autoDownsample=False,
-                             compositionMode=QtGui.QPainter.CompositionMode_SourceOver, levels=(0., 1.))
-
-        # Colouring the labelled data
-        lut = np.array([[0, 0, 0, 0], [250, 0, 0, 255]])
-        self.over_img.setLookupTable(lut)
-        self.over_img.setLevels([0, 1])
-
-        # Maybe the visualization lecture was not that useless...
-        self.colours = [[166, 206, 27],
-                        [31, 120, 180],
-                        [178, 223, 138],
-                        [51, 160, 44],
-                        [251, 154, 153],
-                        [227, 26, 28],
-                        [253, 191, 111],
-                        [255, 127, 0],
-                        [202, 178, 214],
-                        [106, 61, 154],
-                        [255, 255, 153],
-                        [177, 89, 40]
-                        ]
-
-        self.update_colormap()
-
-        # Adding the images to the viewing box and setting it to drawing mode (if there is labeled data)
+        # Downsampled versions of the data shown when zoomed out
+        self.pyramid = DisplayPyramid(self.brain)
+        self.factor = 1
+        # Part of the slice currently rendered (in voxel coordinates)
+        self.rendered = None
+
+        # Making a single image out of the data and the labels
+        self.compositor = Compositor()
+        self.img = CanvasImage(autoDownsample=False)
+        self.img.painter = self.draw
+
+        # Adding the image to the viewing box and setting it to drawing mode (if there is labeled data)
         self.view.addItem(self.img)
-        self.view.addItem(self.mid_img)
-        self.view.addItem(self.over_img)
 
         self.select_mode = False
         self.see_all_labels = False
+        # Voxels whose most likely label has a lower (quantised) probability are highlighted
+        self.see_uncertainty = False
+        self.confidence_threshold = 128
 
         if self.brain.label_filename is not None:
             self.enable_drawing()
             self.update_colormap()
-            self.refresh_image()
+        self.refresh_image()
 
         self.dropbox = SelectLabel(self)
         self.bonus = BonusBrush()
         self.bonus.buttn.clicked.connect(self.new_brush)
 
+        # Rendering what has become visible or switching resolution when the view changes
+        self.view.sigRangeChanged.connect(self.view_changed)
+
     def refresh_image(self):
         """Image Refresher
 
-        Sets the images displayed by the Image viewer to the current data slices.
+        Sets the image displayed by the Image viewer to the current data slices.
         It will only show all the labels if the self.see_all_labels parameters is True.
+        If self.see_uncertainty is True and the brain has a confidence map, the voxels segmented with a low confidence are highlighted.
+        The data and the labels are taken from the pyramid level matching the current zoom and composited into one RGBA image.
+        Only the visible part of the slice (plus a margin) is rendered, which makes a big difference when zoomed in.
         """
-        #Creating slice copy
-        slice = self.brain.current_data_slice
-        new_slice = np.clip(np.log2(1 + slice.astype(float)) * self.brain.intensity, 0, self.brain.scale)
-        self.img.setImage(new_slice, levels=(0., 1.))
-
-        self.over_img.setImage(
-            self.brain.current_label_data_slice, autoLevels=False)
+        self.factor = self.pyramid.factor_for(self.view.voxels_per_pixel())
+        self.compositor.set_intensity(self.brain.intensity, self.brain.scale)
+        self.view.full_bounds = self.pyramid.slice_rect(1)
+        window, self.rendered = self.pyramid.window(self.factor, self.view.visible_region())
+
+        intensity = self.pyramid.data_slice(self.factor)[window]
+        edited = self.pyramid.label_slice(self.brain.label_data, self.factor)[window]
+        labels = None
         if self.see_all_labels:
-            self.mid_img.setImage(
-                self.brain.current_other_labels_data_slice, autoLevels=False)
-        else:
-            self.mid_img.setImage(
-                np.zeros(self.brain.current_other_labels_data_slice.shape), autoLevels=False)
+            labels = self.pyramid.label_slice(self.brain.other_labels_data, self.factor)[window]
+        uncertain = None
+        if self.see_uncertainty and self.brain.confidence is not None:
+            # Only the displayed slice of the confidence map is read
+            confidence = self.pyramid.label_slice(self.brain.confidence["first_confidence"], self.factor)[window]
+            uncertain = confidence < self.confidence_threshold
+
+        self.img.setImage(self.compositor.composite(intensity, labels, edited, uncertain), autoLevels=False)
+        self.img.setRect(self.rendered)
+
+    def view_changed(self):
+        """View tracker
+
+        Refreshes the image when the view has moved outside of the rendered region, or when zooming in or out changes the pyramid level that should be displayed.
+        Any other pan or zoom does not require any new data.
+        """
+        if self.pyramid.factor_for(self.view.voxels_per_pixel()) != self.factor:
+            self.refresh_image()
+            return
+        needed = self.view.viewRect().intersected(self.view.full_bounds)
+        if not needed.isEmpty() and not self.rendered.contains(needed):
+            self.refresh_image()
 
     def recenter(self):
         """Brain Recenter 
@@ -135,29 +142,43 @@ class ImageViewer(GraphicsView):
     def update_colormap(self):
         """Label Colormap Update
 
-        Updates the colormap to account for the current number of distinct labels.
-        There are only 12 distinct colours (not including the "invisible" colour)
+        Updates the image after the labels have changed.
+        Every label value has its own colour in the compositor, so nothing depends on the number of distinct labels anymore.
         """
-        num = len(self.brain.different_labels) + 1
-        self.mid_img.setLookupTable(
-            np.array([[0, 0, 0]] + int(num / len(self.colours) + 1) * self.colours)[:num])
-        self.mid_img.setLevels([0, np.max(self.brain.different_labels)])
+        self.refresh_image()
 
     def enable_drawing(self):
         """Activates drawing mode
 
         The default pen is a voxel in size.
         """
-        self.over_img.setDrawKernel(dot, mask=dot, center=(0, 0), mode='add')
+        self.img.setDrawKernel(dot, mask=dot, center=(0, 0), mode='add')
         self.view.drawing = True
 
+    def draw(self, pos):
+        """Applies the drawing kernel
+
+        Adds the current kernel to the label being edited around the given position and updates the image.
+        The stroke is written directly into the 3-D labels by BrainData, which also keeps track of the region that changed.
+
+        Args:
+            pos (QPointF): Position of the kernel in view (voxel) coordinates
+        """
+        kernel = self.img.drawKernel
+        if kernel is None:
+            return
+        center = self.img.drawKernelCenter
+        kx, ky = np.nonzero(kernel)
+        self.brain.paint(int(pos.x()) - center[0] + kx, int(pos.y()) - center[1] + ky, kernel[kx, ky])
+        self.refresh_image()
+
     def disable_drawing(self):
         """Deactivates drawing mode
 
         It does this by deactivating the drawing kernel and setting the value of the drawing parameter in the modified view box to False.
         """
         if self.view.drawing:
-            self.over_img.drawKernel = None
+            self.img.drawKernel = None
             self.view.drawing = False
             self.view.state["mouseMode"] = 3
         else:
@@ -170,7 +191,7 @@ class ImageViewer(GraphicsView):
         For all the editing buttons the matrix used to edit is defined at the top of the file
         """
         self.view.drawing = True
-        self.over_img.setDrawKernel(dot, mask=dot, center=(0, 0), mode='add')
+        self.img.setDrawKernel(dot, mask=dot, center=(0, 0), mode='add')
 
     def edit_button2(self):
         """Sets the drawing mode to RUBBER
@@ -180,7 +201,7 @@ class ImageViewer(GraphicsView):
         Removes the label from voxels.
         """
         self.view.drawing = True
-        self.over_img.setDrawKernel(
+        self.img.setDrawKernel(
             rubber, mask=rubber, center=(0, 0), mode='add')
 
     def edit_button3(self):
@@ -190,7 +211,7 @@ class ImageViewer(GraphicsView):
         For all the editing buttons the matrix used to edit is defined at the top of the file
         """
         self.view.drawing = True
-        self.over_img.setDrawKernel(
+        self.img.setDrawKernel(
             cross, mask=cross, center=(1, 1), mode='add')
 
     def bonus_brush(self):
@@ -208,7 +229,7 @@ class ImageViewer(GraphicsView):
         """
         self.enable_drawing()
         cent = len(self.bonus.pen)//2
-        self.over_img.setDrawKernel(
+        self.img.setDrawKernel(
             self.bonus.pen, mask=self.bonus.pen, center=(cent, cent), mode='add')
 
     def select_label(self):
@@ -219,7 +240,7 @@ class ImageViewer(GraphicsView):
         The bulk of the implementation for this method is in the modified mouseReleasEevent method
         """
         if self.brain.multiple_labels:
-            self.over_img.drawKernel = None
+            self.img.drawKernel = None
             self.select_mode = True
 
     def view_back_labels(self):
@@ -232,6 +253,18 @@ class ImageViewer(GraphicsView):
         self.see_all_labels = not self.see_all_labels
         self.refresh_image()
 
+    def view_uncertainty(self):
+        """Toggle low confidence overlay.
+
+        Switch that determines whether the voxels the segmentation is unsure about are highlighted.
+        It only has an effect once a confidence map has been computed or loaded.
+        Confidence maps are only computed by the segmentations run after it has been switched on.
+        """
+        self.see_uncertainty = not self.see_uncertainty
+        if self.see_uncertainty:
+            self.brain.keep_confidence = True
+        self.refresh_image()
+
     def next_label(self):
         """Label forward scroll
 
@@ -269,12 +302,9 @@ class ImageViewer(GraphicsView):
 
         This function reverts the previous user action and refreshes the image.
         """
-        current = self.brain.current_edit
-        if current > 1:
-            self.brain.label_data = self.brain.edit_history[current - 2][0]
-            self.brain.other_labels_data = self.brain.edit_history[current - 2][1]
-            self.brain.current_edit = self.brain.current_edit - 1
+        if self.brain.undo_edit():
             self.refresh_image()
+            self.dropbox.update_box()
 
     def redo_previous_edit(self):
         """Redo function
@@ -282,28 +312,25 @@ class ImageViewer(GraphicsView):
         This function re-does a previously reverted actions.
         """
 
-        current = self.brain.current_edit
-        if current < len(self.brain.edit_history):
-            self.brain.label_data = self.brain.edit_history[current][0]
-            self.brain.other_labels_data = self.brain.edit_history[current][1]
-            self.brain.current_edit = self.brain.current_edit + 1
+        if self.brain.redo_edit():
             self.refresh_image()
+            self.dropbox.update_box()
 
     def mouseReleaseEvent(self, ev):
         """Mouse event tracker
 
         This function keeps track of the actions performed by the mouse, while taking the selcted mode into account.
         If when select_mode is activated, the left button is released on a previously labeled area, then the pen is set to that label. Otherwise, everything should work as normal (the default)
-        Now when you release the left button it assumes an edit has been made and stores it into the BrainData.
+        Now when you release the left button, any voxels painted during the stroke are stored as an edit in the BrainData.
 
         Args:
             ev: signal emitted when user releases a mouse button.
         """
         if self.select_mode:
             if ev.button() == Qt.LeftButton:
-                pos = ev.pos()
-                mouse_x = int(self.img.mapFromScene(pos).x())
-                mouse_y = int(self.img.mapFromScene(pos).y())
+                pos = self.view.mapSceneToView(ev.pos())
+                mouse_x = int(pos.x())
+                mouse_y = int(pos.y())
                 location = self.brain.position_as_voxel(mouse_x, mouse_y)
                 within = 0 < location[0] < self.brain.shape[0] and 0 < location[1] < self.brain.shape[1] and 0 < \
                     location[2] < self.brain.shape[2]
@@ -316,7 +343,7 @@ class ImageViewer(GraphicsView):
                         self.enable_drawing()
                         self.dropbox.update_box()
         super(ImageViewer, self).mouseReleaseEvent(ev)
-        if self.view.drawing and ev.button() == Qt.LeftButton:
+        if self.view.drawing and ev.button() == Qt.LeftButton and self.brain.dirty_box is not None:
             self.brain.store_edit()
 
     def wheelEvent(self, ev):
@@ -11,12 +11,13 @@ Usage:
 
 """
 
-from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QWidget, QSizePolicy, QSpacerItem, QLabel
+from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QWidget, QSizePolicy, QSpacerItem, QLabel, QErrorMessage
 from PyQt5 import QtCore
 from Paint4Brains.GUI.PlaneSelectionButtons import PlaneSelectionButtons
 from Paint4Brains.GUI.ImageViewer import ImageViewer
 from Paint4Brains.GUI.MultipleViews import MultipleViews
 from Paint4Brains.GUI.Slider import Slider
+from Paint4Brains.GUI.SegmentManager import ExtractThread
 
 
 class MainWidget(QWidget):
@@ -77,8 +78,9 @@ class MainWidget(QWidget):
         Args:
             pos (class): QPointF class defining a point in the plane using floating point precision
         """
-        mouse_x = int(self.win.img.mapFromScene(pos).x())
-        mouse_y = int(self.win.img.mapFromScene(pos).y())
+        pos = self.win.view.mapSceneToView(pos)
+        mouse_x = int(pos.x())
+        mouse_y = int(pos.y())
         self.position.setText(
             str(self.brain.position_as_voxel(mouse_x, mouse_y)))
 
@@ -154,9 +156,23 @@ class MainWidget(QWidget):
 
         Functionality for this method is defined in the BrainData class.
         This wrapper has been kept here to ensure the displayed image is updated.
+        The extraction runs in the segmentation daemon or a worker process, and the image is refreshed once it has finished.
         """
-        self.brain.extract()
-        self.win.refresh_image()
+        self.extract_thread = ExtractThread(self.brain)
+        self.extract_thread.end_signal.connect(self.win.refresh_image)
+        self.extract_thread.error_signal.connect(self.extraction_error)
+        self.extract_thread.start()
+
+    def extraction_error(self, error):
+        """Extraction error prompt
+
+        Args:
+            error (str): Error raised during extraction
+        """
+        msg = QErrorMessage()
+        msg.setWindowTitle("Error while running extraction.")
+        msg.showMessage("ERROR:\n" + error)
+        msg.exec()
 
     def full_brain(self):
         """Returns the image to the original brain and head image
@@ -63,6 +63,11 @@ class MainWindow(QMainWindow):
         loadAction.triggered.connect(self.load)
         self.file.addAction(loadAction)
 
+        loadConfidenceAction = QAction('Load Confidence', self)
+        loadConfidenceAction.setStatusTip('Load the confidence map of a segmentation')
+        loadConfidenceAction.triggered.connect(self.load_confidence)
+        self.file.addAction(loadConfidenceAction)
+
         saveAction = QAction('Save', self)
         saveAction.setStatusTip('Save Labels')
         saveAction.triggered.connect(self.save)
@@ -113,6 +118,11 @@ class MainWindow(QMainWindow):
         seeAllAction.triggered.connect(self.main_widget.win.view_back_labels)
         self.view_menu.addAction(seeAllAction)
 
+        uncertaintyAction = QAction('Low Confidence', self)
+        uncertaintyAction.setStatusTip('Highlight the voxels the segmentation is unsure about (computed by the next segmentation)')
+        uncertaintyAction.triggered.connect(self.main_widget.win.view_uncertainty)
+        self.view_menu.addAction(uncertaintyAction)
+
 
         nextLabelAction = QAction('Next Label', self)
         nextLabelAction.setShortcut('Ctrl+N')
@@ -280,6 +290,22 @@ class MainWindow(QMainWindow):
         self.main_widget.win.update_colormap()
         self.main_widget.win.refresh_image()
 
+    def load_confidence(self):
+        """Confidence map loader.
+
+        Opens a loading window through which you can select the confidence map of a segmentation (<scan>_confidence.npy).
+        Once a file is loaded the low confidence voxels are highlighted.
+        """
+        filename = QFileDialog.getOpenFileName(self, "Load confidence map", os.path.dirname(self.brain.filename),
+                                               "Confidence Files (*.npy)")
+        if isinstance(filename, tuple):
+            filename = filename[0]
+        if filename == '':
+            return
+        self.brain.load_confidence(filename)
+        self.main_widget.win.see_uncertainty = True
+        self.main_widget.win.refresh_image()
+
     def save_as(self):
         """Labelled data saver with a new name
 
@@ -33,6 +33,57 @@ class ModViewBox(ViewBox):
         self.drawing = False
         self.state['mouseMode'] = 3
         self.setAspectLocked(True)
+        # Extent of the whole image, which might be larger than what is currently rendered
+        self.full_bounds = None
+
+    def voxels_per_pixel(self):
+        """Current zoom level
+
+        Returns how many voxels fit along a single screen pixel with the current zoom.
+        Values above one mean the user is zoomed out and the image could be shown at a lower resolution.
+        Before the view has been laid out on screen there is no meaningful value, so one is returned.
+
+        Returns:
+            float: Number of voxels per screen pixel
+        """
+        if self.width() <= 0 or self.height() <= 0:
+            return 1.
+        size = min(self.viewPixelSize())
+        if not np.isfinite(size) or size <= 0:
+            return 1.
+        return size
+
+    def visible_region(self, margin=0.25):
+        """Visible part of the view
+
+        Returns the rectangle currently visible, grown on every side by a fraction of its size.
+        The extra margin means small pans do not require anything new to be rendered.
+
+        Args:
+            margin (float): Fraction of the width and height added on each side
+
+        Returns:
+            QRectF: Region in view coordinates, or None if the view has not been laid out yet
+        """
+        if self.width() <= 0 or self.height() <= 0:
+            return None
+        rect = self.viewRect()
+        dx, dy = rect.width() * margin, rect.height() * margin
+        return rect.adjusted(-dx, -dy, dx, dy)
+
+    def childrenBounds(self, frac=None, orthoRange=(None, None), items=None):
+        """Bounds of the displayed items
+
+        Overwritten so that auto ranging (e.g. recentering) always uses the whole image.
+        Only part of the image might be rendered, in which case the bounds of the image item would be too small.
+
+        Returns:
+            list: [[xmin, xmax], [ymin, ymax]] in view coordinates
+        """
+        if self.full_bounds is None:
+            return super(ModViewBox, self).childrenBounds(frac=frac, orthoRange=orthoRange, items=items)
+        rect = self.full_bounds
+        return [[rect.left(), rect.right()], [rect.top(), rect.bottom()]]
 
     def mouseDragEvent(self, ev, axis=None):
         """Mouse drag tracker
@@ -72,8 +72,7 @@ class OptionalSliders(QWidget):
 
         Function which controls the slider setting the transparency of the labels.
         """
-        self.win.mid_img.setOpacity(self.first_slider.value() / 100)
-        self.win.over_img.setOpacity(self.first_slider.value() / 100)
+        self.win.compositor.set_opacity(self.first_slider.value() / 100)
         self.win.refresh_image()
 
     def extraction_probability(self):
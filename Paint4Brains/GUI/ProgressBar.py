@@ -1,24 +1,35 @@
-from PyQt5.QtWidgets import QProgressBar, QLabel, QWidget, QVBoxLayout, QPushButton
-from PyQt5.QtCore import QThread, pyqtSignal, pyqtSlot
-import time
+"""Progress Bar Module
+
+This file contains the window showing the progress of a running segmentation.
 
+Usage:
+    To use this module, import it and instantiate is as you wish:
 
-class ProgressBarThread(QThread):
-    '''
-    Worker Thread.
-    '''
-    update_values_signal = pyqtSignal()
+        from Paint4Brains.GUI.ProgressBar import ProgressBar
 
-    def __init__(self):
-        super(ProgressBarThread, self).__init__()
+        progress = ProgressBar(segment_manager)
 
-    def run(self):
-        while True:
-            self.update_values_signal.emit()
-            time.sleep(3)
+"""
+
+from PyQt5.QtWidgets import QProgressBar, QLabel, QWidget, QVBoxLayout, QPushButton
+from PyQt5.QtCore import pyqtSignal, pyqtSlot
 
 
 class ProgressBar(QWidget):
+    """ProgressBar class for Paint4Brains.
+
+    Window displaying the progress events sent by the Segmenter.
+    The Segmenter calls its subscribers from the segmentation thread, so events are passed on through a signal to be handled in the GUI thread.
+    Closing the window kills the segmentation. The window closes straight away, and is reset once the segmentation thread has stopped.
+
+    Attributes:
+        progress_signal (pyqtSignal, object): Signal carrying a ProgressEvent
+
+    Args:
+        parent (class): SegmentManager class
+    """
+    progress_signal = pyqtSignal(object)
+
     def __init__(self, parent):
         super(ProgressBar, self).__init__()
         self.parent = parent
@@ -35,17 +46,64 @@ class ProgressBar(QWidget):
         self.layout.addWidget(self.progress)
         self.layout.addWidget(self.button)
 
-        self.thread = ProgressBarThread()
-        self.thread.update_values_signal.connect(self.update_bar)
-        self.thread.start()
+        self.progress_signal.connect(self.update_bar)
+        self.forward = self.progress_signal.emit
+        self.segmenter.subscribe(self.forward)
+        self.stopping = False
 
-    @pyqtSlot()
-    def update_bar(self):
-        self.progress.setValue(self.segmenter.completion)
-        self.label.setText(self.segmenter.state)
+    @pyqtSlot(object)
+    def update_bar(self, event):
+        """Progress update
+
+        Displays the stage, the number of slices segmented and, once it can be measured, the estimated time left.
+
+        Args:
+            event (ProgressEvent): Latest progress of the segmentation
+        """
+        self.progress.setValue(int(event.completion))
+        text = event.stage
+        if event.total:
+            text += "\n{0} of {1} slices".format(event.done, event.total)
+        if event.eta is not None and event.done < event.total:
+            text += " ({0:.1f} slices/s, about {1} left)".format(event.throughput, _format_time(event.eta))
+        self.label.setText(text)
 
     def closeEvent(self, a0):
+        """Kills the segmentation when the window is closed.
+
+        The segmentation thread can take a while to notice (e.g. while the daemon or worker process stops), so it is not waited for here, which would freeze the interface.
+        """
         self.segmenter.run = False
-        self.parent.thread.quit()
-        self.parent.thread.wait()
+        self.segmenter.unsubscribe(self.forward)
+        thread = self.parent.thread
+        if thread.isRunning() and not self.stopping:
+            self.stopping = True
+            thread.finished.connect(self.stopped)
         super(ProgressBar, self).closeEvent(a0)
+
+    @pyqtSlot()
+    def stopped(self):
+        """Resets the window once the killed segmentation thread has finished."""
+        self.stopping = False
+        self.parent.thread.finished.disconnect(self.stopped)
+        self.progress.setValue(0)
+        self.label.setText("Segmentation Started")
+
+
+def _format_time(seconds):
+    """Formats a number of seconds for the progress label.
+
+    Args:
+        seconds (float): Time in seconds
+
+    Returns:
+        str: Human readable time
+    """
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "{0} s".format(seconds)
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return "{0} min {1} s".format(minutes, seconds)
+    hours, minutes = divmod(minutes, 60)
+    return "{0} h {1} min".format(hours, minutes)
@@ -1,11 +1,12 @@
 """Segmenter Manager Module
 
 This file contains a collection of classes and functions which augment the segmentation operation.
+The models themselves run in the segmentation daemon or in a worker process (see DaemonClient), the threads here only wait for them so the interface stays responsive.
 
 Usage:
     To use this module, import it and instantiate is as you wish:
 
-        from Paint4Brains.GUI.SegmentManager import SegmentThread, SegmentManager
+        from Paint4Brains.GUI.SegmentManager import SegmentThread, SegmentManager, ExtractThread
 
         manager = SegmentManager()
 
@@ -21,35 +22,44 @@ class SegmentThread(QThread):
     '''Segment Worker Thread
 
     In order to allow the operation of the software while segmentation is running, and prevent freezing on older hardware, the segmentation process is threaded.
+    The thread waits for the daemon or worker process running the models, and passes on its progress.
 
     Attributes:
         start_signal (pyqtSignal): Signal marking the start of segmnetation
+        preview_signal (pyqtSignal): Signal marking that a preview of the labels is ready
         end_signal (pyqtSignal): Signal marking the end of segmentation
         error_signal (pyqtSignal, str): String of any error raised during execution
 
     Args:
         window (class): ImageViewer class
         device (int/str): Device type used for training (int - GPU id, str- CPU)
+        preview (bool): Whether a quick preview of the labels should be segmented before the full segmentation
 
     '''
     start_signal = pyqtSignal()
+    preview_signal = pyqtSignal()
     end_signal = pyqtSignal()
     error_signal = pyqtSignal(str)
 
-    def __init__(self, brain, device):
+    def __init__(self, brain, device, preview=True):
         super(SegmentThread, self).__init__()
         # Storing constructor arguments to re-use for processing
         self.device = device
         self.brain = brain
+        self.preview = preview
 
     def run(self):
         """Run function
 
         Run function which, if receiving a run signal, starts the segmentation using a thread, or otherwise ends the thread or raises an error.
+        A preview of the labels is segmented and shown first, so it can be reviewed while the full segmentation runs.
         """
 
         self.start_signal.emit()
         try:
+            if self.preview:
+                self.brain.segment_preview(self.device)
+                self.preview_signal.emit()
             self.brain.segment(self.device)
         except Exception as e:
             text = str(e)
@@ -58,16 +68,54 @@ class SegmentThread(QThread):
             self.end_signal.emit()
 
 
+class ExtractThread(QThread):
+    '''Extraction Worker Thread
+
+    Waits for the brain extraction, which runs in the segmentation daemon or a worker process, so the interface stays responsive meanwhile.
+
+    Attributes:
+        end_signal (pyqtSignal): Signal marking the end of extraction
+        error_signal (pyqtSignal, str): String of any error raised during execution
+
+    Args:
+        brain (class): BrainData class
+    '''
+    end_signal = pyqtSignal()
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, brain):
+        super(ExtractThread, self).__init__()
+        self.brain = brain
+
+    def run(self):
+        """Run function
+
+        Extracts the brain, then signals the end of the extraction or the error raised.
+        """
+        try:
+            self.brain.extract()
+        except Exception as e:
+            self.error_signal.emit(str(e))
+        else:
+            self.end_signal.emit()
+
+
 class SegmentManager(QObject):
     """SegmentManager class
 
     This is a class containing several useful functions which augment the segmentation process.
+    The labels of the slices segmented so far are shown as the segmentation runs. They are passed on from the segmentation thread through a signal.
+
+    Attributes:
+        labels_signal (pyqtSignal, object): Signal carrying partial labels
 
     Args:
         parent (class): Base or parent class
 
     """
 
+    labels_signal = pyqtSignal(object)
+
     def __init__(self, parent):
         super(SegmentManager, self).__init__(parent=parent)
         self.device = "None"
@@ -75,6 +123,8 @@ class SegmentManager(QObject):
         self.brain = self.parent.brain
         self.start_msg = ProgressBar(self)
         self.thread = SegmentThread(self.brain, self.device)
+        self.labels_signal.connect(self.show_partial_labels)
+        self.forward_labels = self.labels_signal.emit
         self.show_initial_message()
 
     def popup_button(self, i):
@@ -108,8 +158,11 @@ class SegmentManager(QObject):
         # Running segmentation in a separate thread, to prevent the GUI from crashing/freezing
         if device != "None":
             self.thread.start_signal.connect(self.started_message)
+            self.thread.preview_signal.connect(self.show_labels)
             self.thread.end_signal.connect(self.finished_message)
             self.thread.error_signal.connect(self.error_message)
+            self.thread.finished.connect(self.stop_partial_labels)
+            self.brain.segmenter.subscribe_labels(self.forward_labels)
             self.thread.device = device
             self.thread.start()
 
@@ -134,10 +187,38 @@ class SegmentManager(QObject):
         msg = QMessageBox()
         msg.setText("Segmentation has finished successfully.")
         msg.exec()
+        self.show_labels()
+        self.start_msg.close()
+
+    @pyqtSlot()
+    def show_labels(self):
+        """Labels display
+
+        Signals the ImageViewer to enable editing, display all the labels and enable color editing.
+        Used for the preview of the labels as well as for the final ones.
+        """
         self.parent.main_widget.win.enable_drawing()
         self.parent.main_widget.win.update_colormap()
-        self.parent.main_widget.win.view_back_labels()
-        self.start_msg.close()
+        self.parent.main_widget.win.see_all_labels = True
+        self.parent.main_widget.win.refresh_image()
+
+    @pyqtSlot(object)
+    def show_partial_labels(self, labels):
+        """Partial labels display
+
+        Merges the labels of the slices segmented so far into the brain, and refreshes the view if any of them are in the slice displayed.
+
+        Args:
+            labels (np.array): Partial labels sent by the Segmenter
+        """
+        new = self.brain.set_partial_labels(labels)
+        if self.brain.get_volume_slice(new, self.brain.i).any():
+            self.show_labels()
+
+    @pyqtSlot()
+    def stop_partial_labels(self):
+        """Stops following the partial labels once the segmentation thread has finished."""
+        self.brain.segmenter.unsubscribe_labels(self.forward_labels)
 
     @pyqtSlot(str)
     def error_message(self, error):
@@ -149,7 +230,6 @@ class SegmentManager(QObject):
             error (pyqtSignal): Error signal generated during segmentation.
         """
 
-        self.start_msg.thread.terminate()
         self.start_msg.close()
         msg = QErrorMessage()
         text = "Error while running segmentation."
@@ -0,0 +1,171 @@
+"""Paint4Brains Instrumentation
+
+This file contains a small profiler used to find out where the time of a segmentation goes.
+Each stage of the pipeline is wrapped in a context manager recording its wall time, CPU time and peak resident memory.
+The results can be read as a dictionary, or written as a Chrome trace (open chrome://tracing or https://ui.perfetto.dev and load the file).
+
+Usage:
+    To use this module, import it and instantiate is as you wish:
+
+        from Paint4Brains.Instrumentation import Instrumentation
+
+        instrumentation = Instrumentation()
+
+        with instrumentation.stage("resample"):
+            do_the_resampling()
+
+        instrumentation.results()
+        instrumentation.write_chrome_trace("trace.json")
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def current_rss():
+    """Current resident memory of this process
+
+    Read from /proc on Linux. Elsewhere the peak resident memory of the process is the best available estimate.
+
+    Returns:
+        int: Resident memory in bytes, or None if it can not be measured
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Instrumentation:
+    """Instrumentation class for Paint4Brains.
+
+    Records wall time, CPU time and peak resident memory of named stages.
+    Stages can be nested (e.g. the inference of each axis inside the whole segmentation).
+    While a stage is open, a background thread samples the resident memory to find its peak.
+    When disabled, stages cost nothing and nothing is recorded.
+
+    Args:
+        enabled (bool): Whether anything should be recorded
+        sample_interval (float): Seconds between memory samples
+    """
+
+    def __init__(self, enabled=True, sample_interval=0.05):
+        self.enabled = enabled
+        self.sample_interval = sample_interval
+        self.records = []
+        self._open = []
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._origin = time.time()
+
+    def reset(self):
+        """Forgets every stage recorded so far."""
+        with self._lock:
+            self.records = []
+            self._origin = time.time()
+
+    @contextmanager
+    def stage(self, name, **details):
+        """Measures a stage
+
+        Context manager recording the stage once the block it wraps finishes (even if it raises).
+
+        Args:
+            name (str): Name of the stage
+            **details: Any extra information to be stored with the stage (e.g. the axis)
+        """
+        if not self.enabled:
+            yield
+            return
+        rss = current_rss()
+        record = {"name": name, "details": details, "start": time.time() - self._origin,
+                  "rss_start": rss, "peak_rss": rss, "thread": threading.current_thread().name}
+        wall, cpu = time.perf_counter(), time.process_time()
+        with self._lock:
+            self._open.append(record)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+                self._sampler.start()
+        try:
+            yield
+        finally:
+            record["wall"] = time.perf_counter() - wall
+            record["cpu"] = time.process_time() - cpu
+            rss = current_rss()
+            with self._lock:
+                self._open.remove(record)
+                record["rss_end"] = rss
+                if rss is not None:
+                    record["peak_rss"] = max(record["peak_rss"] or 0, rss)
+                self.records.append(record)
+
+    def _sample(self):
+        """Memory sampler run in a background thread while any stage is open."""
+        while True:
+            rss = current_rss()
+            with self._lock:
+                if not self._open:
+                    self._sampler = None
+                    return
+                if rss is not None:
+                    for record in self._open:
+                        record["peak_rss"] = max(record["peak_rss"] or 0, rss)
+            time.sleep(self.sample_interval)
+
+    def results(self):
+        """Recorded stages
+
+        Returns:
+            dict: "stages" holds every recorded stage in the order they started.
+                "totals" holds the wall time, CPU time and peak memory added up over stages sharing a name.
+        """
+        with self._lock:
+            stages = sorted((dict(record) for record in self.records), key=lambda record: record["start"])
+        totals = {}
+        for record in stages:
+            total = totals.setdefault(record["name"], {"calls": 0, "wall": 0., "cpu": 0., "peak_rss": None})
+            total["calls"] += 1
+            total["wall"] += record["wall"]
+            total["cpu"] += record["cpu"]
+            if record["peak_rss"] is not None:
+                total["peak_rss"] = max(total["peak_rss"] or 0, record["peak_rss"])
+        return {"stages": stages, "totals": totals}
+
+    def write_chrome_trace(self, filename):
+        """Chrome trace writer
+
+        Writes the recorded stages as complete ("X") events of the Chrome trace event format.
+
+        Args:
+            filename (str): Path of the JSON file to be written
+        """
+        events = []
+        for record in self.results()["stages"]:
+            args = dict(record["details"])
+            args.update({"cpu_s": record["cpu"], "peak_rss_mb": _megabytes(record["peak_rss"]),
+                         "rss_start_mb": _megabytes(record["rss_start"]),
+                         "rss_end_mb": _megabytes(record["rss_end"])})
+            events.append({"name": record["name"], "ph": "X", "pid": os.getpid(), "tid": record["thread"],
+                           "ts": record["start"] * 1e6, "dur": record["wall"] * 1e6, "args": args})
+        with open(filename, "w") as trace:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace, default=str)
+
+
+def _megabytes(size):
+    """Converts a number of bytes to megabytes, keeping None as it is."""
+    return None if size is None else size / 2 ** 20
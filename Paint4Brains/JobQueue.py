@@ -0,0 +1,501 @@
+"""Paint4Brains Cohort Job Queue
+
+This file contains a job queue kept in a folder of a shared filesystem, used to segment a whole cohort on several machines at once.
+Every worker (on any machine which sees the folder) claims the scans which are left by creating a lock file for them, segments them and records how long each one took.
+There is no central service: the lock files are created atomically, so two workers never claim the same scan, and adding workers (or machines) adds throughput.
+A worker keeps refreshing the lock of the scan it is segmenting. When a worker dies, its lock stops being refreshed, and once it is stale another worker takes the scan over.
+
+Attributes:
+    default_stale_after (float): Seconds after which a lock which has not been refreshed is considered to belong to a dead worker.
+    default_max_attempts (int): Number of workers a scan may take down before it is marked as failed.
+
+Usage:
+    Queue the scans of a cohort, then start as many workers as needed, on any machine sharing the folder (see main for the options):
+
+        python -m Paint4Brains.JobQueue add /shared/cohort_queue /shared/cohort/*.nii.gz --output /shared/labels
+        python -m Paint4Brains.JobQueue work /shared/cohort_queue --device cuda
+        python -m Paint4Brains.JobQueue status /shared/cohort_queue
+
+    The queue can be used from Python as well:
+
+        from Paint4Brains.JobQueue import JobQueue
+        from Paint4Brains.Segmenter import Segmenter
+
+        queue = JobQueue("/shared/cohort_queue")
+        queue.add(scans, output_folder="/shared/labels")
+        queue.work(Segmenter(keep_models=True))
+
+    The folder holds:
+
+        jobs/<id>.json          scan and output folder of each job
+        locks/<id>.lock         worker segmenting a job, refreshed while it runs
+        done/<id>.json          outputs and timing of each finished job
+        failed/<id>.json        error of each job which could not be segmented
+        reclaimed/<id>.*.json   locks taken over from dead workers
+        workers/<worker>.json   last time each worker was seen
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import hashlib
+import argparse
+import threading
+import numpy as np
+import nibabel as nib
+
+default_stale_after = 300.
+
+default_max_attempts = 3
+
+folders = ("jobs", "locks", "done", "failed", "reclaimed", "workers")
+
+
+class JobQueue:
+    """JobQueue class for Paint4Brains.
+
+    Queue of segmentation jobs, one per scan, kept as files in a folder shared by every worker.
+    A job is claimed by creating its lock file with O_CREAT | O_EXCL, which only one worker can do, and finished by writing its done (or failed) record before removing the lock.
+    The age of a lock is compared to the time of the filesystem itself (read from a file the worker has just refreshed), so the clocks of the machines do not need to agree.
+    A worker which is only very slow (e.g. paused for longer than stale_after) may see its job taken over: it notices at its next heartbeat, and stops the job without writing its outputs or recording it.
+
+    Args:
+        folder (str): Folder of the queue, on a filesystem shared by every worker
+        stale_after (float): Seconds without the lock of a job being refreshed after which its worker is considered dead
+        heartbeat_interval (float): Seconds between two refreshes of the lock of the job being run. Defaults to a tenth of stale_after.
+        max_attempts (int): Number of workers which may die running a job before it is marked as failed
+        worker (str): Name of this worker. Defaults to the host name and process id.
+    """
+
+    def __init__(self, folder, stale_after=default_stale_after, heartbeat_interval=None,
+                 max_attempts=default_max_attempts, worker=None):
+        self.folder = os.path.abspath(folder)
+        self.stale_after = stale_after
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else stale_after / 10
+        self.max_attempts = max_attempts
+        self.worker = worker if worker is not None else socket.gethostname() + "-" + str(os.getpid())
+        for name in folders:
+            os.makedirs(os.path.join(self.folder, name), exist_ok=True)
+
+    def _path(self, kind, job, extension=".json"):
+        """Path of the file of a job in one of the folders of the queue."""
+        return os.path.join(self.folder, kind, job + extension)
+
+    def add(self, scans, output_folder=None):
+        """Queues scans to be segmented.
+
+        Scans already in the queue are left as they are, so a cohort can be added again after new scans have been acquired.
+
+        Args:
+            scans (list): Paths of the scans, which every worker has to be able to read at the same path
+            output_folder (str): Folder the labels (and confidence maps) are written to. Defaults to the folder of each scan.
+
+        Returns:
+            list: Ids of the jobs added
+        """
+        added = []
+        for scan in scans:
+            scan = os.path.abspath(scan)
+            job = job_id(scan)
+            path = self._path("jobs", job)
+            if os.path.exists(path):
+                continue
+            output = os.path.abspath(output_folder) if output_folder is not None else os.path.dirname(scan)
+            _write_json(path, {"id": job, "scan": scan, "output_folder": output})
+            added.append(job)
+        return added
+
+    def jobs(self):
+        """Ids of every job of the queue, in the order they are claimed."""
+        return sorted(name[:-5] for name in os.listdir(os.path.join(self.folder, "jobs")) if name.endswith(".json"))
+
+    def _finished(self, job):
+        """Whether a job is done or has failed."""
+        return os.path.exists(self._path("done", job)) or os.path.exists(self._path("failed", job))
+
+    def _now(self):
+        """Current time of the shared filesystem, which also records that this worker is alive."""
+        path = self._path("workers", self.worker)
+        _write_json(path, {"worker": self.worker, "host": socket.gethostname(), "pid": os.getpid(), "time": time.time()})
+        return os.stat(path).st_mtime
+
+    def claim(self):
+        """Claims the next job which is neither finished nor run by a live worker.
+
+        Returns:
+            dict: Description of the job claimed, with its "id", "scan", "output_folder" and "attempt", or None if there is none left
+        """
+        now = None
+        for job in self.jobs():
+            if self._finished(job):
+                continue
+            handle = self._lock(job)
+            if handle is None:
+                if now is None:
+                    now = self._now()
+                # Once the lock of a dead worker is out of the way, the job can be claimed straight away
+                if not self._reclaim(job, now):
+                    continue
+                handle = self._lock(job)
+                if handle is None:
+                    continue
+            attempt = self._attempts(job) + 1
+            with os.fdopen(handle, "w") as file:
+                json.dump({"worker": self.worker, "host": socket.gethostname(), "pid": os.getpid(),
+                           "claimed": time.time(), "attempt": attempt}, file)
+            # The job may have been finished between the check and the lock
+            if self._finished(job):
+                self.release(job)
+                continue
+            with open(self._path("jobs", job)) as file:
+                description = json.load(file)
+            if attempt > self.max_attempts:
+                self.fail(description, "Stopped " + str(attempt - 1) + " workers without finishing")
+                continue
+            description["attempt"] = attempt
+            return description
+        return None
+
+    def _lock(self, job):
+        """Creates the lock of a job, which only one worker can do.
+
+        Args:
+            job (str): Id of the job
+
+        Returns:
+            int: Handle of the new lock file, or None if the job is already locked
+        """
+        try:
+            return os.open(self._path("locks", job, ".lock"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+
+    def _reclaim(self, job, now):
+        """Takes a stale lock over, so the job can be claimed again.
+
+        The lock is moved out of the way (which only one worker can do) rather than removed, so the attempts made at the job can be counted.
+        Its age is only checked once it has been moved, as its worker could refresh it between a check and the move.
+        If it turns out to have been refreshed, it is put back (unless another worker has locked the job in the meantime).
+
+        Args:
+            job (str): Id of the job
+            now (float): Current time of the shared filesystem
+
+        Returns:
+            bool: Whether the lock was stale and has been moved
+        """
+        lock = self._path("locks", job, ".lock")
+        moved = self._path("reclaimed", job + "." + uuid.uuid4().hex)
+        try:
+            os.rename(lock, moved)
+        except FileNotFoundError:
+            # Finished, or taken over by another worker in the meantime
+            return False
+        # Nothing refreshes the lock once it has been moved, so its age can not change any more
+        if now - os.stat(moved).st_mtime > self.stale_after:
+            return True
+        try:
+            # Linking does not replace a lock created by another worker in the meantime
+            os.link(moved, lock)
+        except FileExistsError:
+            pass
+        os.remove(moved)
+        return False
+
+    def _attempts(self, job):
+        """Number of workers which died running a job."""
+        prefix = job + "."
+        return sum(1 for name in os.listdir(os.path.join(self.folder, "reclaimed")) if name.startswith(prefix))
+
+    def heartbeat(self, job):
+        """Refreshes the lock of a job, showing its worker is still alive.
+
+        Args:
+            job (str): Id of the job
+
+        Returns:
+            bool: Whether the lock still belongs to this worker. If not, the job has been taken over by another worker.
+        """
+        lock = self._path("locks", job, ".lock")
+        # Another worker checking the age of the lock moves it away for a moment
+        for retry in range(10):
+            if retry > 0:
+                time.sleep(0.1)
+            try:
+                if not self._owns(lock):
+                    return False
+                os.utime(lock)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                return False
+            self._now()
+            return True
+        return False
+
+    def _owns(self, lock):
+        """Whether a lock file belongs to this worker. Raises FileNotFoundError if there is no lock."""
+        try:
+            with open(lock) as file:
+                return json.load(file)["worker"] == self.worker
+        except (ValueError, KeyError):
+            # Another worker is still writing its new lock
+            return False
+
+    def release(self, job):
+        """Removes the lock of a job, if it still belongs to this worker."""
+        lock = self._path("locks", job, ".lock")
+        try:
+            if self._owns(lock):
+                os.remove(lock)
+        except FileNotFoundError:
+            pass
+
+    def complete(self, description, record):
+        """Records a job as done and releases it.
+
+        Args:
+            description (dict): Job, as returned by claim
+            record (dict): Outputs and timing of the job
+        """
+        _write_json(self._path("done", description["id"]), dict(description, worker=self.worker, **record))
+        self.release(description["id"])
+
+    def fail(self, description, error):
+        """Records a job as failed and releases it. Failed jobs are not run again until their record is removed.
+
+        Args:
+            description (dict): Job, as returned by claim
+            error (str): Why the job failed
+        """
+        _write_json(self._path("failed", description["id"]),
+                    dict(description, worker=self.worker, error=str(error), time=time.time()))
+        self.release(description["id"])
+
+    def run(self, segmenter, description):
+        """Segments the scan of a job, writing its labels (and confidence map) to its output folder.
+
+        The lock of the job is refreshed by a background thread while the scan is segmented.
+        If the job is taken over by another worker in the meantime, the segmentation is stopped and nothing is written.
+
+        Args:
+            segmenter (Segmenter): Segmenter running the job
+            description (dict): Job, as returned by claim
+
+        Returns:
+            dict: Outputs and timing of the job: its wall and CPU time, and the stages measured if the segmenter is instrumented
+
+        Raises:
+            JobTakenOver: If another worker has taken the job over
+        """
+        stop, lost = threading.Event(), threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat_interval):
+                if not self.heartbeat(description["id"]):
+                    lost.set()
+                    segmenter.run = False
+                    return
+
+        segmenter.run = True
+        heart = threading.Thread(target=beat, name="heartbeat-" + description["id"], daemon=True)
+        heart.start()
+        started, cpu = time.time(), time.process_time()
+        try:
+            scan = description["scan"]
+            original = nib.load(scan)
+            try:
+                labels = segmenter.segment_array(np.asanyarray(original.dataobj), original.affine)
+            except Exception:
+                if lost.is_set():
+                    raise JobTakenOver(description["id"])
+                raise
+            stop.set()
+            heart.join()
+            # The last refresh also makes sure the job is still this worker's before writing anything
+            if lost.is_set() or not self.heartbeat(description["id"]):
+                raise JobTakenOver(description["id"])
+            target = os.path.join(description["output_folder"], os.path.basename(scan))
+            os.makedirs(description["output_folder"], exist_ok=True)
+            # QuickNAT has 33 classes, so the labels of a whole cohort are stored as bytes
+            outputs = {"labels": segmenter.save_labels(labels.astype(np.uint8), target, original)}
+            if segmenter.confidence_map is not None:
+                outputs["confidence"] = segmenter.save_confidence(segmenter.confidence_map, target)
+        finally:
+            stop.set()
+            heart.join()
+        record = {"outputs": outputs, "host": socket.gethostname(), "started": started, "finished": time.time(),
+                  "wall": time.time() - started, "cpu": time.process_time() - cpu,
+                  "cached": segmenter.cache_metadata is not None}
+        if segmenter.instrumentation.enabled:
+            record["stages"] = segmenter.instrumentation.results()["totals"]
+        return record
+
+    def work(self, segmenter, wait=False, poll_interval=10., limit=None):
+        """Runs jobs until none is left.
+
+        Jobs which raise an error are marked as failed, and the worker moves on to the next one.
+
+        Args:
+            segmenter (Segmenter): Segmenter running the jobs. Keeping its models loaded (keep_models=True) saves loading them for every scan.
+            wait (bool): Whether to keep waiting while other workers still run jobs, which are taken over if they die
+            poll_interval (float): Seconds between two looks for jobs when waiting
+            limit (int): Largest number of jobs to run. If None, runs every job it can claim.
+
+        Returns:
+            list: Ids of the jobs this worker finished
+        """
+        finished = []
+        while limit is None or len(finished) < limit:
+            description = self.claim()
+            if description is None:
+                if wait and not all(self._finished(job) for job in self.jobs()):
+                    time.sleep(poll_interval)
+                    continue
+                break
+            print("Segmenting " + description["scan"] + " (attempt " + str(description["attempt"]) + ")")
+            try:
+                record = self.run(segmenter, description)
+            except JobTakenOver:
+                # The worker which took it over finishes it
+                print("Job " + description["id"] + " has been taken over by another worker", file=sys.stderr)
+                continue
+            except Exception as error:
+                print("Failed to segment " + description["scan"] + ": " + str(error), file=sys.stderr)
+                self.fail(description, error)
+                continue
+            self.complete(description, record)
+            finished.append(description["id"])
+            print("Segmented " + description["scan"] + " in " + "{:.1f}".format(record["wall"]) + " s")
+        return finished
+
+    def status(self):
+        """Summary of the queue
+
+        Returns:
+            dict: Number of jobs "queued", "running", "done" and "failed", the "workers" running them,
+                and the mean wall time of a job and number of jobs done per hour since the first one started
+        """
+        jobs = self.jobs()
+        done = [_read_json(self._path("done", job)) for job in jobs if os.path.exists(self._path("done", job))]
+        done = [record for record in done if record is not None]
+        failed = sum(1 for job in jobs if os.path.exists(self._path("failed", job)))
+        running = {}
+        for job in jobs:
+            lock = _read_json(self._path("locks", job, ".lock"))
+            if lock is not None and not self._finished(job):
+                running[job] = lock["worker"]
+        summary = {"queued": len(jobs) - len(done) - failed - len(running), "running": len(running),
+                   "done": len(done), "failed": failed, "workers": sorted(set(running.values())),
+                   "mean_wall": None, "per_hour": None}
+        if done:
+            summary["mean_wall"] = sum(record["wall"] for record in done) / len(done)
+            span = max(record["finished"] for record in done) - min(record["started"] for record in done)
+            summary["per_hour"] = len(done) * 3600. / span if span > 0 else None
+        return summary
+
+    def timings(self):
+        """Outputs and timing of every job done
+
+        Returns:
+            list: Done records, in the order of the jobs
+        """
+        records = [_read_json(self._path("done", job)) for job in self.jobs()]
+        return [record for record in records if record is not None]
+
+
+class JobTakenOver(Exception):
+    """Raised when the job a worker is running has been taken over by another worker."""
+
+    def __init__(self, job):
+        super(JobTakenOver, self).__init__("Job " + str(job) + " has been taken over by another worker")
+        self.job = job
+
+
+def job_id(scan):
+    """Id of the job of a scan: its file name, followed by a hash of its path so scans with the same name do not clash.
+
+    Args:
+        scan (str): Absolute path of the scan
+
+    Returns:
+        str: Id of the job
+    """
+    name = os.path.basename(scan)
+    for extension in (".nii.gz", ".nii", ".mgz"):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    return name + "-" + hashlib.sha1(scan.encode()).hexdigest()[:8]
+
+
+def _write_json(path, content):
+    """Writes a JSON file atomically, so other workers never read half of it."""
+    temporary = path + "." + uuid.uuid4().hex + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump(content, file, default=str)
+    os.replace(temporary, path)
+
+
+def _read_json(path):
+    """Content of a JSON file, or None if it does not exist (any more)."""
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def main(arguments=None):
+    """Command line entry point
+
+    Adds scans to a queue, runs a worker on it, or prints its status.
+
+    Args:
+        arguments (list): Command line arguments. Defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Segments a cohort with workers sharing a job queue folder.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="Queue scans to be segmented")
+    add.add_argument("folder", help="Folder of the queue, on a shared filesystem")
+    add.add_argument("scans", nargs="+", help="Paths of the scans")
+    add.add_argument("--output", default=None, help="Folder the labels are written to. Defaults to the folder of each scan.")
+    work = commands.add_parser("work", help="Segment queued scans until none is left")
+    work.add_argument("folder", help="Folder of the queue, on a shared filesystem")
+    work.add_argument("--device", default="cpu", help="cpu, cuda or the id of a GPU")
+    work.add_argument("--backend", default="torch", help="Inference backend (torch or onnx)")
+    work.add_argument("--quantised", action="store_true", help="Use the int8 models on the CPU")
+    work.add_argument("--calibration-scans", nargs="+", default=None,
+                      help="Scans to calibrate the int8 models on, if they have not been built yet")
+    work.add_argument("--threads", type=int, default=None, help="Number of threads the models run with")
+    work.add_argument("--confidence", action="store_true", help="Save the confidence map next to the labels")
+    work.add_argument("--instrument", action="store_true", help="Record the time of every stage of each scan")
+    work.add_argument("--wait", action="store_true", help="Keep waiting for jobs of other workers to finish or be taken over")
+    work.add_argument("--stale-after", type=float, default=default_stale_after,
+                      help="Seconds after which the job of a silent worker is taken over")
+    status = commands.add_parser("status", help="Print the progress of the queue")
+    status.add_argument("folder", help="Folder of the queue, on a shared filesystem")
+    args = parser.parse_args(arguments)
+
+    if args.command == "add":
+        added = JobQueue(args.folder).add(args.scans, args.output)
+        print("Added " + str(len(added)) + " scans")
+    elif args.command == "work":
+        # Imported here so adding scans and reading the status do not need PyTorch
+        from Paint4Brains.Segmenter import Segmenter
+        device = int(args.device) if args.device.isdigit() else args.device
+        segmenter = Segmenter(device=device, backend=args.backend, quantised=args.quantised, threads=args.threads,
+                              calibration_scans=args.calibration_scans,
+                              confidence=args.confidence, instrument=args.instrument, keep_models=True)
+        queue = JobQueue(args.folder, stale_after=args.stale_after)
+        finished = queue.work(segmenter, wait=args.wait)
+        print("Worker " + queue.worker + " segmented " + str(len(finished)) + " scans")
+    else:
+        print(json.dumps(JobQueue(args.folder).status(), indent=4))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,449 @@
+"""Paint4Brains Model Export
+
+This file contains the functions producing faster versions of the QuickNAT models for inference on CPUs.
+The int8 quantised models are calibrated on real scans and cached next to the original checkpoints, so they only need to be built once.
+The cache records the content hash of the checkpoint it was built from, and is rebuilt (or refused) when the checkpoint changes.
+No scans ship with Paint4Brains, so the scans used for calibration have to be given the first time a quantised model is built.
+A per structure Dice report compares the labels predicted by the quantised models with those of the original ones, to decide whether the loss of accuracy is acceptable.
+It is computed on the slices left out of the calibration, so it is not flattered by them.
+The models can also be exported as self contained TorchScript files, which the Segmenter loads instead of the checkpoints when present.
+Those load faster and do not need the packages the models were trained with. They only run faster from PyTorch 1.8 onwards, which can freeze them:
+on older versions the export is skipped unless it can fold batch norms, which the QuickNAT models do not have.
+
+Usage:
+    The quantised models are used by the Segmenter when asked to, calibrated on the given scans if they have not been built yet:
+
+        from Paint4Brains.Segmenter import Segmenter
+
+        segmentation_operation = Segmenter(quantised=True, calibration_scans=["scan_1.nii", "scan_2.nii"])
+
+    They can also be built in advance and compared with the original models from the command line, after which Segmenter(quantised=True) needs no scans:
+
+        $ python -m Paint4Brains.ModelExport quantise scan_1.nii scan_2.nii
+
+    The TorchScript and ONNX models are exported with:
+
+        $ python -m Paint4Brains.ModelExport script
+        $ python -m Paint4Brains.ModelExport onnx
+
+"""
+
+import os
+import sys
+import copy
+import warnings
+import inspect
+import argparse
+import numpy as np
+import nibabel as nib
+import torch
+from torch import nn
+from Paint4Brains.Segmenter import Segmenter, preprocess, nonempty_box, slice_axes, label_names
+from Paint4Brains.DiskCache import DiskCache, hash_file
+
+
+def load_checkpoint(model_path, device="cpu"):
+    """Checkpoint loader
+
+    Loads a model saved whole with torch.save, as the QuickNAT checkpoints are.
+    Recent versions of PyTorch only load weights by default, so unpickling the whole model is asked for when the option exists.
+
+    Args:
+        model_path (str): Path to the checkpoint
+        device (int/str): Device the model is loaded on
+
+    Returns:
+        The unpickled content of the checkpoint
+    """
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        return torch.load(model_path, map_location=torch.device(device), weights_only=False)
+    return torch.load(model_path, map_location=torch.device(device))
+
+
+def quantised_path(model_path):
+    """Path of the cached int8 version of a model
+
+    Args:
+        model_path (str): Path to the original checkpoint
+
+    Returns:
+        str: Path where the quantised model is stored
+    """
+    if model_path.endswith(".pth.tar"):
+        return model_path[:-len(".pth.tar")] + ".int8.pth.tar"
+    return os.path.splitext(model_path)[0] + ".int8.pth.tar"
+
+
+def scripted_path(model_path):
+    """Path of the TorchScript version of a model
+
+    Args:
+        model_path (str): Path to the original checkpoint
+
+    Returns:
+        str: Path where the TorchScript model is stored
+    """
+    if model_path.endswith(".pth.tar"):
+        return model_path[:-len(".pth.tar")] + ".torchscript.pt"
+    return os.path.splitext(model_path)[0] + ".torchscript.pt"
+
+
+def onnx_path(model_path):
+    """Path of the ONNX version of a model
+
+    Args:
+        model_path (str): Path to the original checkpoint
+
+    Returns:
+        str: Path where the ONNX model is stored
+    """
+    if model_path.endswith(".pth.tar"):
+        return model_path[:-len(".pth.tar")] + ".onnx"
+    return os.path.splitext(model_path)[0] + ".onnx"
+
+
+def export_onnx(model, path, shape=(1, 1, 256, 256)):
+    """ONNX export
+
+    Exports the model to an ONNX file, with a variable batch size.
+    Opset 11 is the first one able to export the max unpooling used by QuickNAT.
+
+    Args:
+        model (nn.Module): Model to be exported
+        path (str): Path of the ONNX file
+        shape (tuple): Shape of the inputs the model is exported with
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    with torch.no_grad():
+        torch.onnx.export(model, torch.zeros(shape), path, input_names=["input"], output_names=["output"],
+                          dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}}, opset_version=11)
+
+
+def export_torchscript(model, path, shape=(1, 1, 256, 256)):
+    """TorchScript export
+
+    Compiles the model on the CPU and saves it as a self contained TorchScript file.
+    Batch norms are folded into the convolutions next to them first, where this gives the same outputs (see fold_batch_norms).
+    Scripting is tried first, as it keeps the model independent of the input shape. Models using Python features TorchScript does not support are traced instead.
+    From PyTorch 1.8 onwards, the compiled model is also frozen: parameters become constants and dropout is removed.
+    The batch norms of QuickNAT come before a PReLU and the next convolution, so they can not be folded, only precomputed by freezing.
+    When nothing can be folded and the installed PyTorch can not freeze, the export would not be any faster than the checkpoint, so nothing is written.
+
+    Args:
+        model (nn.Module): Model to be exported
+        path (str): Path of the TorchScript file
+        shape (tuple): Shape of the inputs the model is traced with, if it has to be traced
+
+    Returns:
+        torch.jit.ScriptModule: Exported model, or None if it was not written
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    batch_norms = _count_batch_norms(model)
+    model = fold_batch_norms(model)
+    if _count_batch_norms(model) == batch_norms and torch_version() < (1, 8):
+        warnings.warn("Nothing to fold and PyTorch " + torch.__version__ + " can not freeze models, so the "
+                      "TorchScript export would not be faster. " + path + " was not written.")
+        return None
+    try:
+        scripted = torch.jit.script(model)
+    except Exception:
+        with torch.no_grad():
+            scripted = torch.jit.trace(model, torch.zeros(shape))
+    if torch_version() >= (1, 8):
+        scripted = torch.jit.freeze(scripted)
+    scripted.save(path)
+    return scripted
+
+
+def torch_version():
+    """Installed version of PyTorch
+
+    Returns:
+        tuple: Major and minor version numbers
+    """
+    return tuple(int(part) for part in torch.__version__.split(".")[:2])
+
+
+def fold_batch_norms(model):
+    """Batch norm folding
+
+    Folds the batch norms of a model in evaluation mode into the convolutions they directly follow or precede in a Sequential, replacing them by identities.
+    A batch norm following a convolution is always folded into it.
+    A batch norm preceding a convolution is only folded into it when the convolution has no padding (the padded zeros would not go through the batch norm otherwise) and is not grouped.
+    Batch norms with an activation between them and the convolution, as in QuickNAT, are left as they are.
+
+    Args:
+        model (nn.Module): Model in evaluation mode, changed in place
+
+    Returns:
+        nn.Module: The model
+    """
+    for child in model.children():
+        fold_batch_norms(child)
+    if not isinstance(model, nn.Sequential):
+        return model
+    layers = list(model._modules.items())
+    folded = set()
+    for (name, first), (next_name, second) in zip(layers, layers[1:]):
+        # A batch norm between two convolutions is only folded into the first one
+        if name in folded:
+            continue
+        if isinstance(first, nn.Conv2d) and _foldable(second, first.out_channels):
+            scale, shift = _batch_norm_affine(second)
+            with torch.no_grad():
+                bias = first.bias if first.bias is not None else torch.zeros(first.out_channels)
+                first.weight.mul_(scale.view(-1, 1, 1, 1))
+                first.bias = nn.Parameter(bias * scale + shift)
+            model._modules[next_name] = nn.Identity()
+            folded.add(next_name)
+        elif (_foldable(first, None) and isinstance(second, nn.Conv2d) and second.groups == 1 and
+              first.num_features == second.in_channels and all(padding == 0 for padding in second.padding)):
+            scale, shift = _batch_norm_affine(first)
+            with torch.no_grad():
+                bias = second.bias if second.bias is not None else torch.zeros(second.out_channels)
+                shift = second.weight.sum(dim=(2, 3)) @ shift
+                second.weight.mul_(scale.view(1, -1, 1, 1))
+                second.bias = nn.Parameter(bias + shift)
+            model._modules[name] = nn.Identity()
+    return model
+
+
+def _count_batch_norms(model):
+    """Number of batch norms in a model."""
+    return sum(1 for module in model.modules() if isinstance(module, nn.BatchNorm2d))
+
+
+def _foldable(module, channels):
+    """Whether a module is a batch norm using its running statistics, with the given number of channels if not None."""
+    return (isinstance(module, nn.BatchNorm2d) and not module.training and module.running_mean is not None and
+            (channels is None or module.num_features == channels))
+
+
+def _batch_norm_affine(batch_norm):
+    """Scale and shift of each channel applied by a batch norm in evaluation mode."""
+    scale = torch.rsqrt(batch_norm.running_var + batch_norm.eps)
+    if batch_norm.weight is not None:
+        scale = scale * batch_norm.weight
+    shift = -batch_norm.running_mean * scale
+    if batch_norm.bias is not None:
+        shift = shift + batch_norm.bias
+    return scale.detach(), shift.detach()
+
+
+class QuantisedConv(nn.Module):
+    """QuantisedConv class for Paint4Brains.
+
+    Wraps a convolution so that it runs in int8, while taking and returning float tensors like the original.
+    QuickNAT mixes convolutions with operations without int8 kernels (max unpooling, PReLU, squeeze and excitation), so only the convolutions are quantised.
+
+    Args:
+        conv (nn.Conv2d): Convolution to be quantised
+    """
+
+    def __init__(self, conv):
+        super(QuantisedConv, self).__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.conv = conv
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, input):
+        """Forward pass through the int8 convolution
+
+        Args:
+            input (torch.tensor): Float input
+
+        Returns:
+            torch.tensor: Float output
+        """
+        return self.dequant(self.conv(self.quant(input)))
+
+
+def _wrap_convolutions(module):
+    """Replaces every Conv2d inside a module by a QuantisedConv, in place."""
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv2d):
+            setattr(module, name, QuantisedConv(child))
+        else:
+            _wrap_convolutions(child)
+
+
+def _prepare(model):
+    """Copy of a model with observers recording the range of the inputs and outputs of every convolution."""
+    model = copy.deepcopy(model).cpu().eval()
+    _wrap_convolutions(model)
+    qconfig = torch.quantization.get_default_qconfig("fbgemm")
+    for module in model.modules():
+        if isinstance(module, QuantisedConv):
+            module.qconfig = qconfig
+    return torch.quantization.prepare(model)
+
+
+def quantise(model, calibration):
+    """Static int8 quantisation
+
+    The activation ranges of every convolution are observed while running the calibration batches, then the convolutions are converted to int8.
+    The original model is left untouched.
+
+    Args:
+        model (nn.Module): Float model
+        calibration (iterable): Batches of inputs representative of the real data
+
+    Returns:
+        nn.Module: Quantised model, running on the CPU
+    """
+    model = _prepare(model)
+    with torch.no_grad():
+        for batch in calibration:
+            model(batch)
+    return torch.quantization.convert(model)
+
+
+def _quantised_like(model, state):
+    """Rebuilds a quantised model from the float model and the state of its quantised version.
+
+    Quantised modules do not survive being pickled whole, so only their state is cached.
+    """
+    with warnings.catch_warnings():
+        # The observers have not seen any data, their ranges are replaced by the cached ones anyway
+        warnings.simplefilter("ignore")
+        quantised = torch.quantization.convert(_prepare(model))
+    quantised.load_state_dict(state)
+    return quantised
+
+
+def scan_slices(scans, orientation, every=1, cache=None, held_out=False):
+    """Slices of preprocessed scans
+
+    Only slices crossing the head are returned, as these are the only ones the Segmenter passes through the models.
+
+    Args:
+        scans (list): Paths to the scans
+        orientation (str): String indicating the orientation of the slices (COR or AXI)
+        every (int): Only one slice in every this many is returned
+        cache (DiskCache): Optional cache of conformed volumes, shared with the Segmenter
+        held_out (bool): Whether the other slices are returned instead, i.e. those left out when calibrating with the same every
+
+    Yields:
+        torch.tensor: Slice of shape (1, 1, 256, 256)
+    """
+    for scan in scans:
+        volume = preprocess(nib.load(scan), cache=cache)
+        axis = slice_axes[orientation][0]
+        box = nonempty_box(volume)
+        volume = torch.from_numpy(volume.transpose(slice_axes[orientation])).unsqueeze(1)
+        for i in range(box[axis].start, box[axis].stop):
+            if ((i - box[axis].start) % every != 0) == held_out:
+                yield volume[i:i + 1]
+
+
+def load_quantised(model_path, orientation, scans=None, every=8):
+    """Cached quantised model
+
+    Loads the int8 version of a model, building and caching it first if needed.
+    The cache is only used if it was built from the current content of the checkpoint. Otherwise it is rebuilt, which needs the calibration scans.
+
+    Args:
+        model_path (str): Path to the original checkpoint
+        orientation (str): Orientation the model segments (COR or AXI), used to pick the calibration slices
+        scans (list): Scans used for calibration. Only needed when the quantised model has not been built (from this checkpoint) yet.
+        every (int): Only one slice in every this many is used for calibration
+
+    Returns:
+        nn.Module: Quantised model
+    """
+    cached = quantised_path(model_path)
+    source = hash_file(model_path)
+    model = load_checkpoint(model_path)
+    stored = load_checkpoint(cached) if os.path.exists(cached) else None
+    # Caches written before the hash was recorded only hold the state
+    if isinstance(stored, dict) and stored.get("source") == source:
+        return _quantised_like(model, stored["state"])
+    if not scans:
+        if stored is not None:
+            raise FileNotFoundError("The quantised model " + cached + " was built from another version of " +
+                                    model_path + ". Give the scans to calibrate it again with (calibration_scans of "
+                                    "the Segmenter), or rebuild it with "
+                                    "python -m Paint4Brains.ModelExport quantise scan_1.nii scan_2.nii")
+        raise FileNotFoundError("The quantised model " + cached + " has not been built yet. Give the scans to calibrate it "
+                                "with (calibration_scans of the Segmenter), or build it with "
+                                "python -m Paint4Brains.ModelExport quantise scan_1.nii scan_2.nii")
+    if stored is not None:
+        warnings.warn(model_path + " has changed since " + cached + " was built, calibrating it again")
+    quantised = quantise(model, scan_slices(scans, orientation, every, DiskCache("conformed")))
+    torch.save({"source": source, "state": quantised.state_dict()}, cached)
+    return quantised
+
+
+def dice_report(reference_model, model, slices, classes=len(label_names) - 1):
+    """Per structure Dice scores
+
+    Compares the labels predicted by two models on the same slices.
+
+    Args:
+        reference_model (nn.Module): Model taken as the ground truth (e.g. the float model)
+        model (nn.Module): Model being evaluated (e.g. the quantised model)
+        slices (iterable): Input batches
+        classes (int): Number of classes predicted by the models
+
+    Returns:
+        dict: Dice score of each structure, by name. Structures neither model predicts are left out.
+    """
+    overlap = np.zeros(classes)
+    total = np.zeros(classes)
+    with torch.no_grad():
+        for batch in slices:
+            expected = torch.argmax(reference_model(batch), dim=1).numpy().ravel()
+            predicted = torch.argmax(model(batch), dim=1).numpy().ravel()
+            overlap += np.bincount(expected[expected == predicted], minlength=classes)[:classes]
+            total += np.bincount(expected, minlength=classes)[:classes] + \
+                np.bincount(predicted, minlength=classes)[:classes]
+    names = label_names[1:]
+    return {names[label]: 2 * overlap[label] / total[label] for label in range(classes) if total[label] > 0}
+
+
+def main(arguments=None):
+    """Command line entry point
+
+    The quantise command builds (or loads) the quantised coronal and axial models and prints their Dice report against the original models.
+    The report is computed on the slices of the scans which are not used for calibration.
+    The script and onnx commands export both models to TorchScript and ONNX respectively. The TorchScript export is skipped where it would not be faster (see export_torchscript).
+    The scans are only conformed once, the conformed volumes being cached like those of the Segmenter.
+
+    Args:
+        arguments (list): Command line arguments. Defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Builds faster versions of the QuickNAT models.")
+    parser.add_argument("command", choices=["quantise", "script", "onnx"])
+    parser.add_argument("scans", nargs="*", help="Scans used for calibration and for the report. Needed by the quantise command.")
+    parser.add_argument("--every", type=int, default=8,
+                        help="Use one slice in every this many for calibration, and the others for the report.")
+    args = parser.parse_args(arguments)
+
+    if args.command == "quantise" and not args.scans:
+        parser.error("the quantise command needs the scans to calibrate the models with")
+    if args.command == "quantise" and args.every < 2:
+        parser.error("--every has to be at least 2, to leave slices out of the calibration for the report")
+    segmenter = Segmenter()
+    scans = args.scans
+    for orientation, model_path in (("COR", segmenter.coronal_model_path), ("AXI", segmenter.axial_model_path)):
+        if args.command == "script":
+            if export_torchscript(load_checkpoint(model_path), scripted_path(model_path)) is not None:
+                print("Exported the {} model to {}".format(orientation, scripted_path(model_path)))
+            continue
+        if args.command == "onnx":
+            export_onnx(load_checkpoint(model_path), onnx_path(model_path))
+            print("Exported the {} model to {}".format(orientation, onnx_path(model_path)))
+            continue
+        quantised = load_quantised(model_path, orientation, scans, args.every)
+        original = load_checkpoint(model_path).eval()
+        print("Dice of the int8 {} model against the original on the slices left out of the calibration ({})".format(
+            orientation, quantised_path(model_path)))
+        report = dice_report(original, quantised, scan_slices(scans, orientation, args.every, DiskCache("conformed"),
+                                                              held_out=True))
+        for name, dice in report.items():
+            print("    {:<28} {:.4f}".format(name, dice))
+        print("    {:<28} {:.4f}".format("Mean", np.mean(list(report.values()))))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,262 @@
+"""Paint4Brains Resampler
+
+This file contains the resampling engine used to conform the input scans before segmentation and to bring the labels back to the original space afterwards.
+Only the two cases needed by the Segmenter are handled: trilinear interpolation of intensities and nearest neighbour interpolation of labels, both under an affine transformation.
+The output is computed a few slices at a time on several threads (numpy releases the GIL while doing the heavy lifting).
+Grids which only differ by the order or direction of their axes (e.g. scans already conformed by FreeSurfer) are not interpolated at all: the axes are just reordered.
+
+Usage:
+    To use this module, import it and instantiate is as you wish:
+
+        from Paint4Brains.Resampler import AffineResampler
+
+        resampler = AffineResampler(image.affine, image.shape, new_affine, (256, 256, 256))
+
+        conformed = resampler.forward(image_data)
+        labels_in_original_space = resampler.inverse(conformed_labels)
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AffineResampler:
+    """AffineResampler class for Paint4Brains.
+
+    Resamples volumes between a source and a target voxel grid, each defined by an affine and a shape.
+    The mapping between the grids is computed once and used in both directions: forward takes source data to the target grid and inverse takes target data back to the source grid.
+    Voxels mapping outside of the input volume are set to 0.
+    If every voxel of one grid falls exactly on a voxel of the other, resampling is replaced by transposing and flipping the axes.
+
+    Args:
+        source_affine (np.array): 4x4 affine of the source grid (e.g. the original scan)
+        source_shape (tuple): Shape of the source grid
+        target_affine (np.array): 4x4 affine of the target grid (e.g. the conformed space)
+        target_shape (tuple): Shape of the target grid
+        threads (int): Number of threads used. Defaults to the number of CPUs.
+        chunk (int): Number of output slices computed by each task
+    """
+
+    def __init__(self, source_affine, source_shape, target_affine, target_shape, threads=None, chunk=4):
+        self.source_shape = tuple(int(n) for n in source_shape[:3])
+        self.target_shape = tuple(int(n) for n in target_shape[:3])
+        # Maps target voxel coordinates to source voxel coordinates, and the other way around
+        self.mapping = np.linalg.inv(np.asarray(source_affine, dtype=float)).dot(np.asarray(target_affine, dtype=float))
+        self.inverse_mapping = np.linalg.inv(self.mapping)
+        self.reorders = {"forward": _axis_reorder(self.mapping, self.source_shape, self.target_shape),
+                         "inverse": _axis_reorder(self.inverse_mapping, self.target_shape, self.source_shape)}
+        self.threads = threads if threads is not None else (os.cpu_count() or 1)
+        self.chunk = chunk
+        self._steps = {}
+
+    @property
+    def is_reorder(self):
+        """Whether resampling only reorders the axes
+
+        Returns:
+            bool: True if the grids only differ by a permutation or flip of the axes
+        """
+        return self.reorders["forward"] is not None
+
+    def forward(self, data, order=1):
+        """Resamples source data to the target grid
+
+        Args:
+            data (np.array): Volume with the source shape
+            order (int): 1 for trilinear interpolation, 0 for nearest neighbour
+
+        Returns:
+            np.array: Volume with the target shape. float32 for trilinear, same type as the input for nearest neighbour.
+        """
+        return self._resample(data, "forward", order)
+
+    def inverse(self, data, order=0):
+        """Resamples target data back to the source grid
+
+        Args:
+            data (np.array): Volume with the target shape
+            order (int): 1 for trilinear interpolation, 0 for nearest neighbour
+
+        Returns:
+            np.array: Volume with the source shape. float32 for trilinear, same type as the input for nearest neighbour.
+        """
+        return self._resample(data, "inverse", order)
+
+    def _coordinate_steps(self, direction):
+        """Contribution of each output axis to the input coordinates.
+
+        The input coordinates of output voxel (i, j, k) are steps[0][i] + steps[1][j] + steps[2][k].
+        These are computed once per direction and shared by all chunks.
+
+        Args:
+            direction (str): "forward" or "inverse"
+
+        Returns:
+            tuple: Three float32 arrays of shape (output size along the axis, 3)
+        """
+        if direction not in self._steps:
+            if direction == "forward":
+                mapping, shape = self.mapping, self.target_shape
+            else:
+                mapping, shape = self.inverse_mapping, self.source_shape
+            steps = [np.arange(n)[:, np.newaxis] * mapping[:3, axis] for axis, n in enumerate(shape)]
+            steps[0] = steps[0] + mapping[:3, 3]
+            steps = [step.astype(np.float32) for step in steps]
+            self._steps[direction] = tuple(steps)
+        return self._steps[direction]
+
+    def _resample(self, data, direction, order):
+        """Resamples a volume in the given direction.
+
+        Args:
+            data (np.array): Input volume
+            direction (str): "forward" or "inverse"
+            order (int): 1 for trilinear interpolation, 0 for nearest neighbour
+
+        Returns:
+            np.array: Resampled volume
+        """
+        if direction == "forward":
+            input_shape, output_shape = self.source_shape, self.target_shape
+        else:
+            input_shape, output_shape = self.target_shape, self.source_shape
+        data = np.asanyarray(data)
+        if data.shape[:3] != input_shape or any(n != 1 for n in data.shape[3:]):
+            raise ValueError("Expected a volume of shape {}, got {}".format(input_shape, data.shape))
+        data = data.reshape(input_shape)
+        if order not in (0, 1):
+            raise ValueError("Only trilinear (1) and nearest neighbour (0) interpolation are supported")
+
+        reorder = self.reorders[direction]
+        if reorder is not None:
+            axes, flips = reorder
+            reordered = data.transpose(axes)[flips]
+            return reordered.astype(np.float32) if order == 1 else reordered.copy()
+
+        if order == 1:
+            source = np.ascontiguousarray(data, dtype=np.float32).reshape(-1)
+        else:
+            source = np.ascontiguousarray(data).reshape(-1)
+        steps = self._coordinate_steps(direction)
+        output = np.empty(output_shape, dtype=source.dtype)
+
+        def run(start):
+            stop = min(start + self.chunk, output_shape[0])
+            coordinates = [steps[0][start:stop, axis][:, np.newaxis, np.newaxis] +
+                           steps[1][:, axis][np.newaxis, :, np.newaxis] +
+                           steps[2][:, axis][np.newaxis, np.newaxis, :] for axis in range(3)]
+            if order == 1:
+                output[start:stop] = _trilinear(source, input_shape, coordinates)
+            else:
+                output[start:stop] = _nearest(source, input_shape, coordinates)
+
+        starts = range(0, output_shape[0], self.chunk)
+        if self.threads > 1:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                list(pool.map(run, starts))
+        else:
+            for start in starts:
+                run(start)
+        return output
+
+
+def _axis_reorder(mapping, input_shape, output_shape, tolerance=1e-3):
+    """Finds whether a mapping only permutes and flips the axes.
+
+    That is the case if each output axis runs along a single input axis (forwards or backwards) one voxel at a time, and the output grid exactly covers the input grid.
+
+    Args:
+        mapping (np.array): 4x4 affine from output voxel coordinates to input voxel coordinates
+        input_shape (tuple): Shape of the input grid
+        output_shape (tuple): Shape of the output grid
+        tolerance (float): Largest difference (in voxels) allowed with an exact reorder
+
+    Returns:
+        tuple: Axes to transpose the input by and slices flipping the transposed axes, or None if the mapping is not a reorder
+    """
+    linear, offset = mapping[:3, :3], mapping[:3, 3]
+    rounded = np.rint(linear)
+    if not np.allclose(linear, rounded, atol=tolerance) or abs(abs(np.linalg.det(rounded)) - 1) > tolerance:
+        return None
+    if not (np.abs(rounded).sum(axis=0) == 1).all():
+        return None
+    axes = tuple(int(np.flatnonzero(rounded[:, axis])[0]) for axis in range(3))
+    flips = []
+    for axis, input_axis in enumerate(axes):
+        n = input_shape[input_axis]
+        if output_shape[axis] != n:
+            return None
+        forwards = rounded[input_axis, axis] > 0
+        if abs(offset[input_axis] - (0 if forwards else n - 1)) > tolerance:
+            return None
+        flips.append(slice(None) if forwards else slice(None, None, -1))
+    return axes, tuple(flips)
+
+
+def _nearest(source, shape, coordinates):
+    """Nearest neighbour interpolation of a flattened volume.
+
+    Args:
+        source (np.array): Flattened input volume
+        shape (tuple): Shape of the input volume
+        coordinates (list): Input voxel coordinates along each axis of the points to interpolate
+
+    Returns:
+        np.array: Interpolated values, 0 outside of the volume
+    """
+    index = 0
+    outside = False
+    for coordinate, n in zip(coordinates, shape):
+        outside = outside | (coordinate < 0) | (coordinate > n - 1)
+        voxel = np.floor(coordinate + 0.5).astype(np.intp)
+        np.clip(voxel, 0, n - 1, out=voxel)
+        index = index * n + voxel
+    values = np.take(source, index)
+    values[outside] = 0
+    return values
+
+
+def _trilinear(source, shape, coordinates):
+    """Trilinear interpolation of a flattened volume.
+
+    The eight corners of each point are read as fixed offsets from the lowest one, so only one index array is needed.
+
+    Args:
+        source (np.array): Flattened float32 input volume
+        shape (tuple): Shape of the input volume
+        coordinates (list): Input voxel coordinates along each axis of the points to interpolate
+
+    Returns:
+        np.array: Interpolated float32 values, 0 outside of the volume
+    """
+    index = 0
+    outside = False
+    fractions = []
+    strides = []
+    for axis, (coordinate, n) in enumerate(zip(coordinates, shape)):
+        outside = outside | (coordinate < 0) | (coordinate > n - 1)
+        # The lowest corner is kept one voxel away from the end so the highest one is always inside
+        low = np.clip(np.floor(coordinate), 0, max(n - 2, 0))
+        fractions.append(coordinate - low)
+        index = index * n + low.astype(np.intp)
+        strides.append(int(np.prod(shape[axis + 1:])) if n > 1 else 0)
+
+    def corner(offset):
+        return np.take(source[offset:], index)
+
+    sx, sy, sz = strides
+    fx, fy, fz = fractions
+    along_z = [_lerp(corner(offset), corner(offset + sz), fz) for offset in (0, sy, sx, sx + sy)]
+    along_y = [_lerp(along_z[0], along_z[1], fy), _lerp(along_z[2], along_z[3], fy)]
+    values = _lerp(along_y[0], along_y[1], fx)
+    values[outside] = 0
+    return values
+
+
+def _lerp(low, high, fraction):
+    """Linear interpolation between two arrays, reusing the first one for the result."""
+    high -= low
+    high *= fraction
+    low += high
+    return low
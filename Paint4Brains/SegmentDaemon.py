@@ -0,0 +1,480 @@
+"""Paint4Brains Segmentation Daemon
+
+This file contains a local service running segmentations for every Paint4Brains window open on a machine.
+The daemon keeps one Segmenter with its models (and the Extractor) loaded, so several annotators on the same workstation share one copy of the models and never wait for them to load.
+Jobs are submitted over HTTP on localhost and run one at a time, by priority and then in the order they were submitted.
+Their status and progress can be followed, and they can be cancelled whether they are waiting or running.
+A job may ask for the device, backend and quantisation it has to run with: the daemon refuses it if they are not those of its models, so the client can run it somewhere else.
+Whether the job is checkpointed and computes a confidence map is chosen for each job.
+
+Attributes:
+    default_address (tuple): Host and port the daemon listens on by default.
+    kinds (tuple): Kinds of jobs the daemon runs.
+    job_settings (tuple): Settings of the Segmenter a job may ask for.
+
+Usage:
+    Start the daemon from the command line (see main for its options):
+
+        python -m Paint4Brains.SegmentDaemon --device cuda
+
+    The GUI submits its segmentations to it when it is running, through a DaemonClient.
+    The API can be used directly as well:
+
+        POST   /jobs?kind=segment&priority=0    npz body with volume, affine and optionally mask, returns the id of the job
+                                                optional device, backend, quantised, checkpoint and confidence (1 or 0) in the query,
+                                                409 if the models of the daemon do not match them
+        GET    /jobs/<id>                       status and progress of a job
+        GET    /jobs/<id>/result                npz with the labels (and confidence) or the brain mask
+        GET    /jobs/<id>/partial               npz with the latest partial labels
+        DELETE /jobs/<id>                       cancels a job, or forgets a finished one
+        GET    /status                          status of every job
+"""
+
+import io
+import sys
+import json
+import time
+import uuid
+import queue
+import argparse
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from Paint4Brains.Segmenter import Segmenter
+
+default_address = ("127.0.0.1", 8765)
+
+kinds = ("segment", "preview", "extract")
+
+job_settings = ("device", "backend", "quantised", "checkpoint", "confidence")
+
+
+class SegmentDaemon:
+    """SegmentDaemon class for Paint4Brains.
+
+    Owns a Segmenter and a priority queue of jobs, run one at a time by a background thread, and serves them over HTTP.
+    Each job keeps its inputs until it starts and its results until it is deleted.
+
+    Args:
+        segmenter (Segmenter): Segmenter running the jobs. Defaults to one keeping its models loaded. Its checkpoint and confidence settings apply to the jobs which do not choose their own.
+        address (tuple): Host and port to listen on. Only listen on localhost, the API has no authentication.
+    """
+
+    def __init__(self, segmenter=None, address=default_address):
+        if segmenter is None:
+            segmenter = Segmenter(keep_models=True)
+        self.segmenter = segmenter
+        # Used by the jobs which do not choose
+        self._defaults = {"checkpoint": segmenter.checkpoint, "confidence": segmenter.confidence}
+        self.jobs = {}
+        self.queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._current = None
+        self._worker = None
+        self.segmenter.subscribe(self._progress)
+        self.segmenter.subscribe_labels(self._partial)
+        self.server = ThreadingHTTPServer(address, _Handler)
+        self.server.daemon_threads = True
+        self.server.segment_daemon = self
+        self.address = self.server.server_address
+
+    def serve_forever(self):
+        """Runs the jobs and answers requests until shutdown is called."""
+        self.start()
+        self.server.serve_forever()
+
+    def start(self):
+        """Starts the thread running the jobs, if it is not running yet."""
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work, name="segment-daemon", daemon=True)
+            self._worker.start()
+
+    def shutdown(self):
+        """Stops answering requests, cancels the running job and stops the thread running the jobs."""
+        self.server.shutdown()
+        self.server.server_close()
+        with self._lock:
+            self.segmenter.run = False
+        # Sorted before every job
+        self.queue.put((-float("inf"), -1, None))
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    def submit(self, kind, arrays, priority=0, step=4, settings=None):
+        """Adds a job to the queue.
+
+        Args:
+            kind (str): "segment", "preview" or "extract"
+            arrays (dict): Inputs of the job: volume, affine (not needed to extract) and optionally mask
+            priority (int): Jobs with a lower priority run first
+            step (int): Step of a preview (see Segmenter.segment_preview)
+            settings (dict): Settings of the Segmenter the job asks for (see job_settings). Those not given are the daemon's.
+
+        Returns:
+            str: Id of the job
+        """
+        if kind not in kinds:
+            raise ValueError("Unknown job kind " + str(kind) + ", choose one of " + ", ".join(kinds))
+        if "volume" not in arrays or (kind != "extract" and "affine" not in arrays):
+            raise ValueError("A " + kind + " job needs a volume" + (" and an affine" if kind != "extract" else ""))
+        settings = dict(settings or {})
+        unknown = set(settings) - set(job_settings)
+        if unknown:
+            raise ValueError("Unknown job settings " + ", ".join(sorted(unknown)))
+        mismatch = self.mismatch(settings)
+        if mismatch is not None:
+            raise ValueError(mismatch)
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self.jobs[job_id] = {"id": job_id, "kind": kind, "priority": priority, "step": step, "settings": settings,
+                                 "status": "queued", "submitted": time.time(), "started": None, "finished": None,
+                                 "error": None, "progress": None, "inputs": arrays, "result": None, "partial": None,
+                                 "partial_version": 0, "forget": False, "sequence": next(self._sequence)}
+            self.queue.put((priority, self.jobs[job_id]["sequence"], job_id))
+        return job_id
+
+    def mismatch(self, settings):
+        """Why the models of the daemon can not run a job with some settings
+
+        The device, backend and quantisation are those of the models the daemon keeps loaded, so a job asking for others is refused.
+
+        Args:
+            settings (dict): Settings of the Segmenter the job asks for
+
+        Returns:
+            str: Reason the job is refused, or None if the daemon can run it
+        """
+        device = device_type(settings.get("device", self.segmenter.device))
+        if device != device_type(self.segmenter.device):
+            return "The daemon runs on " + device_type(self.segmenter.device) + ", not " + device
+        if settings.get("backend", self.segmenter.backend) != self.segmenter.backend:
+            return "The daemon runs the " + self.segmenter.backend + " backend, not " + str(settings["backend"])
+        # Only the CPU runs int8 models
+        quantised = bool(self.segmenter.quantised) and device == "cpu"
+        if (bool(settings.get("quantised", self.segmenter.quantised)) and device == "cpu") != quantised:
+            return "The daemon runs " + ("int8" if quantised else "float") + " models"
+        return None
+
+    def status(self, job_id=None):
+        """Status of a job, or of every job
+
+        Args:
+            job_id (str): Id of the job. If None, the status of every job is returned.
+
+        Returns:
+            dict: Status, progress, times, error and place in the queue of the job (None if it does not exist), or {"jobs": [...]}
+        """
+        with self._lock:
+            if job_id is None:
+                return {"jobs": [self._describe(job) for job in self.jobs.values()]}
+            if job_id not in self.jobs:
+                return None
+            return self._describe(self.jobs[job_id])
+
+    def result(self, job_id):
+        """Results of a finished job
+
+        Args:
+            job_id (str): Id of the job
+
+        Returns:
+            dict: Arrays computed by the job, or None if it has not finished successfully
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else job["result"]
+
+    def partial(self, job_id):
+        """Latest partial labels of a segmentation job
+
+        Args:
+            job_id (str): Id of the job
+
+        Returns:
+            np.array: Partial labels (see Segmenter.subscribe_labels), or None if there are none yet
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else job["partial"]
+
+    def cancel(self, job_id):
+        """Cancels a waiting or running job, or forgets a finished one.
+
+        Args:
+            job_id (str): Id of the job
+
+        Returns:
+            bool: Whether the job existed
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            if job["status"] == "queued":
+                job["status"] = "cancelled"
+                job["inputs"] = None
+                job["finished"] = time.time()
+            elif job["status"] == "running":
+                job["forget"] = True
+                self.segmenter.run = False
+            else:
+                del self.jobs[job_id]
+            return True
+
+    def _describe(self, job):
+        """JSON serialisable status of a job (called with the lock held)."""
+        ahead = None
+        if job["status"] == "queued":
+            ahead = sum(1 for other in self.jobs.values() if other["status"] in ("queued", "running") and
+                        (other["status"] == "running" or
+                         (other["priority"], other["sequence"]) < (job["priority"], job["sequence"])))
+        status = {key: job[key] for key in ("id", "kind", "priority", "status", "submitted", "started", "finished",
+                                            "error", "progress", "partial_version")}
+        status["ahead"] = ahead
+        return status
+
+    def _work(self):
+        """Runs the queued jobs one after the other."""
+        while True:
+            _, _, job_id = self.queue.get()
+            if job_id is None:
+                return
+            with self._lock:
+                job = self.jobs.get(job_id)
+                if job is None or job["status"] != "queued":
+                    continue
+                job["status"] = "running"
+                job["started"] = time.time()
+                self._current = job
+                self.segmenter.run = True
+            try:
+                result = self._run(job)
+            except Exception as exception:
+                status, result, error = "failed", None, str(exception)
+            else:
+                status, error = "done", None
+            with self._lock:
+                if job["forget"]:
+                    status, result = "cancelled", None
+                job.update(status=status, result=result, error=error, inputs=None, partial=None,
+                           finished=time.time())
+                if job["forget"]:
+                    self.jobs.pop(job_id, None)
+                self._current = None
+
+    def _run(self, job):
+        """Runs a job with the segmenter.
+
+        Args:
+            job (dict): Job to be run
+
+        Returns:
+            dict: Arrays computed by the job
+        """
+        arrays = job["inputs"]
+        # Jobs run one at a time, so the settings of the previous job are simply replaced
+        self.segmenter.checkpoint = job["settings"].get("checkpoint", self._defaults["checkpoint"])
+        self.segmenter.confidence = job["settings"].get("confidence", self._defaults["confidence"])
+        if job["kind"] == "extract":
+            return {"mask": self.segmenter.extract(arrays["volume"])}
+        mask = arrays.get("mask")
+        if job["kind"] == "preview":
+            labels = self.segmenter.segment_preview(arrays["volume"], arrays["affine"], mask, job["step"])
+        else:
+            labels = self.segmenter.segment_array(arrays["volume"], arrays["affine"], mask)
+        # QuickNAT has 33 classes
+        result = {"labels": labels.astype(np.uint8)}
+        if self.segmenter.confidence_map is not None:
+            result["confidence"] = self.segmenter.confidence_map
+        return result
+
+    def _progress(self, event):
+        """Keeps the latest progress of the running job."""
+        with self._lock:
+            if self._current is not None:
+                self._current["progress"] = {"stage": event.stage, "done": event.done, "total": event.total,
+                                             "elapsed": event.elapsed, "throughput": event.throughput}
+
+    def _partial(self, labels):
+        """Keeps the latest partial labels of the running job."""
+        with self._lock:
+            if self._current is not None:
+                self._current["partial"] = labels
+                self._current["partial_version"] += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Requests to a SegmentDaemon, which is available as self.server.segment_daemon."""
+
+    def do_GET(self):
+        daemon = self.server.segment_daemon
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if parts == ["status"]:
+            return self._send_json(daemon.status())
+        if len(parts) < 2 or parts[0] != "jobs":
+            return self._send_json({"error": "Not found"}, 404)
+        status = daemon.status(parts[1])
+        if status is None:
+            return self._send_json({"error": "No job " + parts[1]}, 404)
+        if len(parts) == 2:
+            return self._send_json(status)
+        if parts[2] == "result":
+            result = daemon.result(parts[1])
+            if result is None:
+                return self._send_json({"error": "The job is " + status["status"]}, 409)
+            return self._send_arrays(result)
+        if parts[2] == "partial":
+            partial = daemon.partial(parts[1])
+            if partial is None:
+                return self._send_json({"error": "No partial labels"}, 404)
+            return self._send_arrays({"labels": partial})
+        return self._send_json({"error": "Not found"}, 404)
+
+    def do_POST(self):
+        daemon = self.server.segment_daemon
+        url = urlparse(self.path)
+        if url.path.strip("/") != "jobs":
+            return self._send_json({"error": "Not found"}, 404)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            settings = parse_settings(query)
+            mismatch = daemon.mismatch(settings)
+            if mismatch is not None:
+                return self._send_json({"error": mismatch}, 409)
+            arrays = unpack_arrays(body)
+            job_id = daemon.submit(query.get("kind", "segment"), arrays, int(query.get("priority", 0)),
+                                   int(query.get("step", 4)), settings)
+        except ValueError as error:
+            return self._send_json({"error": str(error)}, 400)
+        return self._send_json({"id": job_id}, 201)
+
+    def do_DELETE(self):
+        daemon = self.server.segment_daemon
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "jobs" or not daemon.cancel(parts[1]):
+            return self._send_json({"error": "Not found"}, 404)
+        return self._send_json({"id": parts[1]})
+
+    def log_message(self, format, *args):
+        # Progress is polled several times a second, which would flood the terminal
+        pass
+
+    def _send_json(self, content, code=200):
+        self._send(json.dumps(content).encode(), "application/json", code)
+
+    def _send_arrays(self, arrays):
+        self._send(pack_arrays(arrays), "application/octet-stream")
+
+    def _send(self, body, content_type, code=200):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def device_type(device):
+    """Type of a device
+
+    Args:
+        device (str/int): Device, as given to the Segmenter ("cpu", "cuda", "cuda:1" or the id of a GPU)
+
+    Returns:
+        str: "cpu" or "cuda"
+    """
+    if isinstance(device, int) or str(device).isdigit():
+        return "cuda"
+    return str(device).split(":")[0]
+
+
+def parse_settings(query):
+    """Settings of a job from the query of its request
+
+    Args:
+        query (dict): Values of the query by name
+
+    Returns:
+        dict: Settings of the Segmenter asked for (see job_settings)
+    """
+    settings = {}
+    for name in ("device", "backend"):
+        if name in query:
+            settings[name] = query[name]
+    for name in ("quantised", "checkpoint", "confidence"):
+        if name in query:
+            if query[name] not in ("0", "1"):
+                raise ValueError(name + " has to be 0 or 1")
+            settings[name] = query[name] == "1"
+    return settings
+
+
+def pack_arrays(arrays):
+    """Arrays as the bytes of an uncompressed .npz file
+
+    Args:
+        arrays (dict): Arrays by name
+
+    Returns:
+        bytes: Content of the .npz file
+    """
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def unpack_arrays(content):
+    """Arrays from the bytes of an .npz file, as made by pack_arrays
+
+    Args:
+        content (bytes): Content of the .npz file
+
+    Returns:
+        dict: Arrays by name
+    """
+    try:
+        with np.load(io.BytesIO(content), allow_pickle=False) as stored:
+            return {name: stored[name] for name in stored.files}
+    except (OSError, ValueError) as error:
+        raise ValueError("Expected an .npz file: " + str(error))
+
+
+def main(arguments=None):
+    """Command line entry point
+
+    Starts a daemon serving segmentations until interrupted.
+
+    Args:
+        arguments (list): Command line arguments. Defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Serves Paint4Brains segmentations to the other processes of this machine.")
+    parser.add_argument("--host", default=default_address[0], help="Address to listen on. Keep it local.")
+    parser.add_argument("--port", type=int, default=default_address[1])
+    parser.add_argument("--device", default="cpu", help="cpu, cuda or the id of a GPU")
+    parser.add_argument("--backend", default="torch", help="Inference backend (torch or onnx)")
+    parser.add_argument("--quantised", action="store_true", help="Use the int8 models on the CPU")
+    parser.add_argument("--calibration-scans", nargs="+", default=None,
+                        help="Scans to calibrate the int8 models on, if they have not been built yet")
+    parser.add_argument("--threads", type=int, default=None, help="Number of threads the models run with")
+    parser.add_argument("--confidence", action="store_true",
+                        help="Compute confidence maps for the jobs which do not say whether they want one")
+    args = parser.parse_args(arguments)
+
+    device = int(args.device) if args.device.isdigit() else args.device
+    segmenter = Segmenter(device=device, backend=args.backend, quantised=args.quantised, threads=args.threads,
+                          calibration_scans=args.calibration_scans,
+                          confidence=args.confidence, checkpoint=device == "cpu", keep_models=True)
+    daemon = SegmentDaemon(segmenter, (args.host, args.port))
+    print("Serving segmentations on http://{}:{}".format(*daemon.address))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
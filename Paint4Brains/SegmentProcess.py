@@ -0,0 +1,315 @@
+"""Paint4Brains Segmentation Process
+
+This file contains a Segmenter which runs every segmentation (and brain extraction) in a separate worker process.
+The GUI process then never runs the models, so the Python parts of the pipeline do not compete with the interface for the GIL, and a crash of the model stack does not take the editor down.
+The volumes go to the worker process and the labels come back through shared arrays, so nothing large is pickled.
+Cancelling asks the worker to stop, so it can stop its own worker processes and remove its shared arrays.
+A worker which does not stop in time (e.g. while conforming the scan) is killed together with its own workers, and the shared arrays it created are removed for it.
+
+Usage:
+    It is used exactly like the Segmenter:
+
+        from Paint4Brains.SegmentProcess import SegmentProcess
+
+        segmentation_operation = SegmentProcess()
+
+        labels = segmentation_operation.segment_array(volume, affine)
+
+"""
+
+import os
+import time
+import uuid
+import queue
+import signal
+import threading
+import multiprocessing
+import nibabel as nib
+import numpy as np
+from Paint4Brains.Segmenter import Segmenter, confidence_dtype
+from Paint4Brains import SharedArray as shared_arrays
+from Paint4Brains.SharedArray import SharedArray
+
+
+class SegmentProcess(Segmenter):
+    """SegmentProcess class for Paint4Brains.
+
+    Segmenter whose segment_array, segment_preview and extract methods run in a new worker process for every call.
+    The worker creates a Segmenter with the same settings, and its progress events and partial labels are passed on to the subscribers of this one.
+    Setting run to False stops the worker process, which is killed if it has not stopped after stop_timeout seconds.
+    Takes the same arguments as the Segmenter.
+
+    Attributes:
+        stop_timeout (float): Seconds a cancelled worker has to stop before it is killed
+    """
+
+    stop_timeout = 30.
+
+    def segment_array(self, volume, affine, mask=None):
+        """In Memory Segmentation in a worker process
+
+        Same as Segmenter.segment_array. The labels and the confidence map are copied back from shared memory.
+
+        Args:
+            volume (np.array): 3-D scan to be segmented
+            affine (np.array): 4x4 affine of the scan
+            mask (np.array): Optional brain mask (e.g. from the Extractor) with the shape of the volume, non zero inside the brain
+
+        Returns:
+            labels (np.array): Labels with the shape and voxels of the volume
+        """
+        return self._segment_in_process("segment", volume, affine, mask)
+
+    def segment_preview(self, volume, affine, mask=None, step=4):
+        """Preview Segmentation in a worker process
+
+        Same as Segmenter.segment_preview.
+
+        Args:
+            volume (np.array): 3-D scan to be segmented
+            affine (np.array): 4x4 affine of the scan
+            mask (np.array): Optional brain mask (e.g. from the Extractor) with the shape of the volume, non zero inside the brain
+            step (int): Number of coronal slices each segmented slice stands for
+
+        Returns:
+            labels (np.array): Approximate labels with the shape and voxels of the volume
+        """
+        return self._segment_in_process("preview", volume, affine, mask, step)
+
+    def extract(self, volume):
+        """Brain Extraction in a worker process
+
+        Same as Segmenter.extract. TensorFlow is only ever loaded in the worker process.
+
+        Args:
+            volume (np.array): 3-D brain volume
+
+        Returns:
+            np.array: Probability of each voxel being brain tissue
+        """
+        self._start(1)
+        self._report("Extracting the brain")
+        arguments = {"volume": _share(volume)}
+        outputs = {"mask": SharedArray(np.shape(volume), np.float64)}
+        try:
+            self._in_process("extract", arguments, outputs)
+            self._done = 1
+            self._report("Finished extracting the brain")
+            return np.array(outputs["mask"].array)
+        finally:
+            _unlink(arguments, outputs)
+
+    def _settings(self):
+        """Arguments creating a Segmenter like this one in the worker process
+
+        Returns:
+            dict: Keyword arguments of the Segmenter
+        """
+        return {"device": self.device, "coronal_model_path": self.coronal_model_path,
+                "axial_model_path": self.axial_model_path, "instrument": self.instrumentation.enabled,
+                "quantised": self.quantised, "calibration_scans": self.calibration_scans, "backend": self.backend,
+                "threads": self.threads, "interop_threads": self.interop_threads, "workers": self.workers,
+                "concurrent_axes": self.concurrent_axes, "use_cache": self.use_cache,
+                "result_cache": self.result_cache, "conformed_cache": self.conformed_cache,
+                "checkpoint": self.checkpoint, "checkpoint_interval": self.checkpoint_interval,
+                "confidence": self.confidence, "partial_interval": self.partial_interval}
+
+    def _start(self, total):
+        """Resets the progress before a job.
+
+        Args:
+            total (int): Number of steps of the job, until the worker reports the real number
+        """
+        self._start_time = time.time()
+        self._inference_start = None
+        self._done = 0
+        self._resumed = 0
+        self._total = total
+
+    def _segment_in_process(self, job, volume, affine, mask, step=None):
+        """Runs segment_array or segment_preview in a worker process.
+
+        Args:
+            job (str): "segment" or "preview"
+            volume (np.array): 3-D scan to be segmented
+            affine (np.array): 4x4 affine of the scan
+            mask (np.array): Brain mask, or None
+            step (int): Step of the preview
+
+        Returns:
+            labels (np.array): Labels with the shape and voxels of the volume
+        """
+        volume = np.asanyarray(volume)
+        self._start(2 * 256)
+        self._report("Starting evaluation")
+        self.original = nib.Nifti1Image(volume, affine)
+        self.cache_metadata = None
+        self.confidence_map = None
+        arguments = {"volume": _share(volume), "mask": None if mask is None else _share(np.asarray(mask) > 0)}
+        # QuickNAT has 33 classes, and partial labels use 255 for the slices not segmented yet
+        outputs = {"labels": SharedArray(volume.shape, np.uint8)}
+        if self.confidence:
+            outputs["confidence"] = SharedArray(volume.shape, confidence_dtype)
+        if self.label_subscribers and job == "segment":
+            outputs["partial"] = SharedArray(volume.shape, np.uint8)
+        try:
+            result = self._in_process(job, dict(arguments, affine=np.asarray(affine), step=step), outputs)
+            self.cache_metadata = result["cache_metadata"]
+            self.instrumentation.records = result["records"]
+            if result["confidence"]:
+                self.confidence_map = np.array(outputs["confidence"].array)
+            return np.array(outputs["labels"].array, dtype=np.intp)
+        finally:
+            _unlink(arguments, outputs)
+
+    def _in_process(self, job, arguments, outputs):
+        """Runs a job in a new worker process, passing on its progress until it finishes.
+
+        Args:
+            job (str): "segment", "preview" or "extract"
+            arguments (dict): Arguments of the job, volumes being shared arrays
+            outputs (dict): Shared arrays the worker writes its results to
+
+        Returns:
+            dict: What the worker sent back when it finished
+        """
+        context = multiprocessing.get_context("spawn")
+        events = context.Queue()
+        stop = context.Event()
+        # Shared arrays created by the worker get their own prefix, so they can be removed if it has to be killed
+        prefix = shared_arrays.file_prefix + uuid.uuid4().hex[:12] + "_"
+        process = context.Process(target=_run_job, args=(job, self._settings(), arguments, outputs, events, stop,
+                                                         prefix), name="paint4brains-" + job)
+        process.start()
+        try:
+            while True:
+                if not self.run:
+                    self._stop(process, stop, prefix)
+                    self._done = 0
+                    self._report("Not running")
+                    raise (Exception("Segmentation has been killed"))
+                try:
+                    kind, value = events.get(timeout=0.1)
+                except queue.Empty:
+                    if process.is_alive():
+                        continue
+                    # The last messages of the worker may still be on their way
+                    try:
+                        kind, value = events.get(timeout=1)
+                    except queue.Empty:
+                        raise (Exception("The segmentation process stopped unexpectedly (exit code " +
+                                         str(process.exitcode) + ")"))
+                if kind == "progress":
+                    self.state = value.stage
+                    self.completion = value.completion
+                    self._done, self._total = value.done, value.total
+                    for callback in list(self.subscribers):
+                        callback(value)
+                elif kind == "labels":
+                    labels = np.array(outputs["partial"].array)
+                    for callback in list(self.label_subscribers):
+                        callback(labels)
+                elif kind == "error":
+                    raise (Exception(value))
+                else:
+                    return value
+        finally:
+            self._stop(process, stop, prefix)
+
+    def _stop(self, process, stop, prefix):
+        """Stops a worker process and waits for it.
+
+        The worker is asked to stop first. If it is still running after stop_timeout seconds, it is killed with every process it started, and its shared arrays are removed.
+
+        Args:
+            process (multiprocessing.Process): Worker process
+            stop (multiprocessing.Event): Event the worker stops on
+            prefix (str): Prefix of the shared arrays created by the worker
+        """
+        stop.set()
+        process.join(self.stop_timeout)
+        if process.is_alive():
+            try:
+                # The worker leads its own process group, which its own workers belong to as well
+                os.killpg(process.pid, signal.SIGKILL)
+            except (AttributeError, ProcessLookupError):
+                # Not on POSIX, or the worker was killed before it started its group
+                process.kill()
+            process.join()
+        shared_arrays.remove_shared(prefix)
+
+
+def _share(array):
+    """Copies an array to a new shared array.
+
+    Args:
+        array (np.array): Array to be shared
+
+    Returns:
+        SharedArray: Shared copy of the array
+    """
+    array = np.asanyarray(array)
+    shared = SharedArray(array.shape, array.dtype)
+    shared.array[:] = array
+    return shared
+
+
+def _unlink(*dictionaries):
+    """Removes the shared arrays in dictionaries of arguments and outputs."""
+    for dictionary in dictionaries:
+        for value in dictionary.values():
+            if isinstance(value, SharedArray):
+                value.unlink()
+
+
+def _run_job(job, settings, arguments, outputs, events, stop, prefix):
+    """Runs a job in the worker process.
+
+    The job stops like any segmentation, through the run attribute of its Segmenter, when the stop event is set.
+
+    Args:
+        job (str): "segment", "preview" or "extract"
+        settings (dict): Keyword arguments of the Segmenter
+        arguments (dict): Arguments of the job, volumes being shared arrays
+        outputs (dict): Shared arrays the results are written to
+        events (multiprocessing.Queue): Queue the progress, partial labels, results and errors are sent through
+        stop (multiprocessing.Event): Event set when the job has to stop
+        prefix (str): Prefix of the files of the shared arrays created by the job
+    """
+    if hasattr(os, "setpgrp"):
+        # Killing the process group of the worker then kills its own workers too
+        os.setpgrp()
+    shared_arrays.file_prefix = prefix
+    try:
+        segmenter = Segmenter(**settings)
+
+        def wait_for_stop():
+            stop.wait()
+            segmenter.run = False
+        threading.Thread(target=wait_for_stop, daemon=True).start()
+        segmenter.subscribe(lambda event: events.put(("progress", event)))
+        if "partial" in outputs:
+            def send_labels(labels):
+                outputs["partial"].array[:] = labels
+                events.put(("labels", None))
+            segmenter.subscribe_labels(send_labels)
+        volume = arguments["volume"].array
+        if job == "extract":
+            outputs["mask"].array[:] = segmenter.extract(volume)
+            events.put(("done", {}))
+            return
+        mask = None if arguments["mask"] is None else arguments["mask"].array
+        if job == "preview":
+            labels = segmenter.segment_preview(volume, arguments["affine"], mask, arguments["step"])
+        else:
+            labels = segmenter.segment_array(volume, arguments["affine"], mask)
+        outputs["labels"].array[:] = labels
+        has_confidence = "confidence" in outputs and segmenter.confidence_map is not None
+        if has_confidence:
+            outputs["confidence"].array[:] = segmenter.confidence_map
+        events.put(("done", {"cache_metadata": segmenter.cache_metadata, "confidence": has_confidence,
+                             "records": segmenter.instrumentation.records}))
+    except Exception as error:
+        events.put(("error", str(error)))
+    finally:
+        _unlink(arguments, outputs)
@@ -6,6 +6,13 @@ The functions and methods in this file were extracted from the several files ass
 Attributes:
     label_names (list): List of all labels corresponding to the different regions that QuickNAT is able to segment.
     new_affine (np.array): Homogenous affine giving relationship between voxel coordinates and world coordinates for the segmented files.
+    slice_axes (dict): Transposition of the conformed volume which puts the slices of each orientation along the first axis.
+    prediction_axes (dict): Transposition of the class probabilities which puts the slices of each orientation along the first axis.
+    axis_names (dict): Name of the axis of each orientation, used in progress messages.
+    conformed_shape (tuple): Shape of the conformed volumes.
+    mask_margin (int): Number of voxels kept around a brain mask when deciding which slices to segment.
+    confidence_dtype (np.dtype): Type of each voxel of a confidence map: the two most likely classes and their probabilities, quantised to 0-255.
+    unsegmented (int): Value of the voxels of partial labels which have not been segmented yet.
 
 Usage:
     To use this module, import it and instantiate is as you wish:
@@ -15,13 +22,39 @@ Usage:
         segmentation_operation = Segmenter(parameters)
 
         segmentation_operation.segment(file_path)
+
+    Scans already in memory can be segmented without going through the disk:
+
+        labels = segmentation_operation.segment_array(volume, affine)
+
+    The confidence of the labels can be kept too, to review the regions the models are unsure about:
+
+        segmentation_operation = Segmenter(confidence=True)
+        labels = segmentation_operation.segment_array(volume, affine)
+        uncertain = segmentation_operation.confidence_map["first_confidence"] < 128
+
+    A rough preview of the labels can be shown while waiting for the full segmentation:
+
+        preview = segmentation_operation.segment_preview(volume, affine)
+
+    The labels of the coronal slices already segmented can be followed as the segmentation runs:
+
+        segmentation_operation.subscribe_labels(show_partial_labels)
 """
 
 import os
+import time
+import queue
+import multiprocessing
 import nibabel as nib
-from nilearn.image import resample_img
 import numpy as np
 import torch
+from Paint4Brains.Instrumentation import Instrumentation
+from Paint4Brains.Resampler import AffineResampler
+from Paint4Brains.Backends import backends
+from Paint4Brains.SharedArray import SharedArray
+from Paint4Brains.DiskCache import DiskCache, hash_array, hash_file, hash_strings
+from Paint4Brains.Checkpoint import Checkpoint, default_checkpoint_folder
 
 label_names = ["vol_ID", "Background", "Left WM", "Left Cortex", "Left Lateral ventricle", "Left Inf LatVentricle",
                "Left Cerebellum WM", "Left Cerebellum Cortex", "Left Thalamus", "Left Caudate", "Left Putamen",
@@ -36,27 +69,148 @@ new_affine = np.array([[-1, 0., 0, 128],
                        [0., -1, 0, 128],
                        [0., 0., 0, 1]])
 
+slice_axes = {"COR": (2, 0, 1), "AXI": (1, 2, 0)}
+
+prediction_axes = {"COR": (3, 1, 0, 2), "AXI": (2, 1, 3, 0)}
+
+axis_names = {"COR": "coronal", "AXI": "axial"}
+
+conformed_shape = (256, 256, 256)
+
+mask_margin = 4
+
+unsegmented = 255
+
+confidence_dtype = np.dtype([("first", np.uint8), ("second", np.uint8),
+                             ("first_confidence", np.uint8), ("second_confidence", np.uint8)])
+
+
+class ProgressEvent:
+    """Segmentation progress event.
+
+    Structured description of how far a segmentation has got, sent to every subscriber of a Segmenter.
+
+    Args:
+        stage (str): Description of what the segmenter is currently doing
+        done (int): Number of slices already segmented
+        total (int): Total number of slices to be segmented
+        elapsed (float): Seconds since the segmentation started
+        throughput (float): Measured slices segmented per second (0 until the first slice is done)
+    """
+
+    def __init__(self, stage, done, total, elapsed, throughput):
+        self.stage = stage
+        self.done = done
+        self.total = total
+        self.elapsed = elapsed
+        self.throughput = throughput
+
+    @property
+    def completion(self):
+        """Percentage of slices segmented
+
+        Returns:
+            float: Completion between 0 and 100
+        """
+        return 100. * self.done / self.total if self.total else 0.
+
+    @property
+    def eta(self):
+        """Estimated time left
+
+        Returns:
+            float: Seconds until all slices are segmented, or None if there is no throughput measured yet
+        """
+        if self.throughput <= 0:
+            return None
+        return (self.total - self.done) / self.throughput
+
 
 class Segmenter:
     """Segmenter class for Paint4Brains.
 
     This class contains the main segmentation functions required for performing the segmentation operation.
+    Progress is reported by calling every subscribed function with a ProgressEvent (a queue's put method works too).
+    When instrumented, the wall time, CPU time and peak memory of every stage of the last segmentation are kept in self.instrumentation.
+    The slices of each axis can be shared between several worker processes, each running its own copy of the models with its own thread budget.
+    Their predictions are added to an accumulator in shared memory, so nothing but progress is sent back.
+    The coronal and axial passes can also run at the same time, each in its own processes and with its own accumulator (which takes another 1.1 GB of memory).
+    The accumulators are only added together before the argmax.
+    Labels are cached on disk, keyed by the content of the scan (and mask) and of the models, so segmenting the same scan again returns straight away.
+    Conformed volumes are cached too, so running other models or settings on a scan does not conform it again.
+    Long segmentations can be checkpointed: the predictions of every slice are kept on disk, so a cancelled or crashed segmentation resumes where it stopped.
+    Functions subscribed to the labels are sent the labels of the coronal slices segmented so far, every few seconds, while the coronal pass runs.
+    A quick preview of the labels can be segmented first, from one slice out of every few along the coronal axis only.
+    Instead of the full class probabilities (which would take the 1.1 GB of the accumulator), a compact confidence map can be kept: the two most likely classes of every voxel and their quantised probabilities, 4 bytes per voxel.
 
     Args:
         coronal_model_path (str): Path to the pre-trained coronal QuickNAT model
         axial_model_path (str): Path to the pre-trained axial QuickNAT model
         device (int/str): Device type used for training (int - GPU id, str- CPU)
+        instrument (bool): Whether the stages of each segmentation should be measured
+        quantised (bool): Whether the int8 versions of the models should be used when running on the CPU
+        calibration_scans (list): Paths of the scans the int8 models are calibrated on, needed when they have not been built yet
+        backend (str): Name of the inference backend running the models ("torch" or "onnx")
+        threads (int): Number of threads each process runs the models with (intra-op threads). If None, PyTorch and ONNX Runtime decide, or the CPUs are split between the workers.
+        interop_threads (int): Number of threads PyTorch runs independent operations with. If None, PyTorch decides.
+        workers (int): Number of worker processes sharing the slices of each axis. If 0, the slices are segmented in this process.
+        concurrent_axes (bool): Whether the coronal and axial passes should run at the same time. Uses two workers if workers is 0.
+        use_cache (bool): Whether cached labels and conformed volumes should be used and new ones stored. Set to False to always run everything.
+        result_cache (DiskCache): Cache of the labels. Defaults to the "results" cache in the default cache folder.
+        conformed_cache (DiskCache): Cache of the conformed volumes. Defaults to the "conformed" cache in the default cache folder.
+        checkpoint (bool): Whether the predictions should be checkpointed, and a previous checkpoint of the same segmentation resumed
+        checkpoint_interval (float): Seconds between saves of the slices segmented. The progress is also saved after each axis and when cancelled.
+        confidence (bool): Whether the confidence map of each segmentation should be kept in self.confidence_map (and saved next to the labels by segment)
+        partial_interval (float): Seconds between the partial labels sent to the functions subscribed to the labels
+        keep_models (bool): Whether the models (and the Extractor) should stay loaded between segmentations run in this process, e.g. in a long running service
 
     Returns:
         filename (str): The file name of the outputted segmentation file.
 
     """
 
-    def __init__(self, device="cpu", coronal_model_path=None, axial_model_path=None):
+    def __init__(self, device="cpu", coronal_model_path=None, axial_model_path=None, instrument=False,
+                 quantised=False, backend="torch", threads=None, interop_threads=None, workers=0,
+                 concurrent_axes=False, use_cache=True, result_cache=None, conformed_cache=None,
+                 checkpoint=False, checkpoint_interval=60., confidence=False,
+                 partial_interval=5., keep_models=False, calibration_scans=None):
         # Defining Values to be read by GUI:
         self.state = "Not running"
         self.completion = 0
         self.run = True
+        self.subscribers = []
+        self.label_subscribers = []
+        self._start_time = None
+        self._inference_start = None
+        self._done = 0
+        self._total = 0
+        self.instrumentation = Instrumentation(enabled=instrument)
+        self.quantised = quantised
+        self.calibration_scans = calibration_scans
+        if backend not in backends:
+            raise ValueError("Unknown inference backend " + str(backend) + ", choose one of " + ", ".join(backends))
+        self.backend = backend
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self.workers = workers
+        self.concurrent_axes = concurrent_axes
+        self.use_cache = use_cache
+        self.result_cache = result_cache if result_cache is not None else DiskCache("results")
+        self.conformed_cache = conformed_cache if conformed_cache is not None else DiskCache("conformed")
+        self.cache_metadata = None
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self._checkpoint = None
+        self._resumed = 0
+        self.confidence = confidence
+        self.confidence_map = None
+        self.partial_interval = partial_interval
+        self._partial = None
+        self._partial_box = None
+        self._published = 0.
+        self.keep_models = keep_models
+        self._backends = {}
+        self._extractor = None
 
         self.cuda_available = torch.cuda.is_available()
         # Take input;
@@ -72,105 +226,845 @@ class Segmenter:
         else:
             self.axial_model_path = axial_model_path
         self.original = None
+        self.resampler = None
+        self._pool = None
+        self._progress = None
+        self._volume = None
+        self._accumulators = {}
 
-    def _segment_over_one_axis(self, file_path, orientation):
+    def subscribe(self, callback):
+        """Progress subscriber
+
+        Registers a function to be called with a ProgressEvent every time the segmentation progresses.
+        Callbacks run in the thread doing the segmentation, so GUI code should forward them through a signal.
+
+        Args:
+            callback (function): Function taking a ProgressEvent
+        """
+        if callback not in self.subscribers:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Removes a previously subscribed progress callback
+
+        Args:
+            callback (function): Function previously passed to subscribe
+        """
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def subscribe_labels(self, callback):
+        """Partial labels subscriber
+
+        Registers a function to be called with the labels of the coronal slices segmented so far, while the coronal pass runs.
+        The labels have the shape and voxels of the scan, and are unsegmented where they are not known yet.
+        Callbacks run in the thread doing the segmentation, so GUI code should forward them through a signal.
+
+        Args:
+            callback (function): Function taking an np.array of uint8 labels
+        """
+        if callback not in self.label_subscribers:
+            self.label_subscribers.append(callback)
+
+    def unsubscribe_labels(self, callback):
+        """Removes a previously subscribed labels callback
+
+        Args:
+            callback (function): Function previously passed to subscribe_labels
+        """
+        if callback in self.label_subscribers:
+            self.label_subscribers.remove(callback)
+
+    def _record_partial(self, orientation, predictions, indices):
+        """Adds the labels of newly segmented slices to the partial labels, and sends them if it is time to.
+
+        Args:
+            orientation (str): String indicating the orientation of the slices (COR or AXI)
+            predictions (np.array): View of the accumulator with the slices of the orientation along the first axis
+            indices (iterable): Indices of the slices just segmented
+        """
+        if self._partial is None or orientation != "COR":
+            return
+        axes = slice_axes[orientation]
+        # Only the box is segmented, the rest of each slice is already background
+        crop = (slice(None), self._partial_box[axes[1]], self._partial_box[axes[2]])
+        partial = self._partial.transpose(axes)
+        for i in indices:
+            partial[i][crop[1:]] = np.argmax(predictions[i][crop], axis=0)
+        if time.time() - self._published > self.partial_interval:
+            self._publish_partial()
+
+    def _publish_partial(self):
+        """Sends the partial labels, brought back to the voxels of the scan, to every labels subscriber."""
+        if self._partial is None:
+            return
+        with self.instrumentation.stage("partial_labels"):
+            labels = self.resampler.inverse(self._partial, order=0)
+        self._published = time.time()
+        for callback in list(self.label_subscribers):
+            callback(labels)
+
+    def _report(self, stage=None):
+        """Sends a ProgressEvent to all subscribers.
+
+        Args:
+            stage (str): New stage of the segmentation. If None the stage stays the same.
+        """
+        if stage is not None:
+            self.state = stage
+        now = time.time()
+        elapsed = now - self._start_time if self._start_time is not None else 0.
+        throughput = 0.
+        # Slices restored from a checkpoint took no time, so they are not part of the throughput
+        if self._inference_start is not None and self._done > self._resumed and now > self._inference_start:
+            throughput = (self._done - self._resumed) / (now - self._inference_start)
+        event = ProgressEvent(self.state, self._done, self._total, elapsed, throughput)
+        self.completion = event.completion
+        for callback in list(self.subscribers):
+            callback(event)
+
+    def _segment_over_one_axis(self, volume, orientation, box=None):
 
         """Forward Segmentation Pass
 
         This function segments given volume along one orientation.
 
-        Given the file_path and orientation it returns the probability of each voxel being in one of the 33 possible classes.
+        Given the preprocessed volume and orientation it returns the probability of each voxel being in one of the 33 possible classes.
 
-        This function loads a volume for segmentation, preprocesses it and then performs a forward pass through the model.
+        The volume is shared by both orientations. It is only transposed (as a view) and wrapped in a tensor without copying, before performing a forward pass through the model.
+        Only the slices crossing the box are passed through the model, the rest are left empty.
+        Slices restored from a checkpoint are skipped.
 
         Args:
-            file_path (str): Path to the desired input brain file
+            volume (np.array): Conformed and normalised float32 volume, as returned by preprocess
             orientation (str): String indicating the input orientation of the file
+            box (tuple): Slices of the conformed volume containing the head, as returned by nonempty_box. If None, every slice is segmented.
 
         Updates:
             self.volume_prediction (np.array): Array containing the predicted labelled data probabilities.
         """
 
-        volume = load_and_preprocess(file_path, orientation=orientation)
-        volume = volume if len(
-            volume.shape) == 4 else volume[:, np.newaxis, :, :]
+        instrumentation = self.instrumentation
+        volume = torch.from_numpy(volume.transpose(slice_axes[orientation])).unsqueeze(1)
+        slices = range(len(volume))
+        if box is not None:
+            slices = range(box[slice_axes[orientation][0]].start, box[slice_axes[orientation][0]].stop)
+        if self._checkpoint is not None:
+            slices = self._checkpoint.remaining(orientation)
 
-        volume = torch.tensor(volume).type(torch.FloatTensor)
+        if len(slices) > 0:
+            with instrumentation.stage("model_load", axis=orientation):
+                self._report("Segmenting slices along the " + axis_names[orientation] + " axis")
+                model = self._backend(orientation)
+            if self._inference_start is None:
+                self._inference_start = time.time()
 
+            with instrumentation.stage("inference", axis=orientation, slices=len(slices)):
+                self._run_model(model, volume, slices, self.volume_prediction.transpose(prediction_axes[orientation]),
+                                orientation)
+            if self._checkpoint is not None:
+                self._checkpoint.save()
         if orientation == "COR":
-            self.state = "Segmenting slices along the coronal axis"
-            self.volume_prediction = self.volume_prediction.transpose((3, 1, 0, 2))
-            model = torch.load(self.coronal_model_path,
-                               map_location=torch.device(self.device))
-        elif orientation == "AXI":
-            self.state = "Segmenting slices along the axial axis"
-            self.volume_prediction = self.volume_prediction.transpose((2, 1, 3, 0))
-            model = torch.load(self.axial_model_path,
-                               map_location=torch.device(self.device))
+            self._publish_partial()
+        self._report("Finished segmentation along the " + axis_names[orientation] + " axis")
+
+    def _segment_in_workers(self, volume, orientations, box):
+        """Forward Segmentation Pass in worker processes
 
+        Same as _segment_over_one_axis, but the slices are split into contiguous shards shared by the workers.
+        Each worker maps the shared volume and accumulator, loads its own model and sends back how many slices it has segmented.
+        The workers write the predictions of a checkpoint, but only this process saves the progress.
+        When several orientations are given, they are all segmented at the same time, the workers being split between them.
+
+        Args:
+            volume (SharedArray): Conformed and normalised float32 volume, as returned by preprocess
+            orientations (tuple): Strings indicating the orientations to segment (COR and/or AXI)
+            box (tuple): Slices of the conformed volume containing the head, as returned by nonempty_box
+
+        Updates:
+            self._accumulators (dict): Shared arrays containing the predicted labelled data probabilities of each orientation.
+        """
+        names = " and ".join(axis_names[orientation] for orientation in orientations)
+        names += " axes" if len(orientations) > 1 else " axis"
+        shards_per_axis = -(-self._worker_count() // len(orientations))
+        shards = []
+        for orientation in orientations:
+            axis = slice_axes[orientation][0]
+            slices = np.arange(box[axis].start, box[axis].stop)
+            if self._checkpoint is not None:
+                slices = np.array(self._checkpoint.remaining(orientation), dtype=int)
+            shards += [(orientation, [int(i) for i in shard])
+                       for shard in np.array_split(slices, shards_per_axis) if len(shard) > 0]
+        total = sum(len(shard) for _, shard in shards)
+        if total == 0:
+            if "COR" in orientations:
+                self._publish_partial()
+            self._report("Finished segmentation along the " + names)
+            return
+
+        with self.instrumentation.stage("model_load", axis="+".join(orientations)):
+            self._report("Segmenting slices along the " + names)
+            # Files the backend needs are built here once, rather than by every worker at the same time
+            for orientation in orientations:
+                backends[self.backend].prepare(self, orientation)
+        if self._checkpoint is not None:
+            # The workers only open the prediction files, so they are created here before any shard is sent
+            self._checkpoint.prepare(orientations)
+        if self._inference_start is None:
+            self._inference_start = time.time()
+
+        with self.instrumentation.stage("inference", axis="+".join(orientations), slices=total,
+                                        workers=self._worker_count()):
+            settings = self._worker_settings()
+            results = [self._pool.apply_async(_segment_shard, (settings, orientation, shard, volume,
+                                                               self._accumulators[orientation], self._checkpoint))
+                       for orientation, shard in shards]
+            indices = {(orientation, shard[0]): shard for orientation, shard in shards}
+            done = {}
+            start = self._done
+            while not all(result.ready() for result in results):
+                if not self.run:
+                    self._done = 0
+                    self._report("Not running")
+                    self._pool.terminate()
+                    if self._checkpoint is not None:
+                        self._checkpoint.save()
+                    raise (Exception("Segmentation has been killed"))
+                try:
+                    shard, count = self._progress.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                # Late messages of a previous pass are ignored
+                if shard not in indices:
+                    continue
+                if self._partial is not None:
+                    self._record_partial(shard[0], self._accumulators[shard[0]].array.transpose(
+                        prediction_axes[shard[0]]), indices[shard][done.get(shard, 0):count])
+                done[shard] = count
+                if self._checkpoint is not None:
+                    self._checkpoint.mark(shard[0], indices[shard][:count])
+                self._done = start + sum(done.values())
+                self._report()
+            for result in results:
+                # Raises the errors of the workers here
+                result.get()
+            self._done = start + total
+            if self._checkpoint is not None:
+                for orientation, shard in shards:
+                    self._checkpoint.mark(orientation, shard)
+                self._checkpoint.save()
+            if "COR" in orientations and self._partial is not None:
+                # Slices whose last progress message was missed are added now
+                predictions = self._accumulators["COR"].array.transpose(prediction_axes["COR"])
+                self._record_partial("COR", predictions, [i for (orientation, first), shard in indices.items()
+                                                          if orientation == "COR"
+                                                          for i in shard[done.get((orientation, first), 0):]])
+                self._publish_partial()
+        self._report("Finished segmentation along the " + names)
+
+    def _worker_count(self):
+        """Number of worker processes used
+
+        Returns:
+            int: The workers setting, or one worker per axis when running the axes concurrently without it
+        """
+        if self.workers == 0 and self.concurrent_axes:
+            return len(slice_axes)
+        return self.workers
+
+    def _worker_settings(self):
+        """Arguments creating a Segmenter like this one in a worker process
+
+        Returns:
+            dict: Keyword arguments of the Segmenter
+        """
+        return {"device": self.device, "coronal_model_path": self.coronal_model_path,
+                "axial_model_path": self.axial_model_path, "quantised": self.quantised, "backend": self.backend,
+                "threads": self._worker_threads(), "calibration_scans": self.calibration_scans}
+
+    def _worker_threads(self):
+        """Thread budget of each worker process
+
+        Returns:
+            int: The threads setting if given, otherwise the CPUs split evenly between the workers
+        """
+        if self.threads is not None:
+            return self.threads
+        return max(1, (os.cpu_count() or 1) // max(self._worker_count(), 1))
+
+    def _backend(self, orientation):
+        """Inference backend running the model of an orientation
+
+        When keeping the models, the backend is only built the first time, for the current settings.
+
+        Args:
+            orientation (str): String indicating the orientation of the slices (COR or AXI)
+
+        Returns:
+            TorchBackend/OnnxBackend: Backend with the model loaded
+        """
+        if not self.keep_models:
+            return backends[self.backend](self, orientation)
+        model_path = self.coronal_model_path if orientation == "COR" else self.axial_model_path
+        key = (self.backend, orientation, model_path, str(self.device), self.quantised, self.threads)
+        if key not in self._backends:
+            self._backends[key] = backends[self.backend](self, orientation)
+        return self._backends[key]
+
+    def load_model(self, orientation):
+        """Model loader
+
+        Loads the model segmenting slices along the given orientation.
+        When running on the CPU in quantised mode, the cached int8 model is used instead (it is built from the calibration scans the first time).
+        Otherwise, the TorchScript export of the model is preferred to the checkpoint if it exists.
+
+        Args:
+            orientation (str): String indicating the orientation of the slices (COR or AXI)
+
+        Returns:
+            model (torch.nn.Module): Model in evaluation mode
+        """
+        model_path = self.coronal_model_path if orientation == "COR" else self.axial_model_path
+        # Imported here as ModelExport builds on top of this module
+        from Paint4Brains.ModelExport import load_quantised, scripted_path, load_checkpoint
+        if self.quantised and self.device == "cpu":
+            model = load_quantised(model_path, orientation, self.calibration_scans)
+        elif os.path.exists(scripted_path(model_path)):
+            model = torch.jit.load(scripted_path(model_path), map_location=torch.device(self.device))
+        else:
+            model = load_checkpoint(model_path, self.device)
         model.eval()
+        return model
 
-        for i in range(len(volume)):
+    def _run_model(self, model, volume, slices, predictions, orientation):
+        """Slice by slice inference
+
+        Adds the predictions of the model for the given slices of the volume to the accumulator, and records them in the checkpoint if there is one.
+
+        Args:
+            model (TorchBackend/OnnxBackend): Inference backend running the model of the axis being segmented
+            volume (torch.Tensor): Slices to be segmented, with shape (slices, 1, width, height)
+            slices (range): Indices of the slices to be segmented
+            predictions (np.array): View of self.volume_prediction with the slices of the axis along the first axis
+            orientation (str): String indicating the orientation of the slices (COR or AXI)
+        """
+        for i in slices:
             if not self.run:
-                self.state = "Not running"
-                self.completion = 0
-                # Killed segmentation so clearing memory
+                self._done = 0
+                self._report("Not running")
+                # Killed segmentation so clearing memory, the checkpoint keeps what has been done so far
                 self.volume_prediction = 0
+                if self._checkpoint is not None:
+                    self._checkpoint.save()
                 raise (Exception("Segmentation has been killed"))
-            self.completion = self.completion + 50 / 256
             batch_x = volume[i:i + 1]
-            if self.cuda_available and self.device == "cuda":
-                batch_x = batch_x.cuda(self.device)
-            self.volume_prediction[i] += np.squeeze(model(batch_x).cpu().numpy().astype(np.half))
+            prediction = np.squeeze(model.predict(batch_x).astype(np.half))
+            predictions[i] += prediction
+            if self._checkpoint is not None:
+                self._checkpoint.record(orientation, i, prediction)
+                self._checkpoint.mark(orientation, (i,))
+            self._record_partial(orientation, predictions, (i,))
+            self._done += 1
+            self._report()
 
-        if orientation == "COR":
-            self.volume_prediction = self.volume_prediction.transpose((2, 1, 3, 0))
-            self.state = "Finished segmentation along the coronal axis"
-        elif orientation == "AXI":
-            self.volume_prediction = self.volume_prediction.transpose((3, 1, 0, 2))
-            self.state = "Finished segmentation along the axial axis"
-
-    def segment(self, file_path):
+    def segment(self, file_path, mask=None):
         """Main Segmentation Operation
 
-        This function combines the segmentations from both axis to obtain the final result
+        This function combines the segmentations from both axis to obtain the final result, and saves it next to the input file.
+        If the segmenter keeps the confidence, the confidence map is saved next to it too, as <scan>_confidence.npy.
+        Slices outside of the head (or of the brain mask, if given) are not segmented, and everything outside of it is labelled as background.
+        If the segmenter is instrumented, the measurements of this call replace those of the previous one.
+        The thread budget of the segmenter only applies during this call, the previous PyTorch settings are restored afterwards.
 
         Args:
             file_path (str): Path to the desired input brain file
+            mask (np.array): Optional brain mask (e.g. from the Extractor) with the shape of the input file, non zero inside the brain
+
+        Returns:
+            filename (str): The file name of the outputted segmentation file.
+        """
+        return self._run(self._segment_file, file_path, mask)
+
+    def segment_array(self, volume, affine, mask=None):
+        """In Memory Segmentation
+
+        Same as segment, but the scan is given as an array and the labels are returned instead of being saved.
+        Nothing is read from or written to the disk, so unsaved or edited volumes can be segmented too.
+        The labels can be saved afterwards with save_labels.
+
+        Args:
+            volume (np.array): 3-D scan to be segmented
+            affine (np.array): 4x4 affine of the scan
+            mask (np.array): Optional brain mask (e.g. from the Extractor) with the shape of the volume, non zero inside the brain
+
+        Returns:
+            labels (np.array): Labels with the shape and voxels of the volume
+        """
+        return self._run(self._segment_image, nib.Nifti1Image(np.asanyarray(volume), affine), mask)
+
+    def segment_preview(self, volume, affine, mask=None, step=4):
+        """Preview Segmentation
+
+        Quickly segments an approximation of the labels returned by segment_array, to be shown while the full segmentation runs.
+        Only the coronal model is run, on one slice out of every step, and each of these slices stands for the slices closest to it.
+        This is about 2 * step times faster than the full segmentation. If the full labels are already cached, they are returned instead.
+        The preview always runs in this process and is neither cached nor checkpointed, but the conformed volume is cached so the full segmentation does not conform the scan again.
+
+        Args:
+            volume (np.array): 3-D scan to be segmented
+            affine (np.array): 4x4 affine of the scan
+            mask (np.array): Optional brain mask (e.g. from the Extractor) with the shape of the volume, non zero inside the brain
+            step (int): Number of coronal slices each segmented slice stands for
+
+        Returns:
+            labels (np.array): Approximate labels with the shape and voxels of the volume
+        """
+        return self._run(self._preview_image, nib.Nifti1Image(np.asanyarray(volume), affine), mask, step)
+
+    def extract(self, volume):
+        """Brain Extraction
+
+        Runs the Extractor (the deepbrain network) on a volume, giving the brain mask used to restrict segmentations.
+
+        Args:
+            volume (np.array): 3-D brain volume
+
+        Returns:
+            np.array: Probability of each voxel being brain tissue
+        """
+        # Imported here as the Extractor needs TensorFlow, which segmenting does not
+        from Paint4Brains.Extractor import Extractor
+        with self.instrumentation.stage("extract"):
+            extractor = self._extractor if self._extractor is not None else Extractor()
+            if self.keep_models:
+                self._extractor = extractor
+            return extractor.run(volume)
+
+    def save_labels(self, labels, file_path, original=None):
+        """Labels Saver
+
+        Saves labels returned by segment_array next to the scan they belong to, as <scan>_segmented.nii.gz.
+
+        Args:
+            labels (np.array): Labels with the shape of the scan
+            file_path (str): Path of the scan
+            original (Nifti1Image): Scan the labels belong to. Defaults to the last one segmented.
 
         Returns:
             filename (str): The file name of the outputted segmentation file.
         """
+        if original is None:
+            original = self.original
+        if ".gz" in file_path:
+            filename = file_path[:-7] + str('_segmented.nii.gz')
+        else:
+            filename = file_path[:-4] + str('_segmented.nii.gz')
+        with self.instrumentation.stage("save"):
+            nib.save(label_image(labels, original), filename)
+        return filename
+
+    def save_confidence(self, confidence_map, file_path):
+        """Confidence Map Saver
+
+        Saves a confidence map next to the scan it belongs to, as <scan>_confidence.npy.
+        The file is not compressed, so the viewer can map it and only read the slices it displays.
+
+        Args:
+            confidence_map (np.array): Confidence map with the shape of the scan, as kept in self.confidence_map
+            file_path (str): Path of the scan
+
+        Returns:
+            filename (str): The file name of the outputted confidence file.
+        """
+        if ".gz" in file_path:
+            filename = file_path[:-7] + str('_confidence.npy')
+        else:
+            filename = file_path[:-4] + str('_confidence.npy')
+        with self.instrumentation.stage("save_confidence"):
+            np.save(filename, confidence_map)
+        return filename
 
-        self.state = "Starting evaluation"
-        self.original = nib.load(file_path)
+    def _run(self, function, *args):
+        """Runs a segmentation function with the thread budget of the segmenter, measuring it as the segment stage.
 
-        self.volume_prediction = np.zeros((256, 33, 256, 256), dtype=np.half)
+        Args:
+            function (function): _segment_file, _segment_image or _preview_image
+            *args: Arguments of the function
+
+        Returns:
+            The result of the function
+        """
+        self._start_time = time.time()
+        self._inference_start = None
+        self._done = 0
+        self._resumed = 0
+        self._total = 2 * 256
+        self._report("Starting evaluation")
+        instrumentation = self.instrumentation
+        instrumentation.reset()
+        previous_threads = torch.get_num_threads()
+        set_thread_budget(self.threads, self.interop_threads)
+        try:
+            with instrumentation.stage("segment"), torch.no_grad():
+                result = function(*args)
+            self._report("Finished evaluation")
+            return result
+        finally:
+            torch.set_num_threads(previous_threads)
+            self._close_workers()
+            self._partial = None
+            if self._checkpoint is not None:
+                self._checkpoint.close()
+                self._checkpoint = None
 
-        with torch.no_grad():
-            self._segment_over_one_axis(file_path, orientation="COR")
-            self._segment_over_one_axis(file_path, orientation="AXI")
-            # Take the class with maximum probability
-            self.volume_prediction = np.argmax(self.volume_prediction, axis=1)
-            self.volume_prediction = np.squeeze(self.volume_prediction)
+    def _segment_file(self, file_path, mask):
+        """Loads, segments and saves a scan, as described in segment."""
+        with self.instrumentation.stage("load"):
+            original = nib.load(file_path)
+        labels = self._segment_image(original, mask)
+        self._report("Saving the segmented labels")
+        if self.confidence:
+            self.save_confidence(self.confidence_map, file_path)
+        return self.save_labels(labels, file_path, original)
 
-            nifti_img = nib.Nifti1Image(self.volume_prediction, new_affine)
-            to_save = undo_transform(nifti_img, self.original)
+    def _result_key(self, image_key, mask):
+        """Key of the labels of a scan in the result cache
 
-            if ".gz" in file_path:
-                filename = file_path[:-7] + str('_segmented.nii.gz')
+        Args:
+            image_key (str): Hash of the scan to be segmented, as returned by image_hash
+            mask (np.array): Brain mask, or None
+
+        Returns:
+            str: Hash of the scan, the mask, the model files and the settings changing the labels
+        """
+        models = [hash_file(path) if os.path.exists(path) else path
+                  for path in (self.coronal_model_path, self.axial_model_path)]
+        mask = hash_array(None if mask is None else np.asarray(mask) > 0)
+        return hash_strings(image_key, mask, *models, self.quantised and self.device == "cpu", self.backend)
+
+    def _segment_image(self, image, mask):
+        """Segments a scan in memory, as described in segment_array."""
+        instrumentation = self.instrumentation
+        self.original = image
+        self.cache_metadata = None
+        self.confidence_map = None
+        image_key = None
+        cached = None
+        if self.use_cache or self.checkpoint:
+            with instrumentation.stage("cache_lookup"):
+                image_key = image_hash(image)
+                key = self._result_key(image_key, mask)
+                if self.use_cache:
+                    cached = self.result_cache.get(key)
+            # Labels cached without their confidence are segmented again when the confidence is needed
+            if cached is not None and (self.confidence and "confidence" not in cached[0]):
+                cached = None
+            if cached is not None:
+                arrays, self.cache_metadata = cached
+                self.confidence_map = arrays.get("confidence")
+                self._done = self._total
+                self._report("Loaded the segmentation from the cache")
+                return arrays["labels"]
+        # The same mapping is used to conform the input and to bring the labels back
+        self.resampler = conforming_resampler(self.original)
+        with instrumentation.stage("preprocess"):
+            volume = preprocess(self.original, instrumentation, self.resampler,
+                                self.conformed_cache if self.use_cache else None, image_key)
+        box = self._segmentation_box(volume, mask)
+        self._total = sum(box[axes[0]].stop - box[axes[0]].start for axes in slice_axes.values())
+        self._report()
+        if self.checkpoint:
+            self._checkpoint = Checkpoint(os.path.join(default_checkpoint_folder, key), box, slice_axes,
+                                          interval=self.checkpoint_interval)
+        if self.label_subscribers:
+            self._partial = np.zeros(conformed_shape, dtype=np.uint8)
+            self._partial[box] = unsegmented
+            self._partial_box = box
+            self._published = time.time()
+
+        if self._worker_count():
+            self._open_workers(volume)
+            del volume
+            self._restore_checkpoint()
+            if self.concurrent_axes:
+                self._segment_in_workers(self._volume, ("COR", "AXI"), box=box)
             else:
-                filename = file_path[:-4] + str('_segmented.nii.gz')
-            nib.save(to_save, filename)
+                self._segment_in_workers(self._volume, ("COR",), box=box)
+                self._segment_in_workers(self._volume, ("AXI",), box=box)
+            self._combine_accumulators()
+        else:
+            self.volume_prediction = np.zeros((256, 33, 256, 256), dtype=np.half)
+            self._restore_checkpoint()
+            self._segment_over_one_axis(volume, orientation="COR", box=box)
+            self._segment_over_one_axis(volume, orientation="AXI", box=box)
+            del volume
+        # Take the class with maximum probability
+        self._report("Combining the segmentations of both axes")
+        if self.confidence:
+            with instrumentation.stage("confidence"):
+                # Everything outside of the box is background, with full confidence
+                confidence = np.zeros(conformed_shape, dtype=confidence_dtype)
+                confidence["first_confidence"] = 255
+                confidence[box] = top_two(self.volume_prediction[box[0], :, box[1], box[2]])
+        else:
+            with instrumentation.stage("argmax"):
+                self.volume_prediction = np.argmax(self.volume_prediction, axis=1)
+                self.volume_prediction = np.squeeze(self.volume_prediction)
+                # Everything outside of the box is background
+                labels = np.zeros_like(self.volume_prediction)
+                labels[box] = self.volume_prediction[box]
+
+        # Segmentation is done so we clear the memory
+        self.volume_prediction = 0
+        self._partial = None
+        if self._checkpoint is not None:
+            self._checkpoint.remove()
+            self._checkpoint = None
+        with instrumentation.stage("undo_transform"):
+            if self.confidence:
+                # The four bytes of each voxel are resampled together, and the labels are the most likely classes
+                confidence = self.resampler.inverse(confidence.view(np.uint32), order=0)
+                self.confidence_map = confidence.view(confidence_dtype)
+                labels = self.confidence_map["first"].astype(np.intp)
+            else:
+                labels = self.resampler.inverse(labels, order=0)
+
+        if self.use_cache:
+            with instrumentation.stage("cache_store"):
+                metadata = {"seconds": time.time() - self._start_time, "slices": self._total,
+                            "created": time.time(), "stages": instrumentation.results()["totals"]}
+                arrays = {"labels": labels}
+                if self.confidence_map is not None:
+                    arrays["confidence"] = self.confidence_map
+                self.result_cache.put(key, arrays, metadata)
+        return labels
+
+    def _segmentation_box(self, volume, mask):
+        """Slices of the conformed volume to be segmented
+
+        Args:
+            volume (np.array): Conformed volume, as returned by preprocess
+            mask (np.array): Brain mask with the shape of the scan, or None
+
+        Returns:
+            box (tuple): Box containing the head, or the brain mask with a margin, as returned by nonempty_box
+        """
+        with self.instrumentation.stage("bounding_box"):
+            if mask is None:
+                return nonempty_box(volume)
+            return nonempty_box(self.resampler.forward(np.asarray(mask) > 0, order=0), margin=mask_margin)
+
+    def _preview_image(self, image, mask, step):
+        """Segments a preview of a scan in memory, as described in segment_preview."""
+        instrumentation = self.instrumentation
+        self.original = image
+        self.cache_metadata = None
+        self.confidence_map = None
+        image_key = None
+        if self.use_cache:
+            with instrumentation.stage("cache_lookup"):
+                image_key = image_hash(image)
+                cached = self.result_cache.get(self._result_key(image_key, mask))
+            if cached is not None:
+                arrays, self.cache_metadata = cached
+                self.confidence_map = arrays.get("confidence")
+                self._done = self._total
+                self._report("Loaded the segmentation from the cache")
+                return arrays["labels"]
+        self.resampler = conforming_resampler(self.original)
+        with instrumentation.stage("preprocess"):
+            volume = preprocess(self.original, instrumentation, self.resampler,
+                                self.conformed_cache if self.use_cache else None, image_key)
+        box = self._segmentation_box(volume, mask)
+        start, stop = box[slice_axes["COR"][0]].start, box[slice_axes["COR"][0]].stop
+        sampled = range(start, stop, step)
+        self._total = len(sampled)
+        self._report()
+
+        labels = np.zeros(conformed_shape, dtype=np.uint8)
+        if len(sampled) > 0:
+            with instrumentation.stage("model_load", axis="COR"):
+                self._report("Segmenting a preview along the coronal axis")
+                model = self._backend("COR")
+            self._inference_start = time.time()
+            slices = torch.from_numpy(volume.transpose(slice_axes["COR"])).unsqueeze(1)
+            previews = np.empty((len(sampled),) + slices.shape[2:], dtype=np.uint8)
+            with instrumentation.stage("inference", axis="COR", slices=len(sampled)):
+                for n, i in enumerate(sampled):
+                    if not self.run:
+                        self._done = 0
+                        self._report("Not running")
+                        raise (Exception("Segmentation has been killed"))
+                    previews[n] = np.argmax(model.predict(slices[i:i + 1])[0], axis=0)
+                    self._done += 1
+                    self._report()
+            # Every slice of the box takes the labels of the closest segmented slice
+            closest = np.minimum((np.arange(start, stop) - start + step // 2) // step, len(sampled) - 1)
+            labels.transpose(slice_axes["COR"])[start:stop] = previews[closest]
+            # Everything outside of the box is background
+            inside = labels[box].copy()
+            labels[:] = 0
+            labels[box] = inside
+        del volume
+        with instrumentation.stage("undo_transform"):
+            return self.resampler.inverse(labels, order=0).astype(np.intp)
+
+    def _restore_checkpoint(self):
+        """Adds the predictions saved in the checkpoint by a previous run to the accumulators, if there are any."""
+        if self._checkpoint is None:
+            return
+        for orientation in slice_axes:
+            if self._accumulators:
+                accumulator = self._accumulators[orientation].array
+            else:
+                accumulator = self.volume_prediction
+            predictions = accumulator.transpose(prediction_axes[orientation])
+            self._resumed += self._checkpoint.restore(orientation, predictions)
+            self._record_partial(orientation, predictions, sorted(self._checkpoint.done[orientation]))
+        if self._resumed > 0:
+            self._done = self._resumed
+            self._report("Resumed " + str(self._resumed) + " slices from a checkpoint")
+
+    def _open_workers(self, volume):
+        """Starts the worker processes and copies the volume to shared memory.
+
+        The workers are started with spawn, which works the same on every platform and does not copy the memory of the GUI.
+
+        Args:
+            volume (np.array): Conformed and normalised float32 volume, as returned by preprocess
+        """
+        self._volume = SharedArray(volume.shape, np.float32)
+        self._volume.array[:] = volume
+        accumulator = SharedArray((256, 33, 256, 256), np.half)
+        self._accumulators = {"COR": accumulator, "AXI": accumulator}
+        if self.concurrent_axes:
+            # Both axes write at the same time, so each needs its own accumulator
+            self._accumulators["AXI"] = SharedArray((256, 33, 256, 256), np.half)
+        self.volume_prediction = accumulator.array
+        context = multiprocessing.get_context("spawn")
+        self._progress = context.Queue()
+        self._pool = context.Pool(self._worker_count(), initializer=_start_worker,
+                                  initargs=(self._progress, self._worker_threads(), self.interop_threads))
+
+    def _close_workers(self):
+        """Stops the worker processes and removes the shared arrays, if there are any."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._volume is not None:
+            self._volume.unlink()
+            self._volume = None
+        for accumulator in set(self._accumulators.values()):
+            accumulator.unlink()
+        self._accumulators = {}
+
+    def _combine_accumulators(self, chunk=16):
+        """Adds the predictions of the axial accumulator to the coronal one, if they are separate.
+
+        This is done a few slices at a time, so no temporary copy of the whole accumulator is made.
+
+        Args:
+            chunk (int): Number of slices added at a time
+        """
+        coronal, axial = self._accumulators["COR"].array, self._accumulators["AXI"].array
+        if coronal is axial:
+            return
+        for start in range(0, len(coronal), chunk):
+            coronal[start:start + chunk] += axial[start:start + chunk]
+
+
+def set_thread_budget(threads=None, interop_threads=None):
+    """Thread budget
+
+    Limits the number of threads PyTorch uses in this process.
+
+    Args:
+        threads (int): Number of intra-op threads. If None, it is left as it is.
+        interop_threads (int): Number of inter-op threads. If None, it is left as it is.
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # PyTorch only allows this before its first parallel operation, which is why workers set it at start up
+            pass
+
+
+_progress = None
+
+
+def _start_worker(progress, threads, interop_threads):
+    """Initialises a worker process of a Segmenter.
+
+    Args:
+        progress (multiprocessing.Queue): Queue the progress of the worker is sent through
+        threads (int): Number of intra-op threads of the worker
+        interop_threads (int): Number of inter-op threads of the worker
+    """
+    global _progress
+    _progress = progress
+    set_thread_budget(threads, interop_threads)
+
+
+def _segment_shard(settings, orientation, indices, volume, accumulator, checkpoint=None):
+    """Segments a shard of slices in a worker process.
+
+    Args:
+        settings (dict): Keyword arguments of the Segmenter, as returned by Segmenter._worker_settings
+        orientation (str): String indicating the orientation of the slices (COR or AXI)
+        indices (list): Indices of the slices of the shard
+        volume (SharedArray): Conformed and normalised float32 volume
+        accumulator (SharedArray): Class probabilities the predictions are added to
+        checkpoint (Checkpoint): Checkpoint the predictions are recorded in, if any
+    """
+    segmenter = Segmenter(**settings)
+    segmenter._checkpoint = checkpoint
+    shard = (orientation, indices[0])
+    segmenter.subscribe(lambda event: _progress.put((shard, event.done)))
+    model = backends[segmenter.backend](segmenter, orientation)
+    slices = torch.from_numpy(np.asarray(volume.array).transpose(slice_axes[orientation])).unsqueeze(1)
+    predictions = accumulator.array.transpose(prediction_axes[orientation])
+    with torch.no_grad():
+        segmenter._run_model(model, slices, indices, predictions, orientation)
+    if checkpoint is not None:
+        checkpoint.close()
+    volume.unlink()
+    accumulator.unlink()
+
 
-            self.state = "Finished evaluation"
+def top_two(scores, chunk=8):
+    """Two most likely classes
 
-            # Segmentation is done so we clear the memory
-            self.volume_prediction = 0
-            return filename
+    Turns the summed scores of both axes into probabilities (softmax of their mean) and keeps the two most likely classes of every voxel.
+    This is done a few slices at a time in float32, so no copy of the whole accumulator is made.
 
+    Args:
+        scores (np.array): Scores of shape (slices, classes, width, height), summed over both axes
+        chunk (int): Number of slices converted at a time
+
+    Returns:
+        np.array: Array of confidence_dtype and shape (slices, width, height), with probabilities quantised to 0-255
+    """
+    result = np.empty((scores.shape[0],) + scores.shape[2:], dtype=confidence_dtype)
+    for start in range(0, len(scores), chunk):
+        probabilities = np.asarray(scores[start:start + chunk], dtype=np.float32) / 2
+        probabilities -= probabilities.max(axis=1, keepdims=True)
+        np.exp(probabilities, out=probabilities)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        block = result[start:start + chunk]
+        for rank in ("first", "second"):
+            classes = np.argmax(probabilities, axis=1)[:, np.newaxis]
+            block[rank] = classes[:, 0]
+            block[rank + "_confidence"] = np.rint(np.take_along_axis(probabilities, classes, axis=1)[:, 0] * 255)
+            # The most likely class is left out when looking for the second one
+            np.put_along_axis(probabilities, classes, -1, axis=1)
+    return result
 
-def load_and_preprocess(file_path, orientation):
+
+def load_and_preprocess(file_path, orientation, instrumentation=None):
     """Load & Preprocess
 
     This function is composed of two other function calls: one that calls a function loading the data, and another which preprocesses the data to the required format.
@@ -179,6 +1073,7 @@ def load_and_preprocess(file_path, orientation):
     Args:
         file_paths (list): List containing the input data and target labelled output data
         orientation (str): String detailing the current view (COR, SAG, AXL)
+        instrumentation (Instrumentation): Optional instrumentation recording the time spent in each step
 
     Returns:
         volume (np.array): Array of training image data of data type dtype.
@@ -186,59 +1081,152 @@ def load_and_preprocess(file_path, orientation):
         original (class): 'nibabel.nifti1.Nifti1Image' class object, containing the original input volume
     """
 
-    original = nib.load(file_path)
-    volume_nifty = transform(original)
-    volume = volume_nifty.get_fdata()
-    volume = (volume - np.min(volume)) / (np.max(volume) - np.min(volume))
-    if orientation == "COR":
-        volume = volume.transpose((2, 0, 1))
-    elif orientation == "AXI":
-        volume = volume.transpose((1, 2, 0))
+    if instrumentation is None:
+        instrumentation = Instrumentation(enabled=False)
+    with instrumentation.stage("load"):
+        original = nib.load(file_path)
+    volume = preprocess(original, instrumentation)
+    return volume.transpose(slice_axes[orientation])
+
+
+def nonempty_box(volume, margin=0):
+    """Bounding box of the non zero voxels
+
+    Args:
+        volume (np.array): 3D array
+        margin (int): Number of voxels added around the box on each side
+
+    Returns:
+        box (tuple): Tuple of three slices selecting the box. If the volume is empty, the box is empty too.
+    """
+    box = []
+    for axis in range(volume.ndim):
+        others = tuple(other for other in range(volume.ndim) if other != axis)
+        filled = np.flatnonzero(np.any(volume, axis=others))
+        if len(filled) == 0:
+            return tuple(slice(0, 0) for _ in range(volume.ndim))
+        box.append(slice(max(int(filled[0]) - margin, 0), min(int(filled[-1]) + 1 + margin, volume.shape[axis])))
+    return tuple(box)
+
+
+def conforming_resampler(image):
+    """Conformation Resampler
+
+    Creates the resampler mapping an image to the conformed space and back.
+
+    Args:
+        image (Nifti1Image): Input image to be conformed
+
+    Returns:
+        resampler (AffineResampler): Resampler between the voxels of the image and the conformed voxels
+    """
+    return AffineResampler(image.affine, image.shape, new_affine, conformed_shape)
+
+
+def image_hash(image):
+    """Content hash of an image
+
+    Args:
+        image (Nifti1Image): Image to be hashed
+
+    Returns:
+        str: Hash of the voxels and affine of the image
+    """
+    return hash_array(np.asanyarray(image.dataobj), image.affine)
+
+
+def preprocess(image, instrumentation=None, resampler=None, cache=None, key=None):
+    """Preprocessing Function
+
+    Conforms the image and normalises its intensities between 0 and 1.
+    This only needs to be done once per segmentation, both orientations use the same volume.
+    The conformed volume only depends on the image, so it can be cached and reused by later runs with other models or settings.
+
+    Args:
+        image (Nifti1Image): Input image to be segmented
+        instrumentation (Instrumentation): Optional instrumentation recording the time spent in each step
+        resampler (AffineResampler): Resampler to the conformed space. If None, a new one is created.
+        cache (DiskCache): Optional cache of conformed volumes
+        key (str): Hash of the image, as returned by image_hash. Computed if needed and not given.
+
+    Returns:
+        volume (np.array): Conformed float32 array of shape (256, 256, 256), with values between 0 and 1
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation(enabled=False)
+    data = None
+    if cache is not None:
+        with instrumentation.stage("conformed_cache_lookup"):
+            if key is None:
+                key = image_hash(image)
+            # The conformed space is part of the key, in case it ever changes
+            key = hash_strings(key, hash_array(new_affine), conformed_shape)
+            cached = cache.get(key)
+        if cached is not None:
+            data = cached[0]["conformed"]
+    if data is None:
+        data = np.asanyarray(transform(image, instrumentation, resampler).dataobj)
+        if cache is not None:
+            with instrumentation.stage("conformed_cache_store"):
+                # The affine and shape of the source define the mapping back from the conformed space
+                metadata = {"source_affine": np.asarray(image.affine).tolist(), "source_shape": list(image.shape[:3])}
+                cache.put(key, {"conformed": data}, metadata)
+    with instrumentation.stage("normalise"):
+        minimum, maximum = data.min(), data.max()
+        volume = np.subtract(data, minimum, dtype=np.float32)
+        volume /= np.float32(maximum - minimum)
     return volume
 
 
-def transform(image):
+def transform(image, instrumentation=None, resampler=None):
     """Conformation Function
 
     This function takes a brain extracted image and conforms it to [256, 256, 256] and 1 mm^3 voxel size just like Freesurfer's mri_conform function
+    As in mri_conform, the intensities are resampled with trilinear interpolation.
 
     Args:
         image (Nifti1Image): Input image to be conformed.
+        instrumentation (Instrumentation): Optional instrumentation recording the time spent resampling and correcting the intensity
+        resampler (AffineResampler): Resampler to the conformed space. If None, a new one is created.
 
     Returns:
         transformed_image (Nifti1Image): Conformed image. 
 
     """
 
-    shape = (256, 256, 256)
-    # creating new image with the new affine and shape
-    new_img = resample_img(image, new_affine, target_shape=shape)
+    if instrumentation is None:
+        instrumentation = Instrumentation(enabled=False)
+    if resampler is None:
+        resampler = conforming_resampler(image)
+    # resampling the data to the new affine and shape
+    with instrumentation.stage("resample"):
+        data = resampler.forward(np.asanyarray(image.dataobj), order=1)
     # change orientation
     orientation = nib.orientations.axcodes2ornt(
-        nib.aff2axcodes(new_img.affine))
+        nib.aff2axcodes(new_affine))
     target_orientation = np.array([[0., -1.], [2., -1.], [1., 1.]])
     transformation = nib.orientations.ornt_transform(
         orientation, target_orientation)
-    data = new_img.get_fdata()
-    data = np.rint(data / np.max(data) * 255)
-    # Putting log correction back in. But estimating the magic number by fitting to some conformed brains.
-    # These values are therefore empirical (potentially need to improve them, but better than hardcoded)
-    var = np.var(data)
-    magic_number = 0.15 + 0.0002874 * var + \
-                   7.9317 / var - 2.986 / np.mean(data)
-    scale = (np.max(data) - np.min(data))
-    data = np.log2(1 + data.astype(float) / scale) * \
-           scale * np.clip(magic_number, 0.9, 1.6)
-    data = np.rint(np.clip(data, 0, 255))  # Ensure values do not go over 255
-    # Continues as before from here
-    data = data.astype(np.uint8)
+    with instrumentation.stage("intensity_correction"):
+        data = np.rint(data / np.max(data) * 255)
+        # Putting log correction back in. But estimating the magic number by fitting to some conformed brains.
+        # These values are therefore empirical (potentially need to improve them, but better than hardcoded)
+        var = np.var(data)
+        magic_number = 0.15 + 0.0002874 * var + \
+                       7.9317 / var - 2.986 / np.mean(data)
+        scale = (np.max(data) - np.min(data))
+        data = np.log2(1 + data.astype(float) / scale) * \
+               scale * np.clip(magic_number, 0.9, 1.6)
+        data = np.rint(np.clip(data, 0, 255))  # Ensure values do not go over 255
+        # Continues as before from here
+        data = data.astype(np.uint8)
 
     new_tran = nib.orientations.apply_orientation(data, transformation)
     transformed_image = nib.Nifti1Image(new_tran, new_affine)
     return transformed_image
 
 
-def undo_transform(mask, original):
+def undo_transform(mask, original, resampler=None):
     """Undo transforation
 
     Function which reverts a previously performed transformation.
@@ -246,14 +1234,32 @@ def undo_transform(mask, original):
     Args:
         mask (Nifti1Image): Image to be reverted to a previous state
         original (Nifti1Image): The original model which serves as a reference
+        resampler (AffineResampler): Resampler used to conform the original image. If None, a new one is created from the mask.
 
     Returns:
         new_mask (Nifti1Image): The reverted image
 
     """
-    shape = original.get_data().shape
-    new_mask = resample_img(mask, original.affine,
-                            target_shape=shape, interpolation='nearest')
+    if resampler is None:
+        resampler = AffineResampler(original.affine, original.shape, mask.affine, mask.shape)
+    labels = resampler.inverse(np.asanyarray(mask.dataobj), order=0)
+    return label_image(labels, original)
+
+
+def label_image(labels, original):
+    """Labels Image
+
+    Wraps labels in a nifti image with the affine of the scan they belong to.
+
+    Args:
+        labels (np.array): Labels with the shape of the original image
+        original (Nifti1Image): The original image which serves as a reference
+
+    Returns:
+        new_mask (Nifti1Image): The labels image
+
+    """
+    new_mask = nib.Nifti1Image(labels, original.affine)
     # Adds a description to the nifti image
 
     new_mask.header["descrip"] = np.array(
@@ -0,0 +1,103 @@
+"""Paint4Brains Shared Arrays
+
+This file contains a numpy array which can be shared between processes without copying it.
+The array is backed by a file, in shared memory (/dev/shm) when there is enough room there, so every process mapping it sees the same data.
+Pickling a SharedArray (e.g. to send it to a worker process) only sends the name of its file.
+
+Usage:
+    To use this module, import it and instantiate it as you wish:
+
+        from Paint4Brains.SharedArray import SharedArray
+
+        shared = SharedArray((256, 256, 256), np.float32)
+        shared.array[:] = volume
+
+        pool.apply_async(function_using_the_array, (shared,))
+
+        shared.unlink()
+
+Attributes:
+    file_prefix (str): Prefix of the files of the shared arrays created by this process. A worker process can be given its own, so the files it leaves behind when killed can be found with remove_shared.
+"""
+
+import os
+import glob
+import shutil
+import tempfile
+import numpy as np
+
+file_prefix = "paint4brains_"
+
+
+def shared_folder(size):
+    """Folder where shared arrays are stored
+
+    Args:
+        size (int): Size in bytes of the array to be stored
+
+    Returns:
+        str: /dev/shm if it can hold the array, the temporary folder otherwise
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        if shutil.disk_usage("/dev/shm").free > 2 * size:
+            return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def remove_shared(prefix):
+    """Removes the files of the shared arrays whose names start with a prefix
+
+    Used to clean up after a process which was killed before it could unlink its shared arrays.
+
+    Args:
+        prefix (str): Prefix of the files, as set in file_prefix by the process which created them
+
+    Returns:
+        int: Number of files removed
+    """
+    removed = 0
+    for folder in {"/dev/shm", tempfile.gettempdir()}:
+        for path in glob.glob(os.path.join(folder, glob.escape(prefix) + "*")):
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+class SharedArray:
+    """SharedArray class for Paint4Brains.
+
+    Numpy array mapped from a file which other processes can map too.
+    A new array is filled with zeros. Only the process that created it removes the file when unlinking.
+
+    Args:
+        shape (tuple): Shape of the array
+        dtype (np.dtype): Type of the array
+        path (str): File of an existing shared array to be mapped. If None, a new one is created.
+    """
+
+    def __init__(self, shape, dtype, path=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = path is None
+        if path is None:
+            size = int(np.prod(self.shape)) * self.dtype.itemsize
+            handle, path = tempfile.mkstemp(prefix=file_prefix, suffix=".npy", dir=shared_folder(size))
+            os.close(handle)
+        self.path = path
+        self.array = np.memmap(path, dtype=self.dtype, mode="w+" if self.owner else "r+", shape=self.shape)
+
+    def __getstate__(self):
+        # The dtype itself is sent, as its string loses the fields of structured types
+        return {"shape": self.shape, "dtype": self.dtype, "path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["shape"], state["dtype"], state["path"])
+
+    def unlink(self):
+        """Releases the array, removing its file if this process created it."""
+        self.array = None
+        if self.owner and os.path.exists(self.path):
+            os.remove(self.path)
@@ -44,4 +44,9 @@ setup(
         'scikit-image',
         'nn_common_modules @ https://github.com/shayansiddiqui/nn-common-modules/releases/download/v1.0/nn_common_modules-1.0-py2.py3-none-any.whl',
         ],
+    extras_require={
+        # Exporting the models to ONNX and running them with ONNX Runtime (Segmenter(backend="onnx"))
+        # Recent versions of PyTorch export to ONNX through torch.export, which needs onnxscript
+        'onnx': ['onnx>=1.6.0', 'onnxruntime>=1.1.0', 'onnxscript; python_version >= "3.9"'],
+        },
 )
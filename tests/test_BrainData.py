@@ -3,6 +3,7 @@ import unittest
 import numpy as np
 
 from Paint4Brains.BrainData import BrainData
+from Paint4Brains.Segmenter import unsegmented
 
 
 class TestBrainData(unittest.TestCase):
@@ -122,6 +123,41 @@ class TestBrainData(unittest.TestCase):
         os.remove(save_file)
         test_brain.other_labels_data = np.zeros(test_brain.shape)
 
+    def test_setting_labels_in_memory(self):
+        """testing labels given in the orientation of the file (as segment_array returns them).
+        """
+        test_brain = BrainData(self.filename)
+        matrix = np.random.randint(0, 12, test_brain.shape)
+
+        # going to the orientation of the file and back changes nothing
+        assert np.array_equal(test_brain.from_native(test_brain.to_native(matrix)), matrix)
+
+        test_brain.set_label_data(test_brain.to_native(matrix))
+        labels = np.where(test_brain.label_data == 1, test_brain.current_label, test_brain.other_labels_data)
+        assert np.array_equal(labels, matrix)
+
+    def test_partial_labels(self):
+        """testing the slices of a running segmentation are merged into the labels without losing the stroke being painted
+        """
+        test_brain = BrainData(self.filename)
+        matrix = np.random.randint(0, 12, test_brain.shape)
+        test_brain.set_label_data(test_brain.to_native(matrix))
+        test_brain.i = 10
+        test_brain.paint(np.array([3, 4]), np.array([6, 6]), 1)
+        before = np.where(test_brain.label_data == 1, test_brain.current_label, test_brain.other_labels_data)
+
+        partial = np.full(test_brain.shape, unsegmented, dtype=np.uint8)
+        partial[:5] = 20
+        new = test_brain.set_partial_labels(test_brain.to_native(partial))
+        assert new[:5].all() and not new[5:].any()
+        labels = np.where(test_brain.label_data == 1, test_brain.current_label, test_brain.other_labels_data)
+        assert np.array_equal(labels, np.where(partial != unsegmented, partial, before))
+        assert 20 in test_brain.different_labels
+        assert test_brain.dirty_box is not None
+
+        # Nothing new has been segmented
+        assert not test_brain.set_partial_labels(test_brain.to_native(partial)).any()
+
     def test_voxel_to_mouse(self):
         """testing transformation from 2D mouse pointer position to 3D voxel location
         """
@@ -209,3 +245,67 @@ class TestBrainData(unittest.TestCase):
 
         assert self.brain.label_data[x2, y2, z2] == 0
         assert self.brain.label_data[x, y, z] == 1
+
+    def test_dropping_oldest_edit(self):
+        """testing painted edits stay undoable once older edits are dropped, whatever label they were painted with"""
+        test_brain = BrainData(self.filename)
+        test_brain.set_label_data(test_brain.to_native(np.random.randint(0, 5, test_brain.shape)))
+        test_brain.store_edit()
+        test_brain.edits_recorded = 3
+        test_brain.i = 10
+
+        def labels():
+            return np.where(test_brain.label_data == 1, test_brain.current_label, test_brain.other_labels_data)
+
+        # The stored copy was split for label 1, the strokes are painted with label 3
+        test_brain.current_label = 3
+        states = []
+        for row in (2, 4, 6):
+            test_brain.paint(np.array([3, 4, 5]), np.array([row, row, row]), 1)
+            test_brain.store_edit()
+            states.append(labels())
+
+        # Loading new labels drops the copy, the first stroke being applied to it
+        test_brain.set_label_data(test_brain.to_native(np.random.randint(0, 5, test_brain.shape)))
+        test_brain.store_edit()
+        assert test_brain.undo_edit()
+        assert np.array_equal(labels(), states[2])
+        assert test_brain.undo_edit() and test_brain.undo_edit()
+        assert np.array_equal(labels(), states[0])
+
+    def test_painting(self):
+        """testing painting, the dirty region and undoing painted edits"""
+        test_brain = BrainData(self.filename)
+        test_brain.i = 10
+
+        for section in range(3):
+            test_brain.section = section
+
+            # Paint a short line in the current view
+            mouse_x = np.array([3, 4, 5])
+            mouse_y = np.array([6, 6, 6])
+            test_brain.paint(mouse_x, mouse_y, 1)
+
+            # Check it was written into the 3D labels
+            voxels = test_brain.position_as_voxel(mouse_x, mouse_y)
+            assert np.all(test_brain.label_data[voxels] == 1)
+
+            # Check the dirty region contains exactly the painted voxels
+            region = test_brain.dirty_region
+            assert np.sum(test_brain.label_data[region]) == 3
+            assert np.sum(test_brain.label_data) == 3
+
+            # Rubbing out one of them
+            test_brain.paint(mouse_x[:1], mouse_y[:1], -1)
+            assert np.sum(test_brain.label_data) == 2
+            test_brain.store_edit()
+            assert test_brain.dirty_box is None
+
+            # Undo and redo the stroke
+            assert test_brain.undo_edit()
+            assert np.sum(test_brain.label_data) == 0
+            assert test_brain.redo_edit()
+            assert np.sum(test_brain.label_data) == 2
+
+            # Leave the labels empty for the next view
+            test_brain.undo_edit()
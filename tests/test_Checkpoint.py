@@ -0,0 +1,72 @@
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from Paint4Brains.Checkpoint import Checkpoint
+
+slice_axes = {"COR": (2, 0, 1), "AXI": (1, 2, 0)}
+
+
+class TestCheckpoint(unittest.TestCase):
+    """Test saving and restoring the predictions of a Checkpoint
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.box = (slice(2, 10), slice(3, 12), slice(1, 7))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_resume(self):
+        """testing saved slices are restored and the other ones are left to segment
+        """
+        checkpoint = Checkpoint(self.folder, self.box, slice_axes, classes=4, interval=None)
+        predictions = np.random.rand(5, 4, 16, 16).astype(np.half)
+        for i in (1, 2, 3):
+            checkpoint.record("COR", i, predictions[i])
+        checkpoint.mark("COR", (1, 2, 3))
+        # Recorded but not saved as done, it has to be segmented again
+        checkpoint.record("COR", 4, predictions[4])
+        checkpoint.save()
+        checkpoint.mark("COR", (4,))
+        checkpoint.close()
+
+        resumed = Checkpoint(self.folder, self.box, slice_axes, classes=4, interval=None)
+        assert resumed.remaining("COR") == [4, 5, 6]
+        assert resumed.remaining("AXI") == list(range(3, 12))
+        accumulator = np.zeros((16, 4, 16, 16), dtype=np.half)
+        assert resumed.restore("COR", accumulator) == 3
+        for i in (1, 2, 3):
+            # Only the part of the slice inside the box is kept
+            assert np.array_equal(accumulator[i][:, 2:10, 3:12], predictions[i][:, 2:10, 3:12])
+        assert not accumulator[i][:, :2].any()
+
+    def test_other_box_starts_again(self):
+        """testing a checkpoint of a different box is not resumed
+        """
+        checkpoint = Checkpoint(self.folder, self.box, slice_axes, classes=4, interval=None)
+        checkpoint.mark("AXI", (3, 4))
+        checkpoint.save()
+        other = Checkpoint(self.folder, (slice(0, 10), slice(3, 12), slice(1, 7)), slice_axes, classes=4)
+        assert other.remaining("AXI") == list(range(3, 12))
+
+    def test_workers_only_open_prepared_files(self):
+        """testing an unpickled checkpoint (as sent to a worker) writes to the prepared files and never creates them
+        """
+        checkpoint = Checkpoint(self.folder, self.box, slice_axes, classes=4, interval=None)
+        worker = pickle.loads(pickle.dumps(checkpoint))
+        with self.assertRaises(Exception):
+            worker.record("COR", 2, np.zeros((4, 16, 16), dtype=np.half))
+        checkpoint.prepare(("COR", "AXI"))
+        prediction = np.random.rand(4, 16, 16).astype(np.half)
+        worker = pickle.loads(pickle.dumps(checkpoint))
+        worker.record("COR", 2, prediction)
+        worker.close()
+        checkpoint.mark("COR", (2,))
+        checkpoint.save()
+        accumulator = np.zeros((16, 4, 16, 16), dtype=np.half)
+        assert Checkpoint(self.folder, self.box, slice_axes, classes=4).restore("COR", accumulator) == 1
+        assert np.array_equal(accumulator[2][:, 2:10, 3:12], prediction[:, 2:10, 3:12])
@@ -0,0 +1,52 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from Paint4Brains.DiskCache import DiskCache, hash_array
+
+
+class TestDiskCache(unittest.TestCase):
+    """Test the storage, eviction and keys of the DiskCache
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = DiskCache("test", folder=self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_put_and_get(self):
+        """testing entries come back as they were stored
+        """
+        labels = np.random.randint(0, 33, (20, 30, 40))
+        assert self.cache.get("missing") is None
+        self.cache.put("key", {"labels": labels}, {"seconds": 1.5})
+        arrays, metadata = self.cache.get("key")
+        assert np.array_equal(arrays["labels"], labels)
+        assert metadata == {"seconds": 1.5}
+
+    def test_least_recently_used_evicted(self):
+        """testing the entries used longest ago are removed first when the cache is too large
+        """
+        for key in ("a", "b", "c"):
+            self.cache.put(key, {"data": np.random.rand(1000)})
+        # Making sure the entries have distinct use times
+        for age, key in enumerate(("b", "a", "c")):
+            os.utime(os.path.join(self.cache.folder, key + ".npz"), (time.time() - 100 + age, time.time() - 100 + age))
+        self.cache.max_size = self.cache.size() - 1
+        self.cache.evict()
+        assert self.cache.get("b") is None
+        assert self.cache.get("a") is not None and self.cache.get("c") is not None
+
+    def test_hash_array(self):
+        """testing keys change with the content, type and shape of the arrays
+        """
+        volume = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+        assert hash_array(volume, np.eye(4)) == hash_array(volume.copy(), np.eye(4))
+        assert hash_array(volume, np.eye(4)) != hash_array(volume, 2 * np.eye(4))
+        assert hash_array(volume) != hash_array(volume.reshape(4, 3, 2))
+        assert hash_array(volume) != hash_array(volume.astype(np.float64))
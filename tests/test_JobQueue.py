@@ -0,0 +1,107 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+import nibabel as nib
+
+from Paint4Brains.JobQueue import JobQueue
+from Paint4Brains.Segmenter import Segmenter
+from test_Segmenter import save_model, synthetic_scan
+
+
+def claim_all(folder, worker):
+    """Claims and completes jobs until none is left, as a worker process would."""
+    queue = JobQueue(folder, worker=worker)
+    finished = []
+    while True:
+        description = queue.claim()
+        if description is None:
+            return finished
+        time.sleep(0.01)
+        queue.complete(description, {"outputs": {}, "started": time.time(), "finished": time.time(), "wall": 0.01})
+        finished.append(description["id"])
+
+
+class TestJobQueue(unittest.TestCase):
+    """Test claiming the jobs of a JobQueue from several workers
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.scans = [os.path.join(self.folder, "scan_" + str(i) + ".nii.gz") for i in range(12)]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_workers_share_jobs(self):
+        """testing every job is run exactly once by several worker processes
+        """
+        queue = JobQueue(self.folder)
+        jobs = queue.add(self.scans)
+        assert queue.add(self.scans) == []
+        with multiprocessing.get_context("spawn").Pool(3) as pool:
+            finished = pool.starmap(claim_all, [(self.folder, "worker-" + str(i)) for i in range(3)])
+        claimed = [job for worker in finished for job in worker]
+        assert sorted(claimed) == sorted(jobs)
+        status = queue.status()
+        assert status["done"] == 12 and status["queued"] == 0 and status["running"] == 0
+
+    def test_reclaim_dead_worker(self):
+        """testing the job of a worker which stopped refreshing its lock is taken over, and failed after too many attempts
+        """
+        dead = JobQueue(self.folder, stale_after=0.5, max_attempts=2, worker="dead")
+        dead.add(self.scans[:1])
+        first = dead.claim()
+        other = JobQueue(self.folder, stale_after=0.5, max_attempts=2, worker="other")
+        assert other.claim() is None
+        assert other.status()["workers"] == ["dead"]
+        time.sleep(1)
+        second = other.claim()
+        assert second["id"] == first["id"] and second["attempt"] == 2
+        assert not dead.heartbeat(first["id"])
+        time.sleep(1)
+        assert dead.claim() is None
+        assert dead.status()["failed"] == 1
+
+    def test_refreshed_lock_is_not_reclaimed(self):
+        """testing a lock refreshed before being moved away is put back, and the job is still its worker's
+        """
+        owner = JobQueue(self.folder, stale_after=0.5, worker="owner")
+        owner.add(self.scans[:1])
+        job = owner.claim()["id"]
+        other = JobQueue(self.folder, stale_after=0.5, worker="other")
+        # The lock looked stale when it was checked, but was refreshed just before being moved
+        assert not other._reclaim(job, time.time())
+        assert owner.heartbeat(job)
+        assert other.status()["workers"] == ["owner"]
+        assert owner._attempts(job) == 0
+        # Another worker's lock is never removed by this one
+        other.release(job)
+        assert owner.heartbeat(job)
+
+    def test_taken_over_job_is_not_written(self):
+        """testing a worker whose job is taken over while it runs stops it without writing or recording anything
+        """
+        folder = tempfile.mkdtemp()
+        try:
+            model_path = save_model(folder)
+            volume, affine = synthetic_scan()
+            nib.save(nib.Nifti1Image(volume, affine), self.scans[0])
+            output = os.path.join(self.folder, "labels")
+            slow = JobQueue(self.folder, stale_after=60, heartbeat_interval=0.05, worker="slow")
+            slow.add(self.scans[:1], output_folder=output)
+            segmenter = Segmenter(coronal_model_path=model_path, axial_model_path=model_path, use_cache=False)
+
+            def take_over(event):
+                if event.stage.startswith("Segmenting"):
+                    other = JobQueue(self.folder, stale_after=0, worker="other")
+                    assert other.claim() is not None
+            segmenter.subscribe(take_over)
+            assert slow.work(segmenter) == []
+            assert not os.path.exists(output)
+            status = slow.status()
+            assert status["done"] == 0 and status["failed"] == 0 and status["workers"] == ["other"]
+        finally:
+            shutil.rmtree(folder)
@@ -0,0 +1,185 @@
+import os
+import copy
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import nibabel as nib
+import torch
+from torch import nn
+
+from Paint4Brains import ModelExport
+from Paint4Brains.ModelExport import quantise, quantised_path, dice_report, QuantisedConv, export_torchscript, onnx_path
+from Paint4Brains.ModelExport import load_quantised, fold_batch_norms, scan_slices
+from Paint4Brains.Backends import TorchBackend, OnnxBackend, onnxruntime
+from Paint4Brains.Segmenter import Segmenter
+from test_Segmenter import synthetic_scan
+
+
+class TinySegmenter(nn.Module):
+    """Small stand in for QuickNAT, mixing convolutions with operations that stay in float
+    """
+
+    def __init__(self):
+        super(TinySegmenter, self).__init__()
+        self.conv1 = nn.Conv2d(1, 8, 5, padding=2)
+        self.batchnorm = nn.BatchNorm2d(8)
+        self.prelu = nn.PReLU()
+        self.pool = nn.MaxPool2d(2, return_indices=True)
+        self.unpool = nn.MaxUnpool2d(2)
+        self.classifier = nn.Conv2d(8, 33, 1)
+
+    def forward(self, input):
+        out, indices = self.pool(self.prelu(self.batchnorm(self.conv1(input))))
+        return self.classifier(self.unpool(out, indices))
+
+
+class TestModelExport(unittest.TestCase):
+    """Test the int8 quantisation of the models
+    """
+    torch.manual_seed(0)
+    model = TinySegmenter().eval()
+    slices = [torch.rand(1, 1, 32, 32) for _ in range(8)]
+
+    def test_quantised_path(self):
+        """testing the quantised models are cached next to the originals
+        """
+        assert quantised_path("models/coronal.pth.tar") == "models/coronal.int8.pth.tar"
+        assert quantised_path("models/coronal.pt") == "models/coronal.int8.pth.tar"
+
+    def test_quantise(self):
+        """testing quantisation keeps the outputs and predictions close to the float model
+        """
+        quantised = quantise(self.model, self.slices)
+        assert isinstance(quantised.conv1, QuantisedConv)
+        assert isinstance(self.model.conv1, nn.Conv2d)
+        with torch.no_grad():
+            expected = self.model(self.slices[0])
+            output = quantised(self.slices[0])
+        assert output.dtype == torch.float32
+        assert (output - expected).abs().mean() < 0.02 * (expected.max() - expected.min())
+
+        report = dice_report(self.model, quantised, self.slices)
+        assert len(report) > 0
+        assert np.mean(list(report.values())) > 0.5
+
+    def test_load_quantised(self):
+        """testing the quantised model is calibrated on the given scans once, then loaded from its cache without them
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            model_path = os.path.join(folder, "model.pth.tar")
+            torch.save(self.model, model_path)
+            scan = os.path.join(folder, "scan.nii.gz")
+            nib.save(nib.Nifti1Image(*synthetic_scan()), scan)
+            with self.assertRaises(FileNotFoundError):
+                load_quantised(model_path, "COR")
+            quantised = load_quantised(model_path, "COR", [scan], every=16)
+            assert os.path.exists(quantised_path(model_path))
+            segmenter = Segmenter(coronal_model_path=model_path, axial_model_path=model_path, quantised=True)
+            cached = segmenter.load_model("COR")
+            batch = torch.rand(1, 1, 64, 64)
+            with torch.no_grad():
+                assert torch.equal(cached(batch), quantised(batch))
+
+            # Retraining the model makes the cache stale
+            retrained = copy.deepcopy(self.model)
+            with torch.no_grad():
+                for parameter in retrained.parameters():
+                    parameter.mul_(1.5)
+            torch.save(retrained, model_path)
+            with self.assertRaises(FileNotFoundError):
+                load_quantised(model_path, "COR")
+            with self.assertWarns(UserWarning):
+                rebuilt = load_quantised(model_path, "COR", [scan], every=16)
+            with torch.no_grad():
+                assert not torch.equal(rebuilt(batch), quantised(batch))
+                assert torch.equal(load_quantised(model_path, "COR")(batch), rebuilt(batch))
+
+    def test_held_out_slices(self):
+        """testing the slices held out for the report are exactly those left out of the calibration
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            scan = os.path.join(folder, "scan.nii.gz")
+            nib.save(nib.Nifti1Image(*synthetic_scan()), scan)
+            calibration = list(scan_slices([scan], "COR", every=4))
+            held_out = list(scan_slices([scan], "COR", every=4, held_out=True))
+            everything = list(scan_slices([scan], "COR"))
+        assert len(calibration) > 0 and len(held_out) == len(everything) - len(calibration)
+        # One slice in every four is used for calibration, the three others are held out
+        assert torch.equal(held_out[0], everything[1]) and torch.equal(held_out[3], everything[5])
+
+    def test_export_torchscript(self):
+        """testing the exported TorchScript model gives the same outputs as the original one
+        """
+        model = nn.Sequential(nn.Conv2d(1, 8, 5, padding=2), nn.BatchNorm2d(8), nn.PReLU(), nn.Conv2d(8, 33, 1)).eval()
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "model.torchscript.pt")
+            export_torchscript(model, path, shape=(1, 1, 32, 32))
+            scripted = torch.jit.load(path)
+        with torch.no_grad():
+            for batch in self.slices:
+                assert torch.allclose(scripted(batch), model(batch), atol=1e-5)
+
+    def test_export_skipped_without_gain(self):
+        """testing nothing is exported on a PyTorch which can not freeze, unless batch norms can be folded
+        """
+        unfoldable = nn.Sequential(nn.Conv2d(1, 8, 5, padding=2), nn.PReLU(), nn.BatchNorm2d(8),
+                                   nn.Conv2d(8, 33, 3, padding=1)).eval()
+        foldable = nn.Sequential(nn.Conv2d(1, 8, 5, padding=2), nn.BatchNorm2d(8), nn.PReLU(),
+                                 nn.Conv2d(8, 33, 1)).eval()
+        with tempfile.TemporaryDirectory() as folder, mock.patch.object(ModelExport, "torch_version",
+                                                                        return_value=(1, 4)):
+            path = os.path.join(folder, "model.torchscript.pt")
+            with self.assertWarns(UserWarning):
+                assert export_torchscript(unfoldable, path, shape=(1, 1, 32, 32)) is None
+            assert not os.path.exists(path)
+            assert export_torchscript(foldable, path, shape=(1, 1, 32, 32)) is not None
+            assert os.path.exists(path)
+
+    def test_fold_batch_norms(self):
+        """testing batch norms next to convolutions are folded into them without changing the outputs, and the others are kept
+        """
+        def batch_norm(channels):
+            layer = nn.BatchNorm2d(channels)
+            layer.running_mean.uniform_(-1, 1)
+            layer.running_var.uniform_(0.5, 2)
+            nn.init.uniform_(layer.weight, 0.5, 2)
+            nn.init.uniform_(layer.bias, -1, 1)
+            return layer
+        model = nn.Sequential(nn.Conv2d(1, 8, 5, padding=2), batch_norm(8), nn.Conv2d(8, 8, 3), batch_norm(8),
+                              nn.PReLU(), batch_norm(8), nn.Conv2d(8, 8, 1), nn.PReLU(), batch_norm(8),
+                              nn.Conv2d(8, 33, 3, padding=1)).eval()
+        with torch.no_grad():
+            expected = [model(batch) for batch in self.slices]
+            folded = fold_batch_norms(model)
+            for batch, output in zip(self.slices, expected):
+                assert torch.allclose(folded(batch), output, atol=1e-4)
+        kept = [i for i, layer in enumerate(folded) if isinstance(layer, nn.BatchNorm2d)]
+        # Folded after the first two convolutions and before the 1x1 one, kept before the padded one
+        assert kept == [8]
+
+    def test_dice_report(self):
+        """testing a model compared to itself is a perfect match
+        """
+        report = dice_report(self.model, self.model, self.slices)
+        assert all(dice == 1 for dice in report.values())
+
+
+@unittest.skipUnless(onnxruntime is not None, "onnxruntime is not installed")
+class TestOnnxBackend(unittest.TestCase):
+    """Test the ONNX Runtime backend gives the same scores as PyTorch
+    """
+
+    def test_parity(self):
+        """testing the exported ONNX model matches the torch model
+        """
+        torch.manual_seed(0)
+        with tempfile.TemporaryDirectory() as folder:
+            model_path = os.path.join(folder, "model.pth.tar")
+            torch.save(TinySegmenter().eval(), model_path)
+            segmenter = Segmenter(coronal_model_path=model_path, axial_model_path=model_path, backend="onnx", threads=2)
+            onnx = OnnxBackend(segmenter, "COR")
+            assert os.path.exists(onnx_path(model_path))
+            reference = TorchBackend(segmenter, "COR")
+            batch = torch.rand(2, 1, 256, 256)
+            assert np.allclose(onnx.predict(batch), reference.predict(batch), atol=1e-4)
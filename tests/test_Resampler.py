@@ -0,0 +1,148 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import nibabel as nib
+import torch
+from torch import nn
+from scipy import ndimage
+from nilearn.image import resample_img
+
+from Paint4Brains import Segmenter as segmenter_module
+from Paint4Brains.Segmenter import Segmenter, transform, new_affine, conformed_shape
+from Paint4Brains.ModelExport import scripted_path
+from Paint4Brains.Resampler import AffineResampler
+
+
+class TestResampler(unittest.TestCase):
+    """Test the AffineResampler against scipy
+    """
+    random = np.random.RandomState(0)
+    source = ndimage.gaussian_filter(random.rand(40, 50, 30), 2).astype(np.float32) * 100
+    labels = random.randint(0, 33, source.shape).astype(np.int16)
+    # Scaled, rotated and shifted mapping from target voxels to source voxels
+    angle = np.pi / 9
+    mapping = np.array([[1.2 * np.cos(angle), -np.sin(angle), 0, 3],
+                        [np.sin(angle), 0.9 * np.cos(angle), 0, -2],
+                        [0, 0, 1.1, 5],
+                        [0, 0, 0, 1]])
+    resampler = AffineResampler(np.eye(4), source.shape, mapping, (45, 45, 45), threads=2, chunk=3)
+
+    def test_trilinear(self):
+        """testing trilinear interpolation matches scipy
+        """
+        expected = ndimage.affine_transform(self.source, self.mapping, output_shape=(45, 45, 45), order=1)
+        resampled = self.resampler.forward(self.source)
+        assert resampled.dtype == np.float32
+        assert np.allclose(resampled, expected, atol=1e-3)
+
+    def test_nearest(self):
+        """testing nearest neighbour interpolation matches scipy in both directions
+        """
+        expected = ndimage.affine_transform(self.labels, self.mapping, output_shape=(45, 45, 45), order=0)
+        resampled = self.resampler.forward(self.labels, order=0)
+        assert resampled.dtype == self.labels.dtype
+        assert np.array_equal(resampled, expected)
+
+        expected = ndimage.affine_transform(resampled, np.linalg.inv(self.mapping), output_shape=self.source.shape,
+                                            order=0)
+        assert np.array_equal(self.resampler.inverse(resampled), expected)
+
+    def test_reorder(self):
+        """testing grids differing only by axis order and direction are reordered without interpolation
+        """
+        shape = (30, 40, 50)
+        volume = self.random.rand(*shape).astype(np.float32)
+        # Output axes run along input axes 2 (backwards), 0 and 1 (backwards)
+        mapping = np.array([[0, 1, 0, 0],
+                            [0, 0, -1, 39],
+                            [-1, 0, 0, 49],
+                            [0, 0, 0, 1.]])
+        resampler = AffineResampler(np.eye(4), shape, mapping, (50, 30, 40))
+        assert resampler.is_reorder
+        expected = ndimage.affine_transform(volume, mapping, output_shape=(50, 30, 40), order=1)
+        assert np.array_equal(resampler.forward(volume), expected)
+        assert np.array_equal(resampler.inverse(expected, order=1), volume)
+
+        assert not AffineResampler(np.eye(4), shape, mapping, (50, 30, 41)).is_reorder
+        assert not self.resampler.is_reorder
+
+    def test_wrong_shape(self):
+        """testing volumes of the wrong shape are rejected
+        """
+        with self.assertRaises(ValueError):
+            self.resampler.forward(self.source[1:])
+
+
+class TissueModel(nn.Module):
+    """Tiny stand in for QuickNAT, giving one of four tissue classes by intensity
+    """
+
+    def forward(self, input):
+        classes = torch.arange(33, dtype=input.dtype).view(1, 33, 1, 1)
+        scores = -(classes - input * 3) ** 2
+        return torch.where(classes < 4, scores, torch.full_like(scores, -1000.))
+
+
+class NilearnResampler:
+    """Conforms an image with resample_img and its default cubic interpolation, as transform did before the AffineResampler
+    """
+
+    def __init__(self, image):
+        self.image = image
+
+    def forward(self, data, order=1):
+        return resample_img(self.image, new_affine, target_shape=conformed_shape).get_fdata()
+
+
+def nilearn_transform(image, instrumentation=None, resampler=None):
+    """transform as it was with resample_img"""
+    return transform(image, instrumentation, NilearnResampler(image))
+
+
+class TestConformParity(unittest.TestCase):
+    """Test the trilinear conform matches the cubic resample_img it replaced on an oblique scan
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # Smooth nested tissues in a scan with anisotropic voxels, tilted by 15 degrees
+        shape = (60, 70, 50)
+        grid = np.indices(shape).astype(float)
+        radius = np.sqrt(((grid - np.array(shape)[:, None, None, None] / 2) ** 2).sum(0))
+        volume = np.select([radius < 8, radius < 14, radius < 20], [150., 100., 50.], 0.)
+        cls.volume = ndimage.gaussian_filter(volume, 1).astype(np.float32)
+        angle = np.pi / 12
+        rotation = np.array([[np.cos(angle), 0, np.sin(angle)], [0, 1, 0], [-np.sin(angle), 0, np.cos(angle)]])
+        cls.affine = np.eye(4)
+        cls.affine[:3, :3] = rotation @ np.diag([1.2, 1.0, 0.9])
+        cls.affine[:3, 3] = [-30, -35, -20]
+
+    def test_conformed_volume(self):
+        """testing the conformed uint8 volume is within a few grey levels of the resample_img one
+        """
+        image = nib.Nifti1Image(self.volume, self.affine)
+        conformed = np.asanyarray(transform(image).dataobj).astype(int)
+        expected = np.asanyarray(nilearn_transform(image).dataobj).astype(int)
+        difference = np.abs(conformed - expected)[(conformed > 0) | (expected > 0)]
+        assert difference.mean() < 1
+        assert np.percentile(difference, 99) <= 3
+        assert difference.max() <= 6
+
+    def test_labels(self):
+        """testing the final labels match those segmented from the resample_img conformed volume
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            model_path = os.path.join(folder, "model.pth.tar")
+            torch.jit.script(TissueModel()).save(scripted_path(model_path))
+            settings = dict(coronal_model_path=model_path, axial_model_path=model_path, use_cache=False)
+            labels = Segmenter(**settings).segment_array(self.volume, self.affine)
+            with mock.patch.object(segmenter_module, "transform", nilearn_transform):
+                expected = Segmenter(**settings).segment_array(self.volume, self.affine)
+        head = (labels > 0) | (expected > 0)
+        assert np.mean(labels[head] == expected[head]) > 0.98
+        for tissue in (1, 2, 3):
+            overlap = np.sum((labels == tissue) & (expected == tissue))
+            dice = 2 * overlap / (np.sum(labels == tissue) + np.sum(expected == tissue))
+            assert dice > 0.98
@@ -0,0 +1,124 @@
+import time
+import socket
+import tempfile
+import threading
+import unittest
+import numpy as np
+
+from Paint4Brains.Segmenter import Segmenter
+from Paint4Brains.SegmentDaemon import SegmentDaemon
+from Paint4Brains.DaemonClient import DaemonClient
+from test_Segmenter import save_model, synthetic_scan
+
+
+def wait_for(condition, timeout=60):
+    """Polls a condition until it holds, failing after the timeout."""
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError("Timed out")
+        time.sleep(0.05)
+
+
+class TestSegmentDaemon(unittest.TestCase):
+    """Test jobs submitted to a SegmentDaemon listening on an ephemeral port
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.TemporaryDirectory()
+        model_path = save_model(cls.folder.name)
+        cls.volume, cls.affine = synthetic_scan()
+        cls.settings = dict(coronal_model_path=model_path, axial_model_path=model_path, use_cache=False,
+                            confidence=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.folder.cleanup()
+
+    def setUp(self):
+        segmenter = Segmenter(keep_models=True, partial_interval=1., **self.settings)
+        self.daemon = SegmentDaemon(segmenter, ("127.0.0.1", 0))
+        # Requests are answered straight away, the jobs only run once the daemon is started
+        threading.Thread(target=self.daemon.server.serve_forever, daemon=True).start()
+        self.client = DaemonClient(self.daemon.address, poll_interval=0.05, **self.settings)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+
+    def test_segment(self):
+        """testing the labels and confidence of the daemon match the Segmenter, with progress and partial labels passed on
+        """
+        events, partials = [], []
+        self.client.subscribe(events.append)
+        self.client.subscribe_labels(partials.append)
+        self.daemon.start()
+        labels = self.client.segment_array(self.volume, self.affine)
+
+        reference = Segmenter(**self.settings)
+        assert np.array_equal(labels, reference.segment_array(self.volume, self.affine))
+        assert np.array_equal(self.client.confidence_map, reference.confidence_map)
+        assert len(events) > 0 and len(partials) > 0
+        # Finished jobs are removed by the client
+        assert self.daemon.status() == {"jobs": []}
+
+    def test_priority_and_cancel_queued(self):
+        """testing queued jobs run by priority, then in submission order, and cancelled ones never run
+        """
+        self.client.priority = 5
+        low = self.client._submit("preview", self.volume, self.affine, step=16)
+        self.client.priority = 0
+        high = self.client._submit("preview", self.volume, self.affine, step=16)
+        cancelled = self.client._submit("preview", self.volume, self.affine, step=16)
+        assert [self.daemon.status(job)["ahead"] for job in (high, cancelled, low)] == [0, 1, 2]
+
+        self.client._request("DELETE", "/jobs/" + cancelled)
+        assert self.daemon.status(cancelled)["status"] == "cancelled"
+        self.daemon.start()
+        wait_for(lambda: self.daemon.status(low)["status"] == "done")
+        assert self.daemon.status(high)["started"] < self.daemon.status(low)["started"]
+        assert self.daemon.status(cancelled)["started"] is None
+        assert self.daemon.result(low)["labels"].shape == self.volume.shape
+
+    def test_cancel_running(self):
+        """testing a client stopping its segmentation cancels the running job, and the daemon carries on
+        """
+        def stop(event):
+            if event.stage.startswith("Segmenting"):
+                self.client.run = False
+        self.client.subscribe(stop)
+        self.daemon.start()
+        with self.assertRaises(Exception):
+            self.client.segment_array(self.volume, self.affine)
+        wait_for(lambda: self.daemon.status() == {"jobs": []})
+
+        self.client.unsubscribe(stop)
+        self.client.run = True
+        preview = self.client.segment_preview(self.volume, self.affine, step=16)
+        assert preview.shape == self.volume.shape
+
+    def test_fallback(self):
+        """testing jobs run in a worker process when no daemon is listening
+        """
+        with socket.socket() as unused:
+            unused.bind(("127.0.0.1", 0))
+            address = unused.getsockname()
+        client = DaemonClient(address, **self.settings)
+        preview = client.segment_preview(self.volume, self.affine, step=16)
+        assert np.array_equal(preview, Segmenter(**self.settings).segment_preview(self.volume, self.affine, step=16))
+
+    def test_settings(self):
+        """testing the checkpoint and confidence settings of a job are honoured, and jobs for other models refused
+        """
+        self.client.confidence = False
+        self.daemon.start()
+        self.client.segment_array(self.volume, self.affine)
+        assert self.client.confidence_map is None
+        assert self.daemon.segmenter.confidence is False and self.daemon.segmenter.checkpoint is False
+
+        for settings in ({"device": "cuda"}, {"backend": "onnx"}, {"quantised": True}):
+            client = DaemonClient(self.daemon.address, **dict(self.settings, **settings))
+            assert client._submit("segment", self.volume, self.affine) is None
+            with self.assertRaises(ValueError):
+                self.daemon.submit("segment", {"volume": self.volume, "affine": self.affine}, settings=settings)
+        assert self.daemon.status() == {"jobs": []}
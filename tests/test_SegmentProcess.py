@@ -0,0 +1,121 @@
+import os
+import glob
+import tempfile
+import unittest
+import multiprocessing
+import numpy as np
+
+from Paint4Brains.Segmenter import Segmenter
+from Paint4Brains.SegmentProcess import SegmentProcess
+from test_Segmenter import save_model, synthetic_scan
+
+
+def shared_files():
+    """Files of the shared arrays currently existing"""
+    folders = {"/dev/shm", tempfile.gettempdir()}
+    return set(path for folder in folders for path in glob.glob(os.path.join(folder, "paint4brains_*")))
+
+
+class TestSegmentProcess(unittest.TestCase):
+    """Test segmentations run in a worker process
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.TemporaryDirectory()
+        cls.model_path = save_model(cls.folder.name)
+        cls.volume, cls.affine = synthetic_scan()
+        cls.settings = dict(coronal_model_path=cls.model_path, axial_model_path=cls.model_path, use_cache=False,
+                            confidence=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.folder.cleanup()
+
+    def setUp(self):
+        self.before = shared_files()
+
+    def tearDown(self):
+        # Every shared array has been removed, whatever happened to the worker
+        assert shared_files() == self.before
+        assert multiprocessing.active_children() == []
+
+    def test_segment(self):
+        """testing the labels and confidence copied back from the worker match the Segmenter
+        """
+        segmenter = SegmentProcess(**self.settings)
+        events = []
+        segmenter.subscribe(events.append)
+        labels = segmenter.segment_array(self.volume, self.affine)
+
+        reference = Segmenter(**self.settings)
+        assert np.array_equal(labels, reference.segment_array(self.volume, self.affine))
+        assert np.array_equal(segmenter.confidence_map, reference.confidence_map)
+        assert events[-1].stage == "Finished evaluation"
+
+    def test_error(self):
+        """testing an error in the worker is raised by the caller
+        """
+        missing = os.path.join(self.folder.name, "missing.pth.tar")
+        segmenter = SegmentProcess(coronal_model_path=missing, axial_model_path=missing, use_cache=False)
+        with self.assertRaises(Exception) as raised:
+            segmenter.segment_array(self.volume, self.affine)
+        assert "missing.pth.tar" in str(raised.exception)
+
+    def test_cancel(self):
+        """testing setting run to False kills the worker
+        """
+        segmenter = SegmentProcess(**self.settings)
+
+        def stop(event):
+            if event.stage.startswith("Segmenting"):
+                segmenter.run = False
+        segmenter.subscribe(stop)
+        with self.assertRaises(Exception) as raised:
+            segmenter.segment_array(self.volume, self.affine)
+        assert str(raised.exception) == "Segmentation has been killed"
+        assert segmenter.state == "Not running"
+
+    def test_cancel_workers(self):
+        """testing cancelling a run with worker processes stops them all and removes every shared array
+        """
+        self._cancel_workers(SegmentProcess.stop_timeout)
+
+    def test_kill_workers(self):
+        """testing a worker which does not stop in time is killed with its own workers, and its shared arrays removed
+        """
+        self._cancel_workers(0)
+
+    def _cancel_workers(self, stop_timeout):
+        """Cancels a segmentation run by two workers once they are segmenting, then checks none of them is left"""
+        segmenter = SegmentProcess(workers=2, **self.settings)
+        segmenter.stop_timeout = stop_timeout
+        workers = []
+
+        def stop(event):
+            if event.stage.startswith("Segmenting"):
+                workers.extend(multiprocessing.active_children())
+                segmenter.run = False
+        segmenter.subscribe(stop)
+        with self.assertRaises(Exception) as raised:
+            segmenter.segment_array(self.volume, self.affine)
+        assert str(raised.exception) == "Segmentation has been killed"
+        assert len(workers) == 1
+        if os.path.isdir("/proc"):
+            # The workers of the worker process are in its process group
+            assert process_group(workers[0].pid) == []
+
+
+def process_group(group):
+    """Ids of the processes still running in a process group"""
+    processes = []
+    for stat in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat) as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # The fields after the name are the state, the parent and the process group; zombies have exited already
+        if int(fields[2]) == group and fields[0] != "Z":
+            processes.append(int(stat.split("/")[2]))
+    return processes
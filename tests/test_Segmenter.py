@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import torch
+from torch import nn
+
+from Paint4Brains.Segmenter import Segmenter, top_two, confidence_dtype
+from Paint4Brains.ModelExport import scripted_path
+
+
+class IntensityModel(nn.Module):
+    """Tiny stand in for QuickNAT, scoring the classes by how close they are to the intensity of each voxel
+    """
+
+    def forward(self, input):
+        classes = torch.arange(33, dtype=input.dtype).view(1, 33, 1, 1)
+        return -(classes - input * 32) ** 2
+
+
+def save_model(folder):
+    """Saves the TorchScript export of an IntensityModel, which the Segmenter loads instead of the checkpoint
+
+    Returns:
+        str: Path of the (missing) checkpoint to give to the Segmenter
+    """
+    model_path = os.path.join(folder, "model.pth.tar")
+    torch.jit.script(IntensityModel()).save(scripted_path(model_path))
+    return model_path
+
+
+def synthetic_scan(shape=(60, 70, 50), seed=0):
+    """Volume and affine of a noisy ball standing in for a head"""
+    random = np.random.RandomState(seed)
+    grid = np.indices(shape).astype(float)
+    radius = np.sqrt(((grid - np.array(shape)[:, None, None, None] / 2) ** 2).sum(0))
+    volume = np.where(radius < min(shape) / 2.5, 100 + 50 * random.rand(*shape), 0).astype(np.float32)
+    affine = np.diag([1.2, 1.0, 0.9, 1])
+    affine[:3, 3] = [-30, -35, -20]
+    return volume, affine
+
+
+class TestSegmenter(unittest.TestCase):
+    """Test the functions of the Segmenter that do not need the models
+    """
+
+    def test_top_two(self):
+        """testing the two most likely classes and their quantised probabilities
+        """
+        scores = np.random.randn(5, 33, 4, 6).astype(np.half) * 8
+        confidence = top_two(scores, chunk=2)
+
+        # one voxel per slice and pixel, and the same classes as the argmax
+        assert confidence.dtype == confidence_dtype
+        assert confidence.shape == (5, 4, 6)
+        assert np.array_equal(confidence["first"], np.argmax(scores, axis=1))
+
+        # the probabilities are the softmax of the mean scores of both axes
+        probabilities = np.exp(scores.astype(float) / 2)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        ordered = np.sort(probabilities, axis=1)
+        assert np.all(np.abs(confidence["first_confidence"] - ordered[:, -1] * 255) <= 1)
+        assert np.all(np.abs(confidence["second_confidence"] - ordered[:, -2] * 255) <= 1)
+        assert np.all(confidence["second"] != confidence["first"])
+
+
+class TestSegmenterWorkers(unittest.TestCase):
+    """Test segmentations shared between worker processes
+    """
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.model_path = save_model(self.folder.name)
+        self.volume, self.affine = synthetic_scan()
+        self.settings = dict(coronal_model_path=self.model_path, axial_model_path=self.model_path, use_cache=False)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_checkpoint_resumes(self):
+        """testing an interrupted checkpointed segmentation in two workers resumes to the same labels
+        """
+        reference = Segmenter(**self.settings).segment_array(self.volume, self.affine)
+        segmenter = Segmenter(workers=2, checkpoint=True, **self.settings)
+
+        def interrupt(event):
+            if event.stage.startswith("Segmenting") and event.done >= 10:
+                segmenter.run = False
+        segmenter.subscribe(interrupt)
+        with self.assertRaises(Exception):
+            segmenter.segment_array(self.volume, self.affine)
+        segmenter.unsubscribe(interrupt)
+        segmenter.run = True
+        labels = segmenter.segment_array(self.volume, self.affine)
+        assert segmenter._resumed > 0
+        assert np.array_equal(labels, reference)